@@ -15,84 +15,136 @@
 
 """Manage user accounts on a Google Compute Engine instances."""
 
+import calendar
 import datetime
+import hashlib
+import heapq
 import json
 import logging.handlers
+import multiprocessing.pool
 import optparse
+import threading
+import time
 
 from google_compute_engine import config_manager
 from google_compute_engine import file_utils
 from google_compute_engine import logger
 from google_compute_engine import metadata_watcher
 from google_compute_engine.accounts import accounts_utils
+from google_compute_engine.accounts import authorized_keys_index
+from google_compute_engine.accounts import nss_cache_utils
 
 LOCKFILE = '/var/lock/google_accounts.lock'
+# The longest wait in seconds for an SSH key expiration. Expirations far in
+# the future are waited for in steps, which keeps the timeout in range.
+EXPIRY_WAIT_MAX = 3600
 
 
 class AccountsDaemon(object):
   """Manage user accounts based on changes to metadata."""
 
   invalid_users = set()
-
-  def __init__(self, groups=None, remove=False, debug=False):
+  accounts_metadata = [
+      'instance/attributes/block-project-ssh-keys',
+      'instance/attributes/sshKeys',
+      'instance/attributes/ssh-keys',
+      'project/attributes/sshKeys',
+      'project/attributes/ssh-keys',
+  ]
+
+  def __init__(
+      self, groups=None, remove=False, workers=1, nss_cache=False,
+      lazy_home=False, force=False, debug=False):
     """Constructor.
 
     Args:
       groups: string, a comma separated list of groups.
       remove: bool, True if deprovisioning a user should be destructive.
+      workers: int, the number of user accounts to update concurrently.
+      nss_cache: bool, True if user accounts are written to NSS cache files.
+      lazy_home: bool, True if home directories are created on first login.
+      force: bool, True if every user account is updated on the first
+          metadata change instead of only the changed user accounts.
       debug: bool, True if debug output should write to the console.
     """
     facility = logging.handlers.SysLogHandler.LOG_DAEMON
     self.logger = logger.Logger(
         name='google-accounts', debug=debug, facility=facility)
+    try:
+      self.workers = max(int(workers), 1)
+    except (TypeError, ValueError):
+      self.logger.warning('Invalid number of workers %s.', workers)
+      self.workers = 1
     self.watcher = metadata_watcher.MetadataWatcher(logger=self.logger)
-    self.utils = accounts_utils.AccountsUtils(
-        logger=self.logger, groups=groups, remove=remove)
+    if nss_cache:
+      utils = nss_cache_utils.NssCacheUtils
+    else:
+      utils = accounts_utils.AccountsUtils
+    self.utils = utils(
+        logger=self.logger, groups=groups, remove=remove, lazy_home=lazy_home)
+    self.keys_index = authorized_keys_index.AuthorizedKeysIndex()
+    # The SSH key entries of each metadata attribute and the expiration time
+    # of each SSH key, reused until the attribute changes.
+    self.parse_cache = {}
+    self.expirations = {}
+    # The SSH keys of the configured users and a heap of upcoming expiration
+    # times, used to revoke expired keys between metadata changes.
+    self.accounts = {}
+    self.expiry_heap = []
+    # The latest metadata contents not yet reconciled. The watcher thread
+    # replaces it while the reconcile thread updates the user accounts.
+    self.pending_result = None
+    self.reconcile_condition = threading.Condition()
+    self.reconcile_stopped = threading.Event()
+    self.force = force
+    self.user_state = self.utils.GetUserState()
+    self.unverified_users = set(self.user_state)
     try:
       with file_utils.LockFile(LOCKFILE):
         self.logger.info('Starting Google Accounts daemon.')
-        self.watcher.WatchMetadata(self.HandleAccounts, recursive=True)
+        reconcile_thread = threading.Thread(target=self._Reconcile)
+        reconcile_thread.daemon = True
+        reconcile_thread.start()
+        self.watcher.WatchMetadata(
+            self._QueueAccounts, recursive=True,
+            selector=self.accounts_metadata)
+        self._StopReconcile()
     except (IOError, OSError) as e:
       self.logger.warning(str(e))
 
-  def _HasExpired(self, key):
-    """Check whether an SSH key has expired.
+  def _ParseExpiration(self, key):
+    """Parse the expiration time of an SSH key.
 
     Uses Google-specific semantics of the OpenSSH public key format's comment
-    field to determine if an SSH key is past its expiration timestamp, and
-    therefore no longer to be trusted. This format is still subject to change.
-    Reliance on it in any way is at your own risk.
+    field to find the expiration timestamp of an SSH key. This format is still
+    subject to change. Reliance on it in any way is at your own risk.
 
     Args:
       key: string, a single public key entry in OpenSSH public key file format.
-          This will be checked for Google-specific comment semantics, and if
-          present, those will be analysed.
 
     Returns:
-      bool, True if the key has Google-specific comment semantics and has an
-          expiration timestamp in the past, or False otherwise.
+      int, the expiration time in seconds since the epoch, or None if the key
+          has no Google-specific expiration timestamp.
     """
-    self.logger.debug('Processing key: %s.', key)
-
     try:
       schema, json_str = key.split(None, 3)[2:]
     except (ValueError, AttributeError):
       self.logger.debug('No schema identifier. Not expiring key.')
-      return False
+      return None
 
     if schema != 'google-ssh':
       self.logger.debug('Invalid schema %s. Not expiring key.', schema)
-      return False
+      return None
 
     try:
       json_obj = json.loads(json_str)
     except ValueError:
       self.logger.debug('Invalid JSON %s. Not expiring key.', json_str)
-      return False
+      return None
 
     if 'expireOn' not in json_obj:
       self.logger.debug('No expiration timestamp. Not expiring key.')
-      return False
+      return None
 
     expire_str = json_obj['expireOn']
     format_str = '%Y-%m-%dT%H:%M:%S+0000'
@@ -102,37 +154,91 @@ class AccountsDaemon(object):
       self.logger.warning(
           'Expiration timestamp "%s" not in format %s. Not expiring key.',
           expire_str, format_str)
+      return None
+
+    return calendar.timegm(expire_time.timetuple())
+
+  def _GetExpiration(self, key):
+    """Get the expiration time of an SSH key, parsing each key only once.
+
+    Args:
+      key: string, a single public key entry in OpenSSH public key file format.
+
+    Returns:
+      int, the expiration time in seconds since the epoch, or None if the key
+          has no Google-specific expiration timestamp.
+    """
+    try:
+      return self.expirations[key]
+    except KeyError:
+      expiration = self._ParseExpiration(key)
+      self.expirations[key] = expiration
+      return expiration
+
+  def _HasExpired(self, key):
+    """Check whether an SSH key has expired.
+
+    Args:
+      key: string, a single public key entry in OpenSSH public key file format.
+          This will be checked for Google-specific comment semantics, and if
+          present, those will be analysed.
+
+    Returns:
+      bool, True if the key has Google-specific comment semantics and has an
+          expiration timestamp in the past, or False otherwise.
+    """
+    expiration = self._GetExpiration(key)
+    if expiration is None:
       return False
 
     # Expire the key if and only if we have exceeded the expiration timestamp.
-    return datetime.datetime.utcnow() > expire_time
+    return time.time() > expiration
 
-  def _ParseAccountsData(self, account_data):
+  def _ParseEntries(self, account_data):
+    """Split the SSH key data into user and SSH key entries.
+
+    Args:
+      account_data: string, the metadata server SSH key attributes data.
+
+    Returns:
+      list, tuples with the user name and the SSH key of each entry.
+    """
+    entries = []
+    for line in account_data.splitlines():
+      if not line:
+        continue
+      split_line = line.split(':', 1)
+      if len(split_line) != 2:
+        self.logger.info('SSH key is not a complete entry: %s.', split_line)
+        continue
+      entries.append(tuple(split_line))
+    return entries
+
+  def _ParseAccountsData(self, account_data, source=None):
     """Parse the SSH key data into a user map.
 
     Args:
       account_data: string, the metadata server SSH key attributes data.
+      source: string, the metadata attribute of the data, used to parse each
+          version of the attribute only once.
 
     Returns:
       dict, a mapping of the form: {'username': ['sshkey1, 'sshkey2', ...]}.
     """
     if not account_data:
       return {}
-    lines = [line for line in account_data.splitlines() if line]
+    cached_data, entries = self.parse_cache.get(source, (None, None))
+    if cached_data != account_data:
+      entries = self._ParseEntries(account_data)
+      if source:
+        self.parse_cache[source] = (account_data, entries)
     user_map = {}
-    for line in lines:
-      split_line = line.split(':', 1)
-      if len(split_line) != 2:
-        self.logger.info('SSH key is not a complete entry: %s.', split_line)
-        continue
-      user, key = split_line
+    for user, key in entries:
       if self._HasExpired(key):
-        self.logger.debug('Expired SSH key for user %s: %s.', user, key)
         continue
       if user not in user_map:
         user_map[user] = []
       user_map[user].append(key)
-    logging.debug('User accounts: %s.', user_map)
     return user_map
 
   def _GetAccountsData(self, metadata_dict):
@@ -157,25 +263,160 @@ class AccountsDaemon(object):
     except KeyError:
       project_data = {}
       self.logger.warning('Project attributes were not found.')
-    valid_keys = [instance_data.get('sshKeys'), instance_data.get('ssh-keys')]
+    sources = [
+        ('instance/sshKeys', instance_data.get('sshKeys')),
+        ('instance/ssh-keys', instance_data.get('ssh-keys')),
+    ]
     block_project = instance_data.get('block-project-ssh-keys', '').lower()
     if block_project != 'true' and not instance_data.get('sshKeys'):
-      valid_keys.append(project_data.get('ssh-keys'))
-      valid_keys.append(project_data.get('sshKeys'))
-    accounts_data = '\n'.join([key for key in valid_keys if key])
-    return self._ParseAccountsData(accounts_data)
+      sources.append(('project/ssh-keys', project_data.get('ssh-keys')))
+      sources.append(('project/sshKeys', project_data.get('sshKeys')))
+
+    changed = False
+    user_map = {}
+    for source, account_data in sources:
+      if account_data != self.parse_cache.get(source, (None, None))[0]:
+        changed = True
+      for user, keys in self._ParseAccountsData(account_data, source).items():
+        user_map.setdefault(user, []).extend(keys)
+
+    # Forget attributes and SSH keys that are no longer in metadata.
+    active_sources = set(source for source, data in sources if data)
+    for source in list(self.parse_cache):
+      if source not in active_sources:
+        del self.parse_cache[source]
+        changed = True
+    if changed:
+      active_keys = set()
+      for _, entries in self.parse_cache.values():
+        active_keys.update(key for _, key in entries)
+      for key in list(self.expirations):
+        if key not in active_keys:
+          del self.expirations[key]
+
+    self.logger.debug('Found SSH keys for %s user accounts.', len(user_map))
+    return user_map
+
+  def _Map(self, function, items):
+    """Call a function for each item using the configured number of workers.
+
+    Args:
+      function: function, called with each item.
+      items: list, the items to process.
+
+    Returns:
+      list, the result of the function for each item in order.
+    """
+    workers = min(self.workers, len(items))
+    if workers <= 1:
+      return [function(item) for item in items]
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+      return pool.map(function, items)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _GetUserState(self, ssh_keys):
+    """Get the state applied to a Linux user account.
+
+    Args:
+      ssh_keys: list, the SSH key strings associated with the user.
+
+    Returns:
+      dict, a fingerprint of the SSH keys and the sorted group names.
+    """
+    keys = '\n'.join(ssh_keys).encode('utf-8')
+    return {
+        'fingerprint': hashlib.sha256(keys).hexdigest(),
+        'groups': sorted(self.utils.groups),
+    }
 
-  def _UpdateUsers(self, update_users):
+  def _HasUserChanged(self, user, user_state):
+    """Check whether a user account differs from the state last applied.
+
+    Args:
+      user: string, the name of the Linux user account.
+      user_state: dict, the state the user account should have.
+
+    Returns:
+      bool, True if the user account needs to be updated.
+    """
+    applied_state = self.user_state.get(user)
+    if not applied_state:
+      return True
+    for key, value in user_state.items():
+      if applied_state.get(key) != value:
+        return True
+    return False
+
+  def _UpdateUsers(self, update_users, force=False):
     """Provision and update Linux user accounts based on account metadata.
 
+    Users whose SSH keys and groups are unchanged since their last successful
+    update are skipped unless a full resync is forced. Users loaded from the
+    saved state are checked once for drift instead of being updated. The group
+    membership of existing users is updated in one batch.
+
+    When newer metadata contents arrive, the users not yet started are left
+    for the next reconcile, which diffs against the newer contents.
+
     Args:
       update_users: dict, authorized users mapped to their public SSH keys.
+      force: bool, True if every user account should be updated.
+
+    Returns:
+      bool, False if the update stopped early for newer metadata contents.
     """
+    pending_users = {}
     for user, ssh_keys in update_users.items():
       if not user or user in self.invalid_users:
         continue
-      if not self.utils.UpdateUser(user, ssh_keys):
+      user_state = self._GetUserState(ssh_keys)
+      unchanged = not force and not self._HasUserChanged(user, user_state)
+      if unchanged and user in self.unverified_users:
+        unchanged = self.utils.CheckUser(user, ssh_keys)
+        if not unchanged:
+          self.logger.info('Repairing changes to user account %s.', user)
+      self.unverified_users.discard(user)
+      if not unchanged:
+        pending_users[user] = user_state
+
+    stats = dict(self.utils.stats)
+    users = sorted(pending_users)
+    if users:
+      self.utils.UpdateGroups(users)
+
+    def _UpdateUser(user):
+      if self._IsPreempted():
+        return None
+      return self.utils.UpdateUser(user, update_users[user])
+
+    results = self._Map(_UpdateUser, users)
+    for user, success in zip(users, results):
+      if success is None:
+        # Check the user again in the next reconcile.
+        self.unverified_users.add(user)
+      elif success:
+        pending_users[user]['applied'] = int(time.time())
+        self.user_state[user] = pending_users[user]
+      else:
+        self.user_state.pop(user, None)
         self.invalid_users.add(user)
+    self.logger.debug(
+        'Updated %s of %s user accounts.', len(pending_users),
+        len(update_users))
+    self.logger.debug(
+        'Rewrote %s and skipped %s unchanged authorized keys files.',
+        self.utils.stats['authorized_keys_rewritten'] -
+        stats['authorized_keys_rewritten'],
+        self.utils.stats['authorized_keys_skipped'] -
+        stats['authorized_keys_skipped'])
+    skipped = results.count(None)
+    if skipped:
+      self.logger.info(
+          'Deferred %s user accounts to newer metadata contents.', skipped)
+    return not skipped
 
   def _RemoveUsers(self, remove_users):
     """Deprovision Linux user accounts that do not appear in account metadata.
@@ -183,35 +424,203 @@ class AccountsDaemon(object):
     Args:
       remove_users: list, the username strings of the Linux accounts to remove.
     """
+    self._Map(self.utils.RemoveUser, remove_users)
     for username in remove_users:
-      self.utils.RemoveUser(username)
+      self.user_state.pop(username, None)
     self.invalid_users -= set(remove_users)
 
-  def HandleAccounts(self, result):
+  def _UpdateKeysIndex(self, users):
+    """Update the index of SSH keys served to sshd.
+
+    Args:
+      users: dict, authorized users mapped to their public SSH keys.
+    """
+    index_users = {}
+    for user, ssh_keys in users.items():
+      if user and user not in self.invalid_users:
+        index_users[user] = [
+            (ssh_key, self._GetExpiration(ssh_key)) for ssh_key in ssh_keys]
+    try:
+      self.keys_index.Write(index_users)
+    except (IOError, OSError) as e:
+      self.logger.warning('Could not update the SSH keys index. %s.', str(e))
+
+  def _ScheduleExpirations(self, users):
+    """Rebuild the heap of upcoming SSH key expirations.
+
+    Args:
+      users: dict, the user account names mapped to their SSH keys.
+    """
+    expiry_heap = []
+    for user, ssh_keys in users.items():
+      for ssh_key in ssh_keys:
+        expiration = self._GetExpiration(ssh_key)
+        if expiration is not None:
+          expiry_heap.append((expiration, user))
+    heapq.heapify(expiry_heap)
+    self.expiry_heap = expiry_heap
+
+  def _ExpireKeys(self):
+    """Revoke the SSH keys that expired since the last metadata change.
+
+    Only the users with an expired SSH key are updated, using the SSH keys
+    from the last metadata change. Called from the reconcile thread.
+    """
+    now = time.time()
+    expired_users = set()
+    while self.expiry_heap and self.expiry_heap[0][0] < now:
+      expired_users.add(heapq.heappop(self.expiry_heap)[1])
+
+    update_users = {}
+    remove_users = []
+    for user in sorted(expired_users):
+      if user not in self.accounts:
+        continue
+      ssh_keys = [
+          key for key in self.accounts[user] if not self._HasExpired(key)]
+      if ssh_keys:
+        update_users[user] = self.accounts[user] = ssh_keys
+      else:
+        remove_users.append(user)
+        del self.accounts[user]
+    if not update_users and not remove_users:
+      return
+
+    self.logger.info(
+        'Revoking expired SSH keys of %s user accounts.',
+        len(update_users) + len(remove_users))
+    if self._UpdateUsers(update_users):
+      self._RemoveUsers(remove_users)
+    else:
+      # The newer metadata contents decide which users to remove.
+      remove_users = []
+    try:
+      self.utils.Flush()
+    except (IOError, OSError) as e:
+      self.logger.warning('Could not write the user accounts. %s.', str(e))
+    if remove_users:
+      self.utils.SetConfiguredUsers(self.accounts.keys())
+    try:
+      self.utils.SetUserState(self.user_state)
+    except (IOError, OSError) as e:
+      self.logger.warning('Could not save the accounts state. %s.', str(e))
+
+  def _IsPreempted(self):
+    """Check whether newer metadata contents are waiting to be reconciled.
+
+    Returns:
+      bool, True if the current reconcile should stop at the next user.
+    """
+    with self.reconcile_condition:
+      return self.pending_result is not None
+
+  def _QueueAccounts(self, result):
+    """Queue metadata contents for the reconcile thread.
+
+    Called by the metadata watcher, which keeps waiting for changes while
+    the user accounts are updated. Only the latest contents are kept.
+
+    Args:
+      result: json, the deserialized contents of the metadata server.
+    """
+    with self.reconcile_condition:
+      if self.pending_result is not None:
+        self.logger.debug('Replacing metadata contents not yet reconciled.')
+      self.pending_result = result
+      self.reconcile_condition.notify()
+
+  def _Reconcile(self):
+    """Update the user accounts for queued metadata and expired SSH keys.
+
+    Waits for the latest queued metadata contents or the earliest SSH key
+    expiration, whichever comes first. Exceptions are logged, so the thread
+    only stops when the daemon stops it.
+    """
+    while True:
+      try:
+        with self.reconcile_condition:
+          while (self.pending_result is None and
+                 not self.reconcile_stopped.is_set()):
+            timeout = None
+            if self.expiry_heap:
+              timeout = self.expiry_heap[0][0] - time.time()
+              if timeout <= 0:
+                break
+              timeout = min(timeout, EXPIRY_WAIT_MAX)
+            self.reconcile_condition.wait(timeout)
+          if self.reconcile_stopped.is_set():
+            return
+          result, self.pending_result = self.pending_result, None
+        # The files changed in one pass are relabeled with one restorecon.
+        with file_utils.BatchSELinuxContext():
+          if result is not None:
+            self.HandleAccounts(result)
+          else:
+            self._ExpireKeys()
+      except Exception as e:
+        self.logger.exception('Exception updating user accounts. %s.', e)
+
+  def _StopReconcile(self):
+    """Stop the thread updating the user accounts."""
+    with self.reconcile_condition:
+      self.reconcile_stopped.set()
+      self.reconcile_condition.notify()
+
+  def HandleAccounts(self, result, force=False):
     """Called when there are changes to the contents of the metadata server.
 
+    The update stops early when newer metadata contents are queued. The work
+    done so far is saved, and the newer contents are then reconciled against
+    the saved state, so several quick changes converge in one pass.
+
     Args:
       result: json, the deserialized contents of the metadata server.
+      force: bool, True if every user account should be updated.
     """
     self.logger.debug('Checking for changes to user accounts.')
+    force = force or self.force
     configured_users = self.utils.GetConfiguredUsers()
+    configured_users = set(configured_users) | set(self.user_state)
     desired_users = self._GetAccountsData(result)
-    remove_users = sorted(set(configured_users) - set(desired_users.keys()))
-    self._UpdateUsers(desired_users)
-    self._RemoveUsers(remove_users)
-    self.utils.SetConfiguredUsers(desired_users.keys())
+    remove_users = sorted(configured_users - set(desired_users.keys()))
+    completed = self._UpdateUsers(desired_users, force=force)
+    if completed:
+      self.force = False
+      self._RemoveUsers(remove_users)
+    try:
+      self.utils.Flush()
+    except (IOError, OSError) as e:
+      self.logger.warning('Could not write the user accounts. %s.', str(e))
+    if completed:
+      self.unverified_users.clear()
+      self.utils.SetConfiguredUsers(desired_users.keys())
+      self._UpdateKeysIndex(desired_users)
+    try:
+      self.utils.SetUserState(self.user_state)
+    except (IOError, OSError) as e:
+      self.logger.warning('Could not save the accounts state. %s.', str(e))
+    if completed:
+      self.accounts = desired_users
+      self._ScheduleExpirations(desired_users)
 
 
 def main():
   parser = optparse.OptionParser()
   parser.add_option('-d', '--debug', action='store_true', dest='debug',
                     help='print debug output to the console.')
+  parser.add_option('-f', '--force', action='store_true', dest='force',
+                    help='update every user account on the first metadata '
+                    'change.')
   (options, _) = parser.parse_args()
   instance_config = config_manager.ConfigManager()
   if instance_config.GetOptionBool('Daemons', 'accounts_daemon'):
     AccountsDaemon(
         groups=instance_config.GetOptionString('Accounts', 'groups'),
         remove=instance_config.GetOptionBool('Accounts', 'deprovision_remove'),
+        workers=instance_config.GetOptionString('Accounts', 'workers'),
+        nss_cache=instance_config.GetOptionBool('Accounts', 'nss_cache'),
+        lazy_home=instance_config.GetOptionBool('Accounts', 'lazy_home'),
+        force=bool(options.force),
         debug=bool(options.debug))
 
 
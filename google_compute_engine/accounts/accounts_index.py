@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-memory index of the local passwd and group databases."""
+
+import grp
+import os
+import pwd
+import threading
+
+PASSWD_FILE = '/etc/passwd'
+GROUP_FILE = '/etc/group'
+
+
+class AccountsIndex(object):
+  """Look up Linux users and groups without a NSS call per lookup.
+
+  The index is a snapshot of the passwd and group files. It is rebuilt when
+  either file changes on disk or when it is invalidated after a command
+  modifying the accounts databases. Names missing from the files, such as
+  users provided by LDAP, are looked up through NSS.
+  """
+
+  def __init__(self, passwd_file=PASSWD_FILE, group_file=GROUP_FILE):
+    """Constructor.
+
+    Args:
+      passwd_file: string, the path of the passwd database file.
+      group_file: string, the path of the group database file.
+    """
+    self.passwd_file = passwd_file
+    self.group_file = group_file
+    self.lock = threading.RLock()
+    self.file_stats = None
+    self.users = {}
+    self.groups = {}
+    self.user_groups = {}
+    self.stats = {'loads': 0, 'hits': 0, 'misses': 0}
+
+  def _GetFileStats(self):
+    """Get the identity of the current passwd and group files.
+
+    Returns:
+      tuple, the inode, size, and modification time of each file.
+    """
+    file_stats = []
+    for path in (self.passwd_file, self.group_file):
+      try:
+        stat = os.stat(path)
+      except OSError:
+        file_stats.append(None)
+      else:
+        file_stats.append((stat.st_ino, stat.st_size, stat.st_mtime))
+    return tuple(file_stats)
+
+  def _ReadEntries(self, path, fields):
+    """Read the entries of a colon separated database file.
+
+    Args:
+      path: string, the path of the database file.
+      fields: int, the number of fields of a valid entry.
+
+    Returns:
+      list, the fields of each valid entry.
+    """
+    try:
+      with open(path) as database:
+        lines = database.readlines()
+    except (IOError, OSError):
+      return []
+    entries = []
+    for line in lines:
+      line = line.rstrip('\n')
+      # Skip comments and NIS compat entries, these are resolved through NSS.
+      if not line or line[0] in '#+-':
+        continue
+      entry = line.split(':')
+      if len(entry) == fields:
+        entries.append(entry)
+    return entries
+
+  def _Load(self):
+    """Rebuild the index from the passwd and group files."""
+    users = {}
+    for entry in self._ReadEntries(self.passwd_file, 7):
+      try:
+        entry[2:4] = [int(entry[2]), int(entry[3])]
+      except ValueError:
+        continue
+      users[entry[0]] = pwd.struct_passwd(entry)
+    groups = {}
+    user_groups = {}
+    for entry in self._ReadEntries(self.group_file, 4):
+      try:
+        entry[2] = int(entry[2])
+      except ValueError:
+        continue
+      entry[3] = [member for member in entry[3].split(',') if member]
+      groups[entry[0]] = grp.struct_group(entry)
+      for member in entry[3]:
+        user_groups.setdefault(member, set()).add(entry[0])
+    self.users = users
+    self.groups = groups
+    self.user_groups = user_groups
+    self.stats['loads'] += 1
+
+  def _Refresh(self):
+    """Rebuild the index if it is invalid or the database files changed."""
+    file_stats = self._GetFileStats()
+    if file_stats != self.file_stats:
+      self._Load()
+      self.file_stats = file_stats
+
+  def Invalidate(self):
+    """Force the index to be rebuilt before the next lookup."""
+    with self.lock:
+      self.file_stats = None
+
+  def GetUser(self, user):
+    """Retrieve a Linux user account.
+
+    Args:
+      user: string, the name of the Linux user account to retrieve.
+
+    Returns:
+      pwd.struct_passwd, the Linux user or None if it does not exist.
+    """
+    with self.lock:
+      self._Refresh()
+      pw_entry = self.users.get(user)
+      if pw_entry:
+        self.stats['hits'] += 1
+        return pw_entry
+      self.stats['misses'] += 1
+    try:
+      return pwd.getpwnam(user)
+    except KeyError:
+      return None
+
+  def GetGroup(self, group):
+    """Retrieve a Linux group.
+
+    Args:
+      group: string, the name of the Linux group to retrieve.
+
+    Returns:
+      grp.struct_group, the Linux group or None if it does not exist.
+    """
+    with self.lock:
+      self._Refresh()
+      gr_entry = self.groups.get(group)
+      if gr_entry:
+        self.stats['hits'] += 1
+        return gr_entry
+      self.stats['misses'] += 1
+    try:
+      return grp.getgrnam(group)
+    except KeyError:
+      return None
+
+  def GetUserGroups(self, user):
+    """Retrieve the local supplementary groups of a Linux user.
+
+    Args:
+      user: string, the name of the Linux user account.
+
+    Returns:
+      set, the names of the groups in the group file listing the user.
+    """
+    with self.lock:
+      self._Refresh()
+      return set(self.user_groups.get(user, ()))
+
+  def GetUsedIds(self):
+    """Retrieve the user and group IDs in use in the passwd and group files.
+
+    Returns:
+      set, the UIDs and GIDs of the local users and groups.
+    """
+    with self.lock:
+      self._Refresh()
+      used_ids = set(entry.pw_uid for entry in self.users.values())
+      used_ids.update(entry.gr_gid for entry in self.groups.values())
+      return used_ids
@@ -15,17 +15,45 @@
 
 """Utilities for provisioning or deprovisioning a Linux user account."""
 
-import grp
+import json
 import os
-import pwd
 import re
-import shutil
+import stat
 import subprocess
-import tempfile
+import threading
 
 from google_compute_engine import file_utils
+from google_compute_engine.accounts import accounts_index
+from google_compute_engine.accounts import home_dir_deleter
 
 USER_REGEX = re.compile(r'\A[A-Za-z0-9._][A-Za-z0-9._-]*\Z')
+HOME_DIR = '/home'
+STATE_VERSION = 1
+
+
+def _ReadUserFile(path, uid):
+  """Read the lines of a file in the home directory of a user.
+
+  The file is opened without following a symbolic link or blocking on a
+  FIFO. Only a regular file owned by the user is read, so the contents of
+  another file are never copied into the home directory of the user.
+
+  Args:
+    path: string, the path of the file.
+    uid: int, the user ID that must own the file.
+
+  Returns:
+    list, the lines of the file, or None if the file is missing or unsafe.
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+  except (IOError, OSError):
+    return None
+  with os.fdopen(fd) as user_file:
+    file_stat = os.fstat(user_file.fileno())
+    if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_uid != uid:
+      return None
+    return user_file.readlines()
 
 
 class AccountsUtils(object):
@@ -33,25 +61,41 @@ class AccountsUtils(object):
 
   google_comment = '# Added by Google'
 
-  def __init__(self, logger, groups=None, remove=False):
+  def __init__(self, logger, groups=None, remove=False, lazy_home=False):
     """Constructor.
 
     Args:
       logger: logger object, used to write to SysLog and serial port.
       groups: string, a comma separated list of groups.
       remove: bool, True if deprovisioning a user should be destructive.
+      lazy_home: bool, True if home directories are created on first login.
     """
     self.logger = logger
+    self.lazy_home = lazy_home
     self.google_sudoers_group = 'google-sudoers'
     self.google_sudoers_file = '/etc/sudoers.d/google_sudoers'
     self.google_users_dir = '/var/lib/google'
     self.google_users_file = os.path.join(self.google_users_dir, 'google_users')
+    self.google_state_file = os.path.join(
+        self.google_users_dir, 'google_accounts.json')
+    self.index = accounts_index.AccountsIndex()
+    # Serializes the commands modifying the passwd and group databases.
+    self.accounts_lock = threading.Lock()
+    self.stats_lock = threading.Lock()
+    self.stats = {
+        'authorized_keys_rewritten': 0,
+        'authorized_keys_skipped': 0,
+    }
 
     self._CreateSudoersGroup()
     self.groups = groups.split(',') if groups else []
     self.groups.append(self.google_sudoers_group)
-    self.groups = filter(self._GetGroup, self.groups)
+    self.groups = list(filter(self._GetGroup, self.groups))
     self.remove = remove
+    # Home directories of removed users are deleted in the background.
+    self.deleter = home_dir_deleter.HomeDirDeleter(logger)
+    if remove:
+      self.deleter.Recover(os.path.join(HOME_DIR, home_dir_deleter.TRASH_DIR))
 
   def _GetGroup(self, group):
     """Retrieve a Linux group.
@@ -62,10 +106,7 @@ class AccountsUtils(object):
     Returns:
       grp.struct_group, the Linux group or None if it does not exist.
     """
-    try:
-      return grp.getgrnam(group)
-    except KeyError:
-      return None
+    return self.index.GetGroup(group)
 
   def _CreateSudoersGroup(self):
     """Create a Linux group for Google added sudo user accounts."""
@@ -74,6 +115,8 @@ class AccountsUtils(object):
         subprocess.check_call(['groupadd', self.google_sudoers_group])
       except subprocess.CalledProcessError as e:
         self.logger.warning('Could not create the sudoers group. %s.', str(e))
+      finally:
+        self.index.Invalidate()
 
     if not os.path.exists(self.google_sudoers_file):
       with open(self.google_sudoers_file, 'w') as group:
@@ -93,10 +136,7 @@ class AccountsUtils(object):
     Returns:
       pwd.struct_passwd, the Linux user or None if it does not exist.
     """
-    try:
-      return pwd.getpwnam(user)
-    except KeyError:
-      return None
+    return self.index.GetUser(user)
 
   def _AddUser(self, user):
     """Configure a Linux user account.
@@ -120,15 +160,22 @@ class AccountsUtils(object):
     #
     # To solve the issue, make the password '*' which is also recognized
     # as locked but does not prevent SSH login.
-    command = ['useradd', '-m', '-s', '/bin/bash', '-p', '*', user]
+    #
+    # With lazy home directories, the home directory is created on the first
+    # login and the SSH keys are served by the google_authorized_keys command.
+    create_home = '-M' if self.lazy_home else '-m'
+    command = ['useradd', create_home, '-s', '/bin/bash', '-p', '*', user]
     try:
-      subprocess.check_call(command)
+      with self.accounts_lock:
+        subprocess.check_call(command)
     except subprocess.CalledProcessError as e:
       self.logger.warning('Could not create user %s. %s.', user, str(e))
       return False
     else:
       self.logger.info('Created user account %s.', user)
       return True
+    finally:
+      self.index.Invalidate()
 
   def _UpdateUserGroups(self, user, groups):
     """Update group membership for a Linux user.
@@ -140,26 +187,44 @@ class AccountsUtils(object):
     Returns:
       bool, True if user update succeeded.
     """
+    if self.index.GetUserGroups(user) == set(groups):
+      return True
     self.logger.debug('Updating user %s with groups %s.', user, groups)
     command = ['usermod', '-G', ','.join(groups), user]
     try:
-      subprocess.check_call(command)
+      with self.accounts_lock:
+        subprocess.check_call(command)
     except subprocess.CalledProcessError as e:
       self.logger.warning('Could not update user %s. %s.', user, str(e))
       return False
     else:
       self.logger.debug('Updated user account %s.', user)
       return True
+    finally:
+      self.index.Invalidate()
+
+  def _Count(self, name):
+    """Increment a counter of the accounts utilities.
+
+    Args:
+      name: string, the name of the counter.
+    """
+    with self.stats_lock:
+      self.stats[name] += 1
 
   def _UpdateAuthorizedKeys(self, user, ssh_keys):
     """Update the authorized keys file for a Linux user with a list of SSH keys.
 
+    The file is only written when its contents change. The new contents are
+    written to a temporary file in the same directory and renamed in place.
+
     Args:
       user: string, the name of the Linux user account.
       ssh_keys: list, the SSH key strings associated with the user.
 
     Raises:
       IOError, raised when there is an exception updating a file.
+      OSError, raised when there is an exception replacing a file.
     """
     pw_entry = self._GetUser(user)
     if not pw_entry:
@@ -179,40 +244,35 @@ class AccountsUtils(object):
     #  # Added by Google
     #  authorized_key_entry
     authorized_keys_file = os.path.join(ssh_dir, 'authorized_keys')
-    prefix = self.logger.name + '-'
-    with tempfile.NamedTemporaryFile(
-        mode='w', prefix=prefix, delete=True) as updated_keys:
-      updated_keys_file = updated_keys.name
-      if os.path.exists(authorized_keys_file):
-        lines = open(authorized_keys_file).readlines()
+    lines = []
+    current_lines = _ReadUserFile(authorized_keys_file, uid)
+    if current_lines is None and os.path.lexists(authorized_keys_file):
+      self.logger.warning(
+          'Replacing %s. It is not a regular file owned by user %s.',
+          authorized_keys_file, user)
+    google_entry = False
+    for line in current_lines or []:
+      # Keep the user's authorized key entries.
+      if line.startswith(self.google_comment):
+        google_entry = True
+      elif google_entry:
+        google_entry = False
       else:
-        lines = []
-
-      google_lines = set()
-      for i, line in enumerate(lines):
-        if line.startswith(self.google_comment):
-          google_lines.update([i, i+1])
-
-      # Write user's authorized key entries.
-      for i, line in enumerate(lines):
-        if i not in google_lines and line:
-          line += '\n' if not line.endswith('\n') else ''
-          updated_keys.write(line)
-
-      # Write the Google authorized key entries at the end of the file.
-      # Each entry is preceded by '# Added by Google'.
-      for ssh_key in ssh_keys:
-        ssh_key += '\n' if not ssh_key.endswith('\n') else ''
-        updated_keys.write('%s\n' % self.google_comment)
-        updated_keys.write(ssh_key)
-
-      # Write buffered data to the updated keys file without closing it and
-      # update the Linux user's authorized keys file.
-      updated_keys.flush()
-      shutil.copy(updated_keys_file, authorized_keys_file)
-
-    file_utils.SetPermissions(
-        authorized_keys_file, mode=0o600, uid=uid, gid=gid)
+        lines.append(line if line.endswith('\n') else line + '\n')
+
+    # Write the Google authorized key entries at the end of the file.
+    # Each entry is preceded by '# Added by Google'.
+    for ssh_key in ssh_keys:
+      lines.append('%s\n' % self.google_comment)
+      lines.append(ssh_key if ssh_key.endswith('\n') else ssh_key + '\n')
+
+    # The .ssh directory is owned by the user, so the new file only gets its
+    # mode and owner through its file descriptor.
+    if file_utils.WriteFile(
+        authorized_keys_file, ''.join(lines), mode=0o600, uid=uid, gid=gid):
+      self._Count('authorized_keys_rewritten')
+    else:
+      self._Count('authorized_keys_skipped')
 
   def _RemoveAuthorizedKeys(self, user):
     """Remove a Linux user account's authorized keys file to prevent login.
@@ -251,18 +311,132 @@ class AccountsUtils(object):
     Args:
       users: list, the username strings of the Linux accounts.
     """
-    prefix = self.logger.name + '-'
-    with tempfile.NamedTemporaryFile(
-        mode='w', prefix=prefix, delete=True) as updated_users:
-      updated_users_file = updated_users.name
-      for user in users:
-        updated_users.write(user + '\n')
-      updated_users.flush()
-      if not os.path.exists(self.google_users_dir):
-        os.makedirs(self.google_users_dir)
-      shutil.copy(updated_users_file, self.google_users_file)
-
-    file_utils.SetPermissions(self.google_users_file, mode=0o600, uid=0, gid=0)
+    if not os.path.exists(self.google_users_dir):
+      os.makedirs(self.google_users_dir)
+    file_utils.WriteFile(
+        self.google_users_file, ''.join(user + '\n' for user in users),
+        mode=0o600, uid=0, gid=0)
+
+  def GetUserState(self):
+    """Retrieve the state applied to the configured Google user accounts.
+
+    Returns:
+      dict, the state of each user account or empty if there is no valid state.
+    """
+    try:
+      with open(self.google_state_file) as state_file:
+        state = json.load(state_file)
+    except (IOError, OSError):
+      return {}
+    except ValueError as e:
+      self.logger.warning('Could not read the accounts state file. %s.', e)
+      return {}
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+      self.logger.info('Ignoring accounts state with an unknown version.')
+      return {}
+    return state.get('users') or {}
+
+  def SetUserState(self, users):
+    """Atomically write the state applied to the Google user accounts.
+
+    Args:
+      users: dict, the state of each user account with the SSH key fingerprint,
+          the groups, and the time the state was applied.
+    """
+    if not os.path.exists(self.google_users_dir):
+      os.makedirs(self.google_users_dir)
+    state = {'version': STATE_VERSION, 'users': users}
+    file_utils.WriteFile(
+        self.google_state_file, json.dumps(state, sort_keys=True), mode=0o600)
+
+  def CheckUser(self, user, ssh_keys):
+    """Check whether a Linux user still matches the state applied to it.
+
+    Args:
+      user: string, the name of the Linux user account.
+      ssh_keys: list, the SSH key strings associated with the user.
+
+    Returns:
+      bool, True if the user exists with the configured groups and SSH keys.
+    """
+    pw_entry = self._GetUser(user)
+    if not pw_entry:
+      return False
+    for group in self.groups:
+      gr_entry = self._GetGroup(group)
+      if not gr_entry or user not in gr_entry.gr_mem:
+        return False
+    if pw_entry.pw_shell == '/sbin/nologin':
+      return True
+    if self.lazy_home and not os.path.isdir(pw_entry.pw_dir):
+      return True
+
+    authorized_keys_file = os.path.join(
+        pw_entry.pw_dir, '.ssh', 'authorized_keys')
+    lines = _ReadUserFile(authorized_keys_file, pw_entry.pw_uid)
+    if lines is None:
+      return False
+    google_keys = []
+    for i, line in enumerate(lines[:-1]):
+      if line.startswith(self.google_comment):
+        google_keys.append(lines[i + 1].rstrip('\n'))
+    return google_keys == [ssh_key.rstrip('\n') for ssh_key in ssh_keys]
+
+  def UpdateGroups(self, users):
+    """Update the group membership of several Linux users at once.
+
+    Each user becomes a member of exactly the configured groups, as with
+    usermod -G. Instead of one usermod call per user, the member list of each
+    affected group is set with a single gpasswd call.
+
+    Args:
+      users: list, the names of the Linux user accounts.
+
+    Returns:
+      bool, True if the group membership of every user updated successfully.
+    """
+    groups = set(self.groups)
+    changed_users = set()
+    changed_groups = set()
+    for user in users:
+      if not self._GetUser(user):
+        continue
+      user_groups = self.index.GetUserGroups(user)
+      if user_groups != groups:
+        changed_users.add(user)
+        changed_groups.update(user_groups ^ groups)
+    if not changed_users:
+      return True
+
+    self.logger.debug(
+        'Updating groups %s for %s users.', sorted(changed_groups),
+        len(changed_users))
+    success = True
+    with self.accounts_lock:
+      for group in sorted(changed_groups):
+        # Only the members in the group file are replaced by gpasswd.
+        gr_entry = self.index.GetGroup(group)
+        if not gr_entry:
+          continue
+        members = set(gr_entry.gr_mem) - changed_users
+        if group in groups:
+          members.update(changed_users)
+        command = ['gpasswd', '-M', ','.join(sorted(members)), group]
+        try:
+          subprocess.check_call(command)
+        except subprocess.CalledProcessError as e:
+          self.logger.warning('Could not update group %s. %s.', group, str(e))
+          success = False
+      self.index.Invalidate()
+    return success
+
+  def Flush(self):
+    """Write pending changes to the accounts databases.
+
+    The commands used to provision user accounts apply every change
+    immediately, so there is nothing to write.
+    """
+    pass
 
   def UpdateUser(self, user, ssh_keys):
     """Update a Linux user with authorized SSH keys.
@@ -291,28 +465,54 @@ class AccountsUtils(object):
       self.logger.debug(message, user)
       return True
 
+    # Users who never logged in have no home directory to write the keys to.
+    if self.lazy_home and pw_entry and not os.path.isdir(pw_entry.pw_dir):
+      return True
+
     try:
       self._UpdateAuthorizedKeys(user, ssh_keys)
-    except IOError as e:
+    except (IOError, OSError) as e:
       message = 'Could not update the authorized keys file for user %s. %s.'
       self.logger.warning(message, user, str(e))
       return False
     else:
       return True
 
+  def _TrashHomeDir(self, user, pw_entry):
+    """Move the home directory of a removed user for background deletion.
+
+    Args:
+      user: string, the name of the removed Linux user account.
+      pw_entry: pwd.struct_passwd, the removed Linux user account.
+    """
+    try:
+      self.deleter.Trash(pw_entry.pw_dir, pw_entry.pw_uid)
+    except (IOError, OSError) as e:
+      self.logger.warning(
+          'Could not remove home directory of user %s. %s.', user, str(e))
+
   def RemoveUser(self, user):
     """Remove a Linux user account.
 
+    With deprovision_remove set, the home directory is moved to a trash
+    directory once the user is deleted, and deleted in the background.
+
     Args:
       user: string, the Linux user account to remove.
     """
     self.logger.info('Removing user %s.', user)
     if self.remove:
-      command = ['userdel', '-r', user]
+      pw_entry = self._GetUser(user)
+      command = ['userdel', user]
       try:
-        subprocess.check_call(command)
+        with self.accounts_lock:
+          subprocess.check_call(command)
       except subprocess.CalledProcessError as e:
         self.logger.warning('Could not remove user %s. %s.', user, str(e))
       else:
         self.logger.info('Removed user account %s.', user)
+        if pw_entry:
+          self._TrashHomeDir(user, pw_entry)
+      finally:
+        self.index.Invalidate()
     self._RemoveAuthorizedKeys(user)
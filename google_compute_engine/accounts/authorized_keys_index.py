@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve the SSH keys of Google user accounts to sshd.
+
+The accounts daemon writes the SSH keys of every Google user account to an
+index file. sshd runs the google_authorized_keys command, configured as:
+
+  AuthorizedKeysCommand /usr/bin/google_authorized_keys %u
+  AuthorizedKeysCommandUser nobody
+
+The index is world readable, so the command needs no privileges and should
+run as a dedicated unprivileged user, never as root.
+
+The command memory maps the index and prints the unexpired keys of one user.
+The index is a hash table of users with the following layout, using little
+endian integers:
+
+  header:  magic (4 bytes), version (uint32), bucket count (uint32).
+  buckets: offset (uint32) and length (uint32) of the records of each bucket.
+  records: name length (uint16), keys length (uint32), name, keys.
+
+A user is stored in the bucket given by the CRC32 of the user name. The keys
+are lines with the expiration time in seconds since the epoch, or 0 for keys
+that do not expire, and the key separated by a space.
+
+sshd runs the command before a key is verified, so it never changes the
+system. Home directories of user accounts created without one are made at the
+session stage of PAM, after authentication, by the pam_mkhomedir module.
+"""
+
+import mmap
+import optparse
+import os
+import struct
+import sys
+import time
+import zlib
+
+from google_compute_engine import file_utils
+
+INDEX_FILE = '/var/lib/google/google_authorized_keys.idx'
+INDEX_MAGIC = b'GAKI'
+INDEX_VERSION = 1
+HEADER = struct.Struct('<4sII')
+BUCKET = struct.Struct('<II')
+RECORD = struct.Struct('<HI')
+
+
+def _GetBucket(name, buckets):
+  """Get the bucket of a user name.
+
+  Args:
+    name: bytes, the encoded user name.
+    buckets: int, the number of buckets in the index.
+
+  Returns:
+    int, the bucket number.
+  """
+  return (zlib.crc32(name) & 0xffffffff) % buckets
+
+
+class AuthorizedKeysIndex(object):
+  """Write and look up the SSH keys of Google user accounts."""
+
+  def __init__(self, index_file=INDEX_FILE):
+    """Constructor.
+
+    Args:
+      index_file: string, the path of the index file.
+    """
+    self.index_file = index_file
+
+  def Write(self, users):
+    """Atomically replace the index with the SSH keys of the user accounts.
+
+    Args:
+      users: dict, user names mapped to a list of tuples with an SSH key and
+          its expiration time in seconds since the epoch or None.
+    """
+    buckets = max(len(users), 1)
+    bucket_records = [[] for _ in range(buckets)]
+    for user, ssh_keys in sorted(users.items()):
+      name = user.encode('utf-8')
+      lines = []
+      for ssh_key, expiration in ssh_keys:
+        lines.append('{0} {1}\n'.format(int(expiration or 0), ssh_key.strip()))
+      data = ''.join(lines).encode('utf-8')
+      record = RECORD.pack(len(name), len(data)) + name + data
+      bucket_records[_GetBucket(name, buckets)].append(record)
+
+    table = []
+    records = []
+    offset = HEADER.size + BUCKET.size * buckets
+    for bucket in bucket_records:
+      length = sum(len(record) for record in bucket)
+      table.append(BUCKET.pack(offset, length))
+      records.extend(bucket)
+      offset += length
+    contents = b''.join(
+        [HEADER.pack(INDEX_MAGIC, INDEX_VERSION, buckets)] + table + records)
+
+    index_dir = os.path.dirname(self.index_file)
+    if not os.path.exists(index_dir):
+      os.makedirs(index_dir)
+    # The command may run as an unprivileged AuthorizedKeysCommandUser.
+    file_utils.WriteFile(self.index_file, contents, mode=0o644)
+
+  def _ReadKeys(self, index, name):
+    """Find the SSH key lines of a user in a mapped index.
+
+    Args:
+      index: mmap.mmap, the mapped index file.
+      name: bytes, the encoded user name.
+
+    Returns:
+      bytes, the SSH key lines of the user or None if the user is not found.
+    """
+    magic, version, buckets = HEADER.unpack_from(index, 0)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or not buckets:
+      return None
+    bucket_offset = HEADER.size + BUCKET.size * _GetBucket(name, buckets)
+    offset, length = BUCKET.unpack_from(index, bucket_offset)
+    end = offset + length
+    while offset < end:
+      name_length, data_length = RECORD.unpack_from(index, offset)
+      offset += RECORD.size
+      data_offset = offset + name_length
+      if index[offset:data_offset] == name:
+        return index[data_offset:data_offset + data_length]
+      offset = data_offset + data_length
+    return None
+
+  def GetKeys(self, user, now=None):
+    """Look up the unexpired SSH keys of a user account.
+
+    Args:
+      user: string, the name of the Linux user account.
+      now: float, the current time in seconds since the epoch.
+
+    Returns:
+      list, the SSH key strings of the user.
+    """
+    try:
+      fd = os.open(self.index_file, os.O_RDONLY)
+    except OSError:
+      return []
+    try:
+      if os.fstat(fd).st_size < HEADER.size:
+        return []
+      index = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+      os.close(fd)
+    try:
+      data = self._ReadKeys(index, user.encode('utf-8'))
+    except struct.error:
+      data = None
+    finally:
+      index.close()
+    if not data:
+      return []
+
+    now = time.time() if now is None else now
+    ssh_keys = []
+    for line in data.decode('utf-8').splitlines():
+      expiration, ssh_key = line.split(' ', 1)
+      if int(expiration) and int(expiration) <= now:
+        continue
+      ssh_keys.append(ssh_key)
+    return ssh_keys
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog USER')
+  (_, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error('Expected a single user name.')
+  for ssh_key in AuthorizedKeysIndex().GetKeys(args[0]):
+    sys.stdout.write(ssh_key + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Delete the home directories of removed user accounts in the background.
+
+A removed home directory is renamed into a trash directory next to it, on the
+same file system, which is a single atomic operation. A daemon thread deletes
+the trash at idle I/O priority, so a large home directory does not delay the
+updates of other user accounts. Trash left behind by a previous run is
+deleted when the deleter starts.
+"""
+
+import collections
+import errno
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+TRASH_DIR = '.google-trash'
+
+
+class HomeDirDeleter(object):
+  """Move home directories to a trash directory and delete them later."""
+
+  def __init__(self, logger):
+    """Constructor.
+
+    Args:
+      logger: logger object, used to write to SysLog and serial port.
+    """
+    self.logger = logger
+    # The trashed paths with their size in bytes, or None until measured.
+    self.queue = collections.deque()
+    self.condition = threading.Condition()
+    self.thread = None
+    self.stats = {
+        'deleted_bytes': 0,
+        'deleted_dirs': 0,
+        'deletion_seconds': 0.0,
+        'pending_bytes': 0,
+        'pending_dirs': 0,
+    }
+
+  def _GetTrashDir(self, home_dir):
+    """Get the trash directory on the file system of a home directory.
+
+    Args:
+      home_dir: string, the path of the home directory.
+
+    Returns:
+      string, the path of the trash directory.
+    """
+    return os.path.join(os.path.dirname(home_dir.rstrip('/')), TRASH_DIR)
+
+  def _Queue(self, path):
+    """Queue a trashed path for deletion and start the deletion thread.
+
+    Args:
+      path: string, the path in the trash directory.
+    """
+    with self.condition:
+      self.queue.append([path, None])
+      self.stats['pending_dirs'] += 1
+      if not self.thread:
+        self.thread = threading.Thread(target=self._Run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+
+  def Trash(self, home_dir, uid):
+    """Move a home directory into the trash and queue it for deletion.
+
+    Args:
+      home_dir: string, the path of the home directory.
+      uid: int, the user ID that must own the home directory.
+
+    Returns:
+      bool, True if the home directory was moved into the trash.
+
+    Raises:
+      OSError, raised when the home directory cannot be moved.
+    """
+    try:
+      home_stat = os.lstat(home_dir)
+    except OSError:
+      return False
+    if not stat.S_ISDIR(home_stat.st_mode) or home_stat.st_uid != uid:
+      self.logger.warning(
+          'Not removing %s. It is not a directory owned by the user.',
+          home_dir)
+      return False
+    trash_dir = self._GetTrashDir(home_dir)
+    try:
+      os.mkdir(trash_dir, 0o700)
+    except OSError as e:
+      # Several users may be removed at the same time.
+      if e.errno != errno.EEXIST:
+        raise
+    prefix = os.path.basename(home_dir.rstrip('/')) + '-'
+    trash_path = tempfile.mkdtemp(prefix=prefix, dir=trash_dir)
+    try:
+      os.rename(home_dir, os.path.join(trash_path, 'home'))
+    except OSError:
+      os.rmdir(trash_path)
+      raise
+    self._Queue(trash_path)
+    return True
+
+  def Recover(self, trash_dir):
+    """Queue the trash left behind by a previous run for deletion.
+
+    Args:
+      trash_dir: string, the path of a trash directory.
+    """
+    try:
+      names = sorted(os.listdir(trash_dir))
+    except OSError:
+      return
+    for name in names:
+      self._Queue(os.path.join(trash_dir, name))
+
+  def _GetSize(self, path):
+    """Add up the size of the files under a path without following links.
+
+    Args:
+      path: string, the path to measure.
+
+    Returns:
+      int, the size in bytes.
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+      for name in dirs + files:
+        try:
+          size += os.lstat(os.path.join(root, name)).st_size
+        except OSError:
+          pass
+    return size
+
+  def _Delete(self, path):
+    """Delete a path at idle I/O and lowest CPU priority.
+
+    Args:
+      path: string, the path to delete.
+    """
+    command = [
+        'ionice', '-c', '3', 'nice', '-n', '19',
+        'rm', '-rf', '--one-file-system', path,
+    ]
+    try:
+      subprocess.check_call(command)
+    except OSError:
+      # ionice is not installed.
+      shutil.rmtree(path)
+
+  def _MeasurePending(self):
+    """Measure the size of the queued paths that were not yet measured."""
+    with self.condition:
+      entries = [entry for entry in self.queue if entry[1] is None]
+    for entry in entries:
+      size = self._GetSize(entry[0])
+      with self.condition:
+        entry[1] = size
+        self.stats['pending_bytes'] += size
+
+  def _DeleteNext(self):
+    """Delete the oldest queued path."""
+    self._MeasurePending()
+    with self.condition:
+      path, size = self.queue[0]
+    try:
+      start_time = time.time()
+      self._Delete(path)
+      elapsed = time.time() - start_time
+    except (OSError, subprocess.CalledProcessError) as e:
+      self.logger.warning('Could not delete %s. %s.', path, str(e))
+      elapsed = None
+    with self.condition:
+      self.queue.popleft()
+      self.stats['pending_dirs'] -= 1
+      self.stats['pending_bytes'] -= size
+      if elapsed is not None:
+        self.stats['deleted_dirs'] += 1
+        self.stats['deleted_bytes'] += size
+        self.stats['deletion_seconds'] += elapsed
+      pending_bytes = self.stats['pending_bytes']
+    if elapsed is not None:
+      self.logger.info(
+          'Deleted %s (%s bytes) in %.1f seconds. %s bytes pending.',
+          path, size, elapsed, pending_bytes)
+
+  def _Run(self):
+    """Delete the queued paths, one at a time."""
+    while True:
+      with self.condition:
+        while not self.queue:
+          self.condition.wait()
+      self._DeleteNext()
+
+  def GetStats(self):
+    """Get the deletion counters.
+
+    Returns:
+      dict, the pending and deleted directories and bytes, and the time spent
+          deleting in seconds.
+    """
+    with self.condition:
+      return dict(self.stats)
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Provision Google user accounts through NSS cache files.
+
+Instead of running useradd and usermod for every user account, the Google
+user accounts and their group memberships are kept in memory and written in
+bulk to passwd and group cache files, in the format read by the libnss-cache
+module. The cache module is enabled in /etc/nsswitch.conf, for example:
+
+  passwd: files cache
+  group: files cache
+"""
+
+import grp
+import json
+import os
+import pwd
+import re
+
+from google_compute_engine import file_utils
+from google_compute_engine.accounts import accounts_utils
+
+CACHE_DIR = '/etc'
+HOME_DIR = accounts_utils.HOME_DIR
+# The user names accepted by shadow-utils useradd, which this backend replaces.
+USER_REGEX = re.compile(r'\A[A-Za-z_][A-Za-z0-9._-]*\$?\Z')
+USER_NAME_MAX = 32
+UID_MIN = 5000
+UID_MAX = 59999
+
+
+class NssCacheUtils(accounts_utils.AccountsUtils):
+  """User account configuration utilities writing NSS cache files."""
+
+  def __init__(
+      self, logger, groups=None, remove=False, lazy_home=False,
+      cache_dir=CACHE_DIR):
+    """Constructor.
+
+    Args:
+      logger: logger object, used to write to SysLog and serial port.
+      groups: string, a comma separated list of groups.
+      remove: bool, True if deprovisioning a user should be destructive.
+      lazy_home: bool, True if home directories are created on first login.
+      cache_dir: string, the directory of the passwd and group cache files.
+    """
+    self.passwd_cache_file = os.path.join(cache_dir, 'passwd.cache')
+    self.group_cache_file = os.path.join(cache_dir, 'group.cache')
+    self.cache_users = {}
+    self.cache_members = {}
+    self.uids = {}
+    self.dirty = False
+    super(NssCacheUtils, self).__init__(
+        logger=logger, groups=groups, remove=remove, lazy_home=lazy_home)
+    self.google_uids_file = os.path.join(
+        self.google_users_dir, 'google_uids.json')
+    self._LoadCache()
+
+  def _LoadCache(self):
+    """Read the Google user accounts and UID allocations from disk."""
+    try:
+      with open(self.google_uids_file) as uids_file:
+        self.uids = json.load(uids_file)
+    except (IOError, OSError, ValueError):
+      self.uids = {}
+    for entry in self._ReadCacheFile(self.passwd_cache_file, 7):
+      try:
+        entry[2:4] = [int(entry[2]), int(entry[3])]
+      except ValueError:
+        continue
+      if not self._IsValidUser(entry[0]):
+        continue
+      self.cache_users[entry[0]] = pwd.struct_passwd(entry)
+      self.uids.setdefault(entry[0], entry[2])
+    for entry in self._ReadCacheFile(self.group_cache_file, 4):
+      members = [member for member in entry[3].split(',') if member]
+      if entry[0] not in self.cache_users:
+        self.cache_members[entry[0]] = set(members)
+
+  def _ReadCacheFile(self, path, fields):
+    """Read the entries of a colon separated cache file.
+
+    Args:
+      path: string, the path of the cache file.
+      fields: int, the number of fields of a valid entry.
+
+    Returns:
+      list, the fields of each valid entry.
+    """
+    try:
+      with open(path) as cache_file:
+        lines = cache_file.read().splitlines()
+    except (IOError, OSError):
+      return []
+    entries = [line.split(':') for line in lines if line]
+    return [entry for entry in entries if len(entry) == fields]
+
+  def _WriteCacheFile(self, path, lines, mode):
+    """Atomically replace a cache file.
+
+    Args:
+      path: string, the path of the cache file.
+      lines: list, the lines of the file.
+      mode: int, the permissions of the file.
+    """
+    file_utils.WriteFile(path, ''.join(line + '\n' for line in lines), mode=mode)
+
+  def _IsValidUser(self, user):
+    """Check whether a name is valid for a Google user account.
+
+    Args:
+      user: string, the name of the Linux user account.
+
+    Returns:
+      bool, True if the name is valid and its home directory is in /home.
+    """
+    if len(user) > USER_NAME_MAX or not USER_REGEX.match(user):
+      return False
+    return self._GetHomeDir(user) is not None
+
+  def _GetHomeDir(self, user):
+    """Get the home directory of a Google user account.
+
+    Args:
+      user: string, the name of the Linux user account.
+
+    Returns:
+      string, the home directory path or None if the path resolves to
+          anything but a direct child of /home.
+    """
+    home_dir = os.path.normpath(os.path.join(HOME_DIR, user))
+    if os.path.dirname(home_dir) != HOME_DIR:
+      return None
+    if os.path.basename(home_dir) != user:
+      return None
+    return home_dir
+
+  def _AllocateUid(self, user):
+    """Get the persistent UID of a Google user account.
+
+    Args:
+      user: string, the name of the Linux user account.
+
+    Returns:
+      int, the UID of the user or None if no UID is available.
+    """
+    if user in self.uids:
+      return self.uids[user]
+    used_uids = self.index.GetUsedIds()
+    used_uids.update(self.uids.values())
+    uid = max([UID_MIN - 1] + [u for u in used_uids if u <= UID_MAX]) + 1
+    while uid in used_uids:
+      uid += 1
+    if uid > UID_MAX:
+      return None
+    self.uids[user] = uid
+    return uid
+
+  def _GetUser(self, user):
+    """Retrieve a Linux user account.
+
+    Args:
+      user: string, the name of the Linux user account to retrieve.
+
+    Returns:
+      pwd.struct_passwd, the Linux user or None if it does not exist.
+    """
+    with self.accounts_lock:
+      pw_entry = self.cache_users.get(user)
+    return pw_entry or self.index.GetUser(user)
+
+  def _GetGroup(self, group):
+    """Retrieve a Linux group including the Google user accounts in the cache.
+
+    Args:
+      group: string, the name of the Linux group to retrieve.
+
+    Returns:
+      grp.struct_group, the Linux group or None if it does not exist.
+    """
+    gr_entry = self.index.GetGroup(group)
+    if not gr_entry:
+      return None
+    with self.accounts_lock:
+      members = sorted(self.cache_members.get(group, ()))
+    if not members:
+      return gr_entry
+    members = list(gr_entry.gr_mem) + members
+    return grp.struct_group(
+        (gr_entry.gr_name, gr_entry.gr_passwd, gr_entry.gr_gid, members))
+
+  def _AddUser(self, user):
+    """Add a Linux user account to the passwd cache.
+
+    Args:
+      user: string, the name of the Linux user account to create.
+
+    Returns:
+      bool, True if user creation succeeded.
+    """
+    self.logger.info('Creating a new user account for %s.', user)
+    if not self._IsValidUser(user):
+      self.logger.warning('Could not create user %s. Invalid name.', user)
+      return False
+    with self.accounts_lock:
+      uid = self._AllocateUid(user)
+      if uid is None:
+        self.logger.warning('Could not create user %s. No UID available.', user)
+        return False
+      home_dir = self._GetHomeDir(user)
+      self.cache_users[user] = pwd.struct_passwd(
+          (user, 'x', uid, uid, '', home_dir, '/bin/bash'))
+      self.dirty = True
+    self.logger.info('Created user account %s.', user)
+    return True
+
+  def _UpdateUserGroups(self, user, groups):
+    """Update group membership for a Google user account in the group cache.
+
+    Args:
+      user: string, the name of the Linux user account.
+      groups: list, the group names to add the user as a member.
+
+    Returns:
+      bool, True if user update succeeded.
+    """
+    if user not in self.cache_users:
+      return super(NssCacheUtils, self)._UpdateUserGroups(user, groups)
+    with self.accounts_lock:
+      for group, members in self.cache_members.items():
+        if group not in groups and user in members:
+          members.discard(user)
+          self.dirty = True
+      for group in groups:
+        members = self.cache_members.setdefault(group, set())
+        if user not in members:
+          members.add(user)
+          self.dirty = True
+    return True
+
+  def UpdateGroups(self, users):
+    """Update the group membership of several Linux users at once.
+
+    Args:
+      users: list, the names of the Linux user accounts.
+
+    Returns:
+      bool, True if the group membership of every user updated successfully.
+    """
+    local_users = [user for user in users if user not in self.cache_users]
+    success = True
+    for user in users:
+      if user in self.cache_users:
+        success = self._UpdateUserGroups(user, self.groups) and success
+    return super(NssCacheUtils, self).UpdateGroups(local_users) and success
+
+  def RemoveUser(self, user):
+    """Remove a Linux user account from the passwd and group caches.
+
+    Args:
+      user: string, the Linux user account to remove.
+    """
+    if user not in self.cache_users:
+      super(NssCacheUtils, self).RemoveUser(user)
+      return
+    self.logger.info('Removing user %s.', user)
+    self._RemoveAuthorizedKeys(user)
+    with self.accounts_lock:
+      pw_entry = self.cache_users.pop(user)
+      for members in self.cache_members.values():
+        members.discard(user)
+      self.dirty = True
+    if self.remove:
+      self._TrashHomeDir(user, pw_entry)
+      self.logger.info('Removed user account %s.', user)
+
+  def _TrashHomeDir(self, user, pw_entry):
+    """Move the home directory of a removed user for background deletion.
+
+    Args:
+      user: string, the name of the removed Linux user account.
+      pw_entry: pwd.struct_passwd, the user account in the passwd cache.
+    """
+    if pw_entry.pw_dir != self._GetHomeDir(user):
+      self.logger.warning(
+          'Not removing home directory %s of user %s.', pw_entry.pw_dir, user)
+      return
+    super(NssCacheUtils, self)._TrashHomeDir(user, pw_entry)
+
+  def Flush(self):
+    """Write the passwd and group caches if the Google accounts changed.
+
+    Raises:
+      IOError, raised when there is an exception writing a file.
+      OSError, raised when there is an exception replacing a file.
+    """
+    with self.accounts_lock:
+      if not self.dirty:
+        return
+      passwd_lines = []
+      group_lines = []
+      for user, pw_entry in sorted(self.cache_users.items()):
+        passwd_lines.append(':'.join(str(field) for field in pw_entry))
+        # Each user has a primary group with the same name and ID.
+        group_lines.append('{0}:x:{1}:'.format(user, pw_entry.pw_gid))
+      for group, members in sorted(self.cache_members.items()):
+        gr_entry = self.index.GetGroup(group)
+        if gr_entry and members:
+          group_lines.append('{0}:x:{1}:{2}'.format(
+              group, gr_entry.gr_gid, ','.join(sorted(members))))
+      group_lines.sort()
+      self._WriteCacheFile(self.passwd_cache_file, passwd_lines, 0o644)
+      self._WriteCacheFile(self.group_cache_file, group_lines, 0o644)
+      if not os.path.exists(self.google_users_dir):
+        os.makedirs(self.google_users_dir)
+      self._WriteCacheFile(
+          self.google_uids_file, [json.dumps(self.uids, sort_keys=True)],
+          0o600)
+      self.dirty = False
+    self.logger.info(
+        'Wrote %s user accounts to the NSS cache.', len(passwd_lines))
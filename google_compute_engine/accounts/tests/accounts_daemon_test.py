@@ -16,6 +16,8 @@
 """Unittest for accounts_daemon.py module."""
 
 import datetime
+import heapq
+import threading
 
 from google_compute_engine.accounts import accounts_daemon
 from google_compute_engine.test_compat import mock
@@ -28,18 +30,37 @@ class AccountsDaemonTest(unittest.TestCase):
     self.mock_logger = mock.Mock()
     self.mock_watcher = mock.Mock()
     self.mock_utils = mock.Mock()
+    self.mock_utils.stats = {
+        'authorized_keys_rewritten': 0,
+        'authorized_keys_skipped': 0,
+    }
 
     self.mock_setup = mock.create_autospec(accounts_daemon.AccountsDaemon)
     self.mock_setup.logger = self.mock_logger
     self.mock_setup.watcher = self.mock_watcher
     self.mock_setup.utils = self.mock_utils
-
+    self.mock_setup.force = False
+    self.mock_setup.user_state = {}
+    self.mock_setup.unverified_users = set()
+    self.mock_setup.parse_cache = {}
+    self.mock_setup.expirations = {}
+    self.mock_setup.accounts = {}
+    self.mock_setup.expiry_heap = []
+    self.mock_setup.pending_result = None
+    self.mock_setup.reconcile_condition = threading.Condition()
+    self.mock_setup.reconcile_stopped = threading.Event()
+    self.mock_setup._IsPreempted.return_value = False
+    self.mock_setup._UpdateUsers.return_value = True
+    self.mock_setup._Map.side_effect = (
+        lambda function, items: [function(item) for item in items])
+
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.threading')
   @mock.patch('google_compute_engine.accounts.accounts_daemon.accounts_utils')
   @mock.patch('google_compute_engine.accounts.accounts_daemon.metadata_watcher')
   @mock.patch('google_compute_engine.accounts.accounts_daemon.logger')
   @mock.patch('google_compute_engine.accounts.accounts_daemon.file_utils')
   def testAccountsDaemon(self, mock_lock, mock_logger, mock_watcher,
-                         mock_utils):
+                         mock_utils, mock_threading):
     mock_logger_instance = mock.Mock()
     mock_logger.Logger.return_value = mock_logger_instance
     mocks = mock.Mock()
@@ -47,19 +68,32 @@ class AccountsDaemonTest(unittest.TestCase):
     mocks.attach_mock(mock_logger, 'logger')
     mocks.attach_mock(mock_watcher, 'watcher')
     mocks.attach_mock(mock_utils, 'utils')
+    mocks.attach_mock(mock_threading, 'threading')
+    mock_utils.AccountsUtils.return_value.GetUserState.return_value = {}
     with mock.patch.object(
-        accounts_daemon.AccountsDaemon, 'HandleAccounts') as mock_handle:
+        accounts_daemon.AccountsDaemon, '_QueueAccounts') as mock_handle:
       accounts_daemon.AccountsDaemon(groups='foo,bar', remove=True, debug=True)
       expected_calls = [
           mock.call.logger.Logger(name=mock.ANY, debug=True, facility=mock.ANY),
           mock.call.watcher.MetadataWatcher(logger=mock_logger_instance),
           mock.call.utils.AccountsUtils(
-              logger=mock_logger_instance, groups='foo,bar', remove=True),
+              logger=mock_logger_instance, groups='foo,bar', remove=True,
+              lazy_home=False),
+          mock.call.threading.Condition(),
+          mock.call.threading.Event(),
+          mock.call.utils.AccountsUtils().GetUserState(),
           mock.call.lock.LockFile(accounts_daemon.LOCKFILE),
           mock.call.lock.LockFile().__enter__(),
           mock.call.logger.Logger().info(mock.ANY),
+          mock.call.threading.Thread(target=mock.ANY),
+          mock.call.threading.Thread().start(),
           mock.call.watcher.MetadataWatcher().WatchMetadata(
-              mock_handle, recursive=True),
+              mock_handle, recursive=True,
+              selector=accounts_daemon.AccountsDaemon.accounts_metadata),
+          mock.call.threading.Condition().__enter__(),
+          mock.call.threading.Event().set(),
+          mock.call.threading.Condition().notify(),
+          mock.call.threading.Condition().__exit__(None, None, None),
           mock.call.lock.LockFile().__exit__(None, None, None),
       ]
       self.assertEqual(mocks.mock_calls, expected_calls)
@@ -77,6 +111,7 @@ class AccountsDaemonTest(unittest.TestCase):
     mocks.attach_mock(mock_logger, 'logger')
     mocks.attach_mock(mock_watcher, 'watcher')
     mocks.attach_mock(mock_utils, 'utils')
+    mock_utils.AccountsUtils.return_value.GetUserState.return_value = {}
     mock_lock.LockFile.side_effect = IOError('Test Error')
     with mock.patch.object(accounts_daemon.AccountsDaemon, 'HandleAccounts'):
       accounts_daemon.AccountsDaemon()
@@ -85,12 +120,49 @@ class AccountsDaemonTest(unittest.TestCase):
               name=mock.ANY, debug=False, facility=mock.ANY),
           mock.call.watcher.MetadataWatcher(logger=mock_logger_instance),
           mock.call.utils.AccountsUtils(
-              logger=mock_logger_instance, groups=None, remove=False),
+              logger=mock_logger_instance, groups=None, remove=False,
+              lazy_home=False),
+          mock.call.utils.AccountsUtils().GetUserState(),
           mock.call.lock.LockFile(accounts_daemon.LOCKFILE),
           mock.call.logger.Logger().warning('Test Error'),
       ]
       self.assertEqual(mocks.mock_calls, expected_calls)
 
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.threading')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.accounts_utils')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.metadata_watcher')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.logger')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.file_utils')
+  def testAccountsDaemonWorkers(
+      self, _, mock_logger, mock_watcher, mock_utils, mock_threading):
+    mock_utils.AccountsUtils.return_value.GetUserState.return_value = {}
+    with mock.patch.object(accounts_daemon.AccountsDaemon, 'HandleAccounts'):
+      self.assertEqual(accounts_daemon.AccountsDaemon(workers='8').workers, 8)
+      self.assertEqual(accounts_daemon.AccountsDaemon(workers='0').workers, 1)
+      self.assertEqual(
+          accounts_daemon.AccountsDaemon(workers='invalid').workers, 1)
+      self.assertEqual(accounts_daemon.AccountsDaemon(workers=None).workers, 1)
+    mock_logger.Logger().warning.assert_any_call(mock.ANY, 'invalid')
+
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.threading')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.nss_cache_utils')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.accounts_utils')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.metadata_watcher')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.logger')
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.file_utils')
+  def testAccountsDaemonNssCache(
+      self, _, mock_logger, mock_watcher, mock_utils, mock_nss_cache_utils,
+      mock_threading):
+    mock_utils_instance = mock_nss_cache_utils.NssCacheUtils.return_value
+    mock_utils_instance.GetUserState.return_value = {}
+    with mock.patch.object(accounts_daemon.AccountsDaemon, 'HandleAccounts'):
+      daemon = accounts_daemon.AccountsDaemon(groups='foo', nss_cache=True)
+    self.assertEqual(daemon.utils, mock_utils_instance)
+    mock_nss_cache_utils.NssCacheUtils.assert_called_once_with(
+        logger=mock_logger.Logger(), groups='foo', remove=False,
+        lazy_home=False)
+    mock_utils.AccountsUtils.assert_not_called()
+
   def testHasExpired(self):
 
     def _GetTimestamp(days):
@@ -121,11 +193,54 @@ class AccountsDaemonTest(unittest.TestCase):
         'user:xyz key google-ssh {"expireOn":"%s"}' % _GetTimestamp(-1): True,
     }
 
+    self.mock_setup._GetExpiration.side_effect = (
+        lambda key: accounts_daemon.AccountsDaemon._ParseExpiration(
+            self.mock_setup, key))
     for key, expired in ssh_keys.items():
       self.assertEqual(
           accounts_daemon.AccountsDaemon._HasExpired(self.mock_setup, key),
           expired)
 
+  def testParseExpiration(self):
+    key = 'user:ssh-rsa key google-ssh {"expireOn":"2016-01-02T03:04:05+0000"}'
+    self.assertEqual(
+        accounts_daemon.AccountsDaemon._ParseExpiration(self.mock_setup, key),
+        1451703845)
+    self.assertEqual(
+        accounts_daemon.AccountsDaemon._ParseExpiration(
+            self.mock_setup, 'ssh-rsa key user@domain.com'),
+        None)
+
+  def testGetExpiration(self):
+    self.mock_setup._ParseExpiration.side_effect = [100, None]
+    get_expiration = accounts_daemon.AccountsDaemon._GetExpiration
+
+    self.assertEqual(get_expiration(self.mock_setup, 'a'), 100)
+    self.assertEqual(get_expiration(self.mock_setup, 'a'), 100)
+    self.assertEqual(get_expiration(self.mock_setup, 'b'), None)
+    self.assertEqual(get_expiration(self.mock_setup, 'b'), None)
+    self.assertEqual(self.mock_setup._ParseExpiration.call_count, 2)
+    self.assertEqual(self.mock_setup.expirations, {'a': 100, 'b': None})
+
+  def testUpdateKeysIndex(self):
+    users = {'a': ['1', '2'], 'b': ['3'], 'invalid': ['4'], '': ['5']}
+    self.mock_setup.invalid_users = set(['invalid'])
+    self.mock_setup.keys_index = mock.Mock()
+    self.mock_setup._GetExpiration.side_effect = (
+        lambda key: 100 if key == '2' else None)
+
+    accounts_daemon.AccountsDaemon._UpdateKeysIndex(self.mock_setup, users)
+    self.mock_setup.keys_index.Write.assert_called_once_with(
+        {'a': [('1', None), ('2', 100)], 'b': [('3', None)]})
+
+  def testUpdateKeysIndexError(self):
+    self.mock_setup.invalid_users = set()
+    self.mock_setup.keys_index = mock.Mock()
+    self.mock_setup.keys_index.Write.side_effect = OSError('Test Error')
+
+    accounts_daemon.AccountsDaemon._UpdateKeysIndex(self.mock_setup, {})
+    self.mock_logger.warning.assert_called_once_with(mock.ANY, 'Test Error')
+
   def testParseAccountsData(self):
     user_map = {
         'a': ['1', '2'],
@@ -137,6 +252,9 @@ class AccountsDaemonTest(unittest.TestCase):
         accounts_data += '%s:%s\n' % (user, key)
     # Make the _HasExpired function treat odd numbers as expired SSH keys.
     self.mock_setup._HasExpired.side_effect = lambda key: int(key) % 2 == 0
+    self.mock_setup._ParseEntries.side_effect = (
+        lambda data: accounts_daemon.AccountsDaemon._ParseEntries(
+            self.mock_setup, data))
 
     self.assertEqual(
         accounts_daemon.AccountsDaemon._ParseAccountsData(
@@ -147,6 +265,27 @@ class AccountsDaemonTest(unittest.TestCase):
     expected_users = {'a': ['1'], 'b': ['3', '5']}
     self.assertEqual(accounts_daemon.AccountsDaemon._ParseAccountsData(
         self.mock_setup, accounts_data), expected_users)
+    self.mock_logger.info.assert_called_once_with(mock.ANY, ['skip'])
+    self.assertEqual(self.mock_setup.parse_cache, {})
+
+  def testParseAccountsDataCache(self):
+    self.mock_setup._HasExpired.side_effect = lambda key: key == 'expired'
+    self.mock_setup._ParseEntries.side_effect = (
+        lambda data: accounts_daemon.AccountsDaemon._ParseEntries(
+            self.mock_setup, data))
+    parse = accounts_daemon.AccountsDaemon._ParseAccountsData
+
+    data = 'a:1\na:expired\nb:2\n'
+    self.assertEqual(
+        parse(self.mock_setup, data, 'source'), {'a': ['1'], 'b': ['2']})
+    self.assertEqual(
+        parse(self.mock_setup, data, 'source'), {'a': ['1'], 'b': ['2']})
+    self.mock_setup._ParseEntries.assert_called_once_with(data)
+    self.assertEqual(
+        parse(self.mock_setup, 'a:1\n', 'source'), {'a': ['1']})
+    self.assertEqual(self.mock_setup._ParseEntries.call_count, 2)
+    self.assertEqual(
+        self.mock_setup.parse_cache, {'source': ('a:1\n', [('a', '1')])})
 
   def testGetAccountsData(self):
 
@@ -157,46 +296,49 @@ class AccountsDaemonTest(unittest.TestCase):
         data: dictionary, the faux metadata server contents.
         expected: list, the faux SSH keys expected to be set.
       """
-      accounts_daemon.AccountsDaemon._GetAccountsData(self.mock_setup, data)
-      if expected:
-        call_args, _ = self.mock_setup._ParseAccountsData.call_args
-        actual = call_args[0]
-        self.assertEqual(set(actual.split()), set(expected))
-      else:
-        self.mock_setup._ParseAccountsData.assert_called_once_with(expected)
-      self.mock_setup._ParseAccountsData.reset_mock()
+      user_map = accounts_daemon.AccountsDaemon._GetAccountsData(
+          self.mock_setup, data)
+      self.assertEqual(sorted(user_map.get('u', [])), expected)
+
+    self.mock_setup._HasExpired.return_value = False
+    self.mock_setup._ParseAccountsData.side_effect = (
+        lambda data, source: accounts_daemon.AccountsDaemon._ParseAccountsData(
+            self.mock_setup, data, source))
+    self.mock_setup._ParseEntries.side_effect = (
+        lambda data: accounts_daemon.AccountsDaemon._ParseEntries(
+            self.mock_setup, data))
 
     data = None
-    _AssertAccountsData(data, '')
+    _AssertAccountsData(data, [])
 
     data = {'test': 'data'}
-    _AssertAccountsData(data, '')
+    _AssertAccountsData(data, [])
 
     data = {'instance': {'attributes': {}}}
-    _AssertAccountsData(data, '')
+    _AssertAccountsData(data, [])
 
-    data = {'instance': {'attributes': {'ssh-keys': '1'}}}
+    data = {'instance': {'attributes': {'ssh-keys': 'u:1'}}}
     _AssertAccountsData(data, ['1'])
 
-    data = {'instance': {'attributes': {'ssh-keys': '1', 'sshKeys': '2'}}}
+    data = {'instance': {'attributes': {'ssh-keys': 'u:1', 'sshKeys': 'u:2'}}}
     _AssertAccountsData(data, ['1', '2'])
 
-    data = {'project': {'attributes': {'ssh-keys': '1'}}}
+    data = {'project': {'attributes': {'ssh-keys': 'u:1'}}}
     _AssertAccountsData(data, ['1'])
 
-    data = {'project': {'attributes': {'ssh-keys': '1', 'sshKeys': '2'}}}
+    data = {'project': {'attributes': {'ssh-keys': 'u:1', 'sshKeys': 'u:2'}}}
     _AssertAccountsData(data, ['1', '2'])
 
     data = {
         'instance': {
             'attributes': {
-                'ssh-keys': '1',
-                'sshKeys': '2',
+                'ssh-keys': 'u:1',
+                'sshKeys': 'u:2',
             },
         },
         'project': {
             'attributes': {
-                'ssh-keys': '3',
+                'ssh-keys': 'u:3',
             },
         },
     }
@@ -205,13 +347,13 @@ class AccountsDaemonTest(unittest.TestCase):
     data = {
         'instance': {
             'attributes': {
-                'ssh-keys': '1',
+                'ssh-keys': 'u:1',
                 'block-project-ssh-keys': 'false',
             },
         },
         'project': {
             'attributes': {
-                'ssh-keys': '2',
+                'ssh-keys': 'u:2',
             },
         },
     }
@@ -220,13 +362,13 @@ class AccountsDaemonTest(unittest.TestCase):
     data = {
         'instance': {
             'attributes': {
-                'ssh-keys': '1',
+                'ssh-keys': 'u:1',
                 'block-project-ssh-keys': 'true',
             },
         },
         'project': {
             'attributes': {
-                'ssh-keys': '2',
+                'ssh-keys': 'u:2',
             },
         },
     }
@@ -235,19 +377,49 @@ class AccountsDaemonTest(unittest.TestCase):
     data = {
         'instance': {
             'attributes': {
-                'ssh-keys': '1',
+                'ssh-keys': 'u:1',
                 'block-project-ssh-keys': 'false',
             },
         },
         'project': {
             'attributes': {
-                'ssh-keys': '2',
-                'sshKeys': '3',
+                'ssh-keys': 'u:2',
+                'sshKeys': 'u:3',
             },
         },
     }
     _AssertAccountsData(data, ['1', '2', '3'])
 
+  def testGetAccountsDataCache(self):
+    self.mock_setup._HasExpired.return_value = False
+    self.mock_setup._ParseAccountsData.side_effect = (
+        lambda data, source: accounts_daemon.AccountsDaemon._ParseAccountsData(
+            self.mock_setup, data, source))
+    self.mock_setup._ParseEntries.side_effect = (
+        lambda data: accounts_daemon.AccountsDaemon._ParseEntries(
+            self.mock_setup, data))
+    get_accounts_data = accounts_daemon.AccountsDaemon._GetAccountsData
+    data = {
+        'instance': {'attributes': {'ssh-keys': 'a:1'}},
+        'project': {'attributes': {'ssh-keys': 'b:2\nb:3'}},
+    }
+    self.mock_setup.expirations = {'1': None, '2': None, '3': None}
+
+    self.assertEqual(
+        get_accounts_data(self.mock_setup, data),
+        {'a': ['1'], 'b': ['2', '3']})
+    self.assertEqual(
+        sorted(self.mock_setup.parse_cache),
+        ['instance/ssh-keys', 'project/ssh-keys'])
+
+    # Blocking project keys forgets the project keys.
+    data['instance']['attributes']['block-project-ssh-keys'] = 'true'
+    self.assertEqual(get_accounts_data(self.mock_setup, data), {'a': ['1']})
+    self.assertEqual(
+        sorted(self.mock_setup.parse_cache), ['instance/ssh-keys'])
+    self.assertEqual(self.mock_setup.expirations, {'1': None})
+    self.assertEqual(self.mock_setup._ParseEntries.call_count, 2)
+
   def testUpdateUsers(self):
     update_users = {
         'a': '1',
@@ -272,9 +444,136 @@ class AccountsDaemonTest(unittest.TestCase):
     self.assertEqual(
         self.mock_setup.invalid_users, set(['invalid', 'a', 'b', 'c']))
 
+  def testMap(self):
+    self.mock_setup.workers = 1
+    self.assertEqual(
+        accounts_daemon.AccountsDaemon._Map(
+            self.mock_setup, lambda item: item * 2, [1, 2, 3]),
+        [2, 4, 6])
+    self.assertEqual(
+        accounts_daemon.AccountsDaemon._Map(
+            self.mock_setup, lambda item: item * 2, []),
+        [])
+
+  def testMapWorkers(self):
+    self.mock_setup.workers = 4
+    items = list(range(20))
+    threads = set()
+
+    def _Function(item):
+      threads.add(threading.current_thread())
+      return item + 1
+
+    self.assertEqual(
+        accounts_daemon.AccountsDaemon._Map(self.mock_setup, _Function, items),
+        [item + 1 for item in items])
+    self.assertNotIn(
+        threading.current_thread(),
+        threads)
+
+  def testGetUserState(self):
+    self.mock_utils.groups = ['b', 'a']
+    user_state = accounts_daemon.AccountsDaemon._GetUserState(
+        self.mock_setup, ['key1', 'key2'])
+    self.assertEqual(len(user_state['fingerprint']), 64)
+    self.assertEqual(user_state['groups'], ['a', 'b'])
+    self.assertNotEqual(
+        accounts_daemon.AccountsDaemon._GetUserState(
+            self.mock_setup, ['key1'])['fingerprint'],
+        user_state['fingerprint'])
+
+  def testHasUserChanged(self):
+    self.mock_setup.user_state = {
+        'a': {'fingerprint': '1', 'groups': ['g'], 'applied': 100},
+    }
+    user_state = {'fingerprint': '1', 'groups': ['g']}
+    self.assertFalse(
+        accounts_daemon.AccountsDaemon._HasUserChanged(
+            self.mock_setup, 'a', user_state))
+    self.assertTrue(
+        accounts_daemon.AccountsDaemon._HasUserChanged(
+            self.mock_setup, 'b', user_state))
+    user_state = {'fingerprint': '1', 'groups': ['g', 'h']}
+    self.assertTrue(
+        accounts_daemon.AccountsDaemon._HasUserChanged(
+            self.mock_setup, 'a', user_state))
+
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.time')
+  def testUpdateUsersUnchanged(self, mock_time):
+    mock_time.time.return_value = 200
+    update_users = {'a': ['1'], 'b': ['2'], 'c': ['3']}
+    self.mock_setup.invalid_users = set()
+    self.mock_setup._GetUserState.side_effect = lambda keys: {'keys': keys}
+    self.mock_setup._HasUserChanged.side_effect = (
+        lambda user, state: self.mock_setup.user_state.get(
+            user, {}).get('keys') != state['keys'])
+    self.mock_setup.user_state = {
+        'a': {'keys': ['1'], 'applied': 100},
+        'b': {'keys': ['old'], 'applied': 100},
+        'd': {'keys': ['4'], 'applied': 100},
+    }
+    self.mock_utils.UpdateUser.side_effect = lambda user, _: user != 'c'
+
+    accounts_daemon.AccountsDaemon._UpdateUsers(self.mock_setup, update_users)
+    self.mock_utils.UpdateGroups.assert_called_once_with(['b', 'c'])
+    expected_calls = [mock.call('b', ['2']), mock.call('c', ['3'])]
+    self.mock_utils.UpdateUser.assert_has_calls(expected_calls, any_order=True)
+    self.assertEqual(self.mock_utils.UpdateUser.call_count, 2)
+    self.mock_utils.CheckUser.assert_not_called()
+    expected_state = {
+        'a': {'keys': ['1'], 'applied': 100},
+        'b': {'keys': ['2'], 'applied': 200},
+        'd': {'keys': ['4'], 'applied': 100},
+    }
+    self.assertEqual(self.mock_setup.user_state, expected_state)
+    self.assertEqual(self.mock_setup.invalid_users, set(['c']))
+
+  def testUpdateUsersUnverified(self):
+    update_users = {'a': ['1'], 'b': ['2']}
+    self.mock_setup.invalid_users = set()
+    self.mock_setup.unverified_users = set(['a', 'b'])
+    self.mock_setup._HasUserChanged.return_value = False
+    self.mock_utils.CheckUser.side_effect = lambda user, _: user == 'a'
+    self.mock_utils.UpdateUser.return_value = True
+
+    # Only the user account that drifted from the saved state is updated.
+    accounts_daemon.AccountsDaemon._UpdateUsers(self.mock_setup, update_users)
+    self.mock_utils.UpdateGroups.assert_called_once_with(['b'])
+    self.mock_utils.UpdateUser.assert_called_once_with('b', ['2'])
+    self.assertEqual(self.mock_setup.unverified_users, set())
+    self.assertEqual(self.mock_utils.CheckUser.call_count, 2)
+
+  def testUpdateUsersForce(self):
+    update_users = {'a': ['1'], 'b': ['2']}
+    self.mock_setup.invalid_users = set()
+    self.mock_setup._HasUserChanged.return_value = False
+    self.mock_utils.UpdateUser.return_value = True
+
+    accounts_daemon.AccountsDaemon._UpdateUsers(
+        self.mock_setup, update_users, force=True)
+    self.assertEqual(self.mock_utils.UpdateUser.call_count, 2)
+    self.mock_setup._HasUserChanged.assert_not_called()
+
+  def testUpdateUsersPreempted(self):
+    update_users = {'a': ['1'], 'b': ['2'], 'c': ['3']}
+    self.mock_setup.invalid_users = set()
+    self.mock_setup._HasUserChanged.return_value = True
+    self.mock_utils.UpdateUser.return_value = True
+    # Newer metadata contents arrive after the first user is updated.
+    self.mock_setup._IsPreempted.side_effect = [False, True, True]
+
+    self.assertFalse(
+        accounts_daemon.AccountsDaemon._UpdateUsers(
+            self.mock_setup, update_users))
+    self.mock_utils.UpdateUser.assert_called_once_with('a', ['1'])
+    self.assertEqual(sorted(self.mock_setup.user_state), ['a'])
+    self.assertEqual(self.mock_setup.unverified_users, set(['b', 'c']))
+    self.assertEqual(self.mock_setup.invalid_users, set())
+
   def testRemoveUsers(self):
     remove_users = ['a', 'b', 'c', 'valid']
     self.mock_setup.invalid_users = set(['invalid', 'a', 'b', 'c'])
+    self.mock_setup.user_state = {'valid': {}, 'other': {'applied': 1}}
     accounts_daemon.AccountsDaemon._RemoveUsers(self.mock_setup, remove_users)
     expected_calls = [
         mock.call('a'),
@@ -284,6 +583,149 @@ class AccountsDaemonTest(unittest.TestCase):
     ]
     self.mock_utils.RemoveUser.assert_has_calls(expected_calls)
     self.assertEqual(self.mock_setup.invalid_users, set(['invalid']))
+    self.assertEqual(self.mock_setup.user_state, {'other': {'applied': 1}})
+
+  def testScheduleExpirations(self):
+    users = {'a': ['1', '2'], 'b': ['3'], 'c': ['4']}
+    expirations = {'1': 300, '2': None, '3': 100, '4': 200}
+    self.mock_setup._GetExpiration.side_effect = expirations.get
+
+    accounts_daemon.AccountsDaemon._ScheduleExpirations(self.mock_setup, users)
+    heap = self.mock_setup.expiry_heap
+    self.assertEqual(
+        [heapq.heappop(heap) for _ in range(len(heap))],
+        [(100, 'b'), (200, 'c'), (300, 'a')])
+
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.time')
+  def testExpireKeys(self, mock_time):
+    mock_time.time.return_value = 150
+    self.mock_setup.accounts = {
+        'a': ['1', '2'], 'b': ['3'], 'c': ['4'], 'd': ['5']}
+    self.mock_setup.expiry_heap = [(100, 'a'), (120, 'b'), (200, 'c')]
+    self.mock_setup._HasExpired.side_effect = lambda key: key in ('1', '3')
+    mocks = mock.Mock()
+    mocks.attach_mock(self.mock_utils, 'utils')
+    mocks.attach_mock(self.mock_setup, 'setup')
+
+    accounts_daemon.AccountsDaemon._ExpireKeys(self.mock_setup)
+    expected_calls = [
+        mock.call.setup._HasExpired('1'),
+        mock.call.setup._HasExpired('2'),
+        mock.call.setup._HasExpired('3'),
+        mock.call.setup.logger.info(mock.ANY, 2),
+        mock.call.setup._UpdateUsers({'a': ['2']}),
+        mock.call.setup._RemoveUsers(['b']),
+        mock.call.utils.Flush(),
+        mock.call.utils.SetConfiguredUsers(mock.ANY),
+        mock.call.utils.SetUserState(self.mock_setup.user_state),
+    ]
+    self.assertEqual(mocks.mock_calls, expected_calls)
+    self.assertEqual(
+        self.mock_setup.accounts, {'a': ['2'], 'c': ['4'], 'd': ['5']})
+    self.assertEqual(self.mock_setup.expiry_heap, [(200, 'c')])
+    call_args, _ = self.mock_utils.SetConfiguredUsers.call_args
+    self.assertEqual(sorted(call_args[0]), ['a', 'c', 'd'])
+
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.time')
+  def testExpireKeysNotDue(self, mock_time):
+    mock_time.time.return_value = 150
+    self.mock_setup.accounts = {'a': ['1']}
+    self.mock_setup.expiry_heap = [(100, 'removed'), (200, 'a')]
+
+    accounts_daemon.AccountsDaemon._ExpireKeys(self.mock_setup)
+    self.assertEqual(self.mock_setup.expiry_heap, [(200, 'a')])
+    self.mock_setup._UpdateUsers.assert_not_called()
+    self.mock_utils.SetUserState.assert_not_called()
+
+  def testIsPreempted(self):
+    self.assertFalse(
+        accounts_daemon.AccountsDaemon._IsPreempted(self.mock_setup))
+    self.mock_setup.pending_result = {}
+    self.assertTrue(
+        accounts_daemon.AccountsDaemon._IsPreempted(self.mock_setup))
+
+  def testQueueAccounts(self):
+    accounts_daemon.AccountsDaemon._QueueAccounts(self.mock_setup, 'first')
+    accounts_daemon.AccountsDaemon._QueueAccounts(self.mock_setup, 'second')
+
+    # Only the latest metadata contents are kept.
+    self.assertEqual(self.mock_setup.pending_result, 'second')
+    self.mock_logger.debug.assert_called_once_with(mock.ANY)
+
+  @mock.patch('google_compute_engine.accounts.accounts_daemon.file_utils.BatchSELinuxContext')
+  def testReconcile(self, mock_batch):
+    self.mock_setup.pending_result = 'result'
+    self.mock_setup.expiry_heap = [(0, 'a')]
+
+    def _HandleAccounts(result):
+      self.assertIsNone(self.mock_setup.pending_result)
+      raise IOError('Test Error')
+
+    def _ExpireKeys():
+      self.mock_setup.reconcile_stopped.set()
+
+    self.mock_setup.HandleAccounts.side_effect = _HandleAccounts
+    self.mock_setup._ExpireKeys.side_effect = _ExpireKeys
+
+    # Queued metadata contents are reconciled before expired SSH keys.
+    accounts_daemon.AccountsDaemon._Reconcile(self.mock_setup)
+    self.mock_setup.HandleAccounts.assert_called_once_with('result')
+    self.mock_setup._ExpireKeys.assert_called_once_with()
+    self.mock_logger.exception.assert_called_once_with(mock.ANY, mock.ANY)
+    # Each pass relabels the changed files in one batch.
+    self.assertEqual(mock_batch.call_count, 2)
+    self.assertEqual(mock_batch.return_value.__exit__.call_count, 2)
+
+  def testReconcileFarExpiration(self):
+    key = 'user:ssh-rsa key google-ssh {"expireOn":"9999-12-31T00:00:00+0000"}'
+    self.mock_setup._GetExpiration.side_effect = (
+        lambda key: accounts_daemon.AccountsDaemon._ParseExpiration(
+            self.mock_setup, key))
+    accounts_daemon.AccountsDaemon._ScheduleExpirations(
+        self.mock_setup, {'user': [key]})
+    self.mock_setup.reconcile_condition = mock.MagicMock()
+    timeouts = []
+
+    def _Wait(timeout):
+      timeouts.append(timeout)
+      if len(timeouts) == 1:
+        raise OverflowError('Test Error')
+      if len(timeouts) == 3:
+        self.mock_setup.reconcile_stopped.set()
+
+    self.mock_setup.reconcile_condition.wait.side_effect = _Wait
+
+    # The wait is capped and an exception does not stop the thread.
+    accounts_daemon.AccountsDaemon._Reconcile(self.mock_setup)
+    self.assertEqual(timeouts, [accounts_daemon.EXPIRY_WAIT_MAX] * 3)
+    self.mock_logger.exception.assert_called_once_with(mock.ANY, mock.ANY)
+    self.mock_setup.HandleAccounts.assert_not_called()
+    self.mock_setup._ExpireKeys.assert_not_called()
+
+  def testReconcileQueued(self):
+    thread = threading.Thread(
+        target=accounts_daemon.AccountsDaemon._Reconcile,
+        args=(self.mock_setup,))
+    self.mock_setup.HandleAccounts.side_effect = (
+        lambda _: accounts_daemon.AccountsDaemon._StopReconcile(
+            self.mock_setup))
+    thread.start()
+    accounts_daemon.AccountsDaemon._QueueAccounts(self.mock_setup, 'result')
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    self.mock_setup.HandleAccounts.assert_called_once_with('result')
+    self.mock_setup._ExpireKeys.assert_not_called()
+
+  def testReconcileStopped(self):
+    thread = threading.Thread(
+        target=accounts_daemon.AccountsDaemon._Reconcile,
+        args=(self.mock_setup,))
+    thread.start()
+    accounts_daemon.AccountsDaemon._StopReconcile(self.mock_setup)
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    self.mock_setup.HandleAccounts.assert_not_called()
+    self.mock_setup._ExpireKeys.assert_not_called()
 
   def testHandleAccounts(self):
     configured = ['c', 'c', 'b', 'b', 'a', 'a']
@@ -293,25 +735,83 @@ class AccountsDaemonTest(unittest.TestCase):
     mocks.attach_mock(self.mock_setup, 'setup')
     self.mock_utils.GetConfiguredUsers.return_value = configured
     self.mock_setup._GetAccountsData.return_value = desired
+    self.mock_setup.user_state = {'e': {}}
+    self.mock_setup.unverified_users = set(['e'])
     result = 'result'
     expected_add = ['c', 'd']
-    expected_remove = ['a', 'b']
+    expected_remove = ['a', 'b', 'e']
 
     accounts_daemon.AccountsDaemon.HandleAccounts(self.mock_setup, result)
     expected_calls = [
         mock.call.setup.logger.debug(mock.ANY),
         mock.call.utils.GetConfiguredUsers(),
         mock.call.setup._GetAccountsData(result),
-        mock.call.setup._UpdateUsers(desired),
+        mock.call.setup._UpdateUsers(desired, force=False),
         mock.call.setup._RemoveUsers(mock.ANY),
+        mock.call.utils.Flush(),
         mock.call.utils.SetConfiguredUsers(mock.ANY),
+        mock.call.setup._UpdateKeysIndex(desired),
+        mock.call.utils.SetUserState(self.mock_setup.user_state),
+        mock.call.setup._ScheduleExpirations(desired),
     ]
     self.assertEqual(mocks.mock_calls, expected_calls)
+    self.assertEqual(self.mock_setup.unverified_users, set())
+    self.assertEqual(self.mock_setup.accounts, desired)
     call_args, _ = self.mock_utils.SetConfiguredUsers.call_args
     self.assertEqual(set(call_args[0]), set(expected_add))
     call_args, _ = self.mock_setup._RemoveUsers.call_args
     self.assertEqual(set(call_args[0]), set(expected_remove))
 
+  def testHandleAccountsForce(self):
+    self.mock_utils.GetConfiguredUsers.return_value = []
+    self.mock_setup._GetAccountsData.return_value = {}
+    self.mock_setup.force = True
+
+    # Only the first metadata change after startup updates every account.
+    accounts_daemon.AccountsDaemon.HandleAccounts(self.mock_setup, 'result')
+    accounts_daemon.AccountsDaemon.HandleAccounts(self.mock_setup, 'result')
+    self.assertEqual(
+        self.mock_setup._UpdateUsers.mock_calls,
+        [mock.call({}, force=True), mock.call({}, force=False)])
+    self.assertFalse(self.mock_setup.force)
+
+  def testHandleAccountsPreempted(self):
+    desired = {'a': ['1']}
+    self.mock_utils.GetConfiguredUsers.return_value = ['b']
+    self.mock_setup._GetAccountsData.return_value = desired
+    self.mock_setup._UpdateUsers.return_value = False
+    self.mock_setup.force = True
+    self.mock_setup.unverified_users = set(['c'])
+
+    # The progress is saved and the rest is left for the newer contents.
+    accounts_daemon.AccountsDaemon.HandleAccounts(self.mock_setup, 'result')
+    self.mock_setup._RemoveUsers.assert_not_called()
+    self.mock_utils.Flush.assert_called_once_with()
+    self.mock_utils.SetUserState.assert_called_once_with({})
+    self.mock_utils.SetConfiguredUsers.assert_not_called()
+    self.mock_setup._UpdateKeysIndex.assert_not_called()
+    self.mock_setup._ScheduleExpirations.assert_not_called()
+    self.assertTrue(self.mock_setup.force)
+    self.assertEqual(self.mock_setup.unverified_users, set(['c']))
+    self.assertEqual(self.mock_setup.accounts, {})
+
+  def testHandleAccountsStateError(self):
+    self.mock_utils.GetConfiguredUsers.return_value = []
+    self.mock_setup._GetAccountsData.return_value = {}
+    self.mock_utils.SetUserState.side_effect = IOError('Test Error')
+
+    accounts_daemon.AccountsDaemon.HandleAccounts(self.mock_setup, 'result')
+    self.mock_logger.warning.assert_called_once_with(mock.ANY, 'Test Error')
+
+  def testHandleAccountsFlushError(self):
+    self.mock_utils.GetConfiguredUsers.return_value = []
+    self.mock_setup._GetAccountsData.return_value = {}
+    self.mock_utils.Flush.side_effect = OSError('Test Error')
+
+    accounts_daemon.AccountsDaemon.HandleAccounts(self.mock_setup, 'result')
+    self.mock_logger.warning.assert_called_once_with(mock.ANY, 'Test Error')
+    self.mock_utils.SetUserState.assert_called_once_with({})
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for accounts_index.py module."""
+
+import os
+import shutil
+import tempfile
+
+from google_compute_engine.accounts import accounts_index
+from google_compute_engine.test_compat import mock
+from google_compute_engine.test_compat import unittest
+
+
+class AccountsIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.passwd_file = os.path.join(self.temp_dir, 'passwd')
+    self.group_file = os.path.join(self.temp_dir, 'group')
+    self._WriteFile(self.passwd_file, [
+        'root:x:0:0:root:/root:/bin/bash',
+        '# comment',
+        '+nis',
+        'invalid:x:uid:0::/:/bin/sh',
+        'short:x:1',
+        'user:x:1000:1000:User:/home/user:/bin/bash',
+    ])
+    self._WriteFile(self.group_file, [
+        'root:x:0:',
+        'google-sudoers:x:1001:user,other',
+        'adm:x:4:user',
+    ])
+    self.index = accounts_index.AccountsIndex(
+        passwd_file=self.passwd_file, group_file=self.group_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _WriteFile(self, path, lines):
+    with open(path, 'w') as database:
+      database.write('\n'.join(lines) + '\n')
+
+  @mock.patch('google_compute_engine.accounts.accounts_index.pwd.getpwnam')
+  def testGetUser(self, mock_getpwnam):
+    pw_entry = self.index.GetUser('user')
+    self.assertEqual(pw_entry.pw_uid, 1000)
+    self.assertEqual(pw_entry.pw_dir, '/home/user')
+    self.assertEqual(pw_entry.pw_shell, '/bin/bash')
+    self.assertEqual(self.index.GetUser('root').pw_gid, 0)
+    mock_getpwnam.assert_not_called()
+    self.assertEqual(self.index.stats['loads'], 1)
+    self.assertEqual(self.index.stats['hits'], 2)
+
+  @mock.patch('google_compute_engine.accounts.accounts_index.pwd.getpwnam')
+  def testGetUserFallback(self, mock_getpwnam):
+    mock_getpwnam.return_value = 'ldap'
+    self.assertEqual(self.index.GetUser('ldap'), 'ldap')
+    mock_getpwnam.side_effect = KeyError('Test Error')
+    self.assertEqual(self.index.GetUser('invalid'), None)
+    self.assertEqual(self.index.stats['misses'], 2)
+
+  @mock.patch('google_compute_engine.accounts.accounts_index.grp.getgrnam')
+  def testGetGroup(self, mock_getgrnam):
+    gr_entry = self.index.GetGroup('google-sudoers')
+    self.assertEqual(gr_entry.gr_gid, 1001)
+    self.assertEqual(gr_entry.gr_mem, ['user', 'other'])
+    self.assertEqual(self.index.GetGroup('root').gr_mem, [])
+    mock_getgrnam.side_effect = KeyError('Test Error')
+    self.assertEqual(self.index.GetGroup('missing'), None)
+    mock_getgrnam.assert_called_once_with('missing')
+
+  def testGetUserGroups(self):
+    self.assertEqual(
+        self.index.GetUserGroups('user'), set(['google-sudoers', 'adm']))
+    self.assertEqual(self.index.GetUserGroups('other'), set(['google-sudoers']))
+    self.assertEqual(self.index.GetUserGroups('root'), set())
+
+  def testGetUsedIds(self):
+    self.assertEqual(self.index.GetUsedIds(), set([0, 4, 1000, 1001]))
+
+  def testRefresh(self):
+    self.assertEqual(self.index.GetUserGroups('new'), set())
+    self._WriteFile(self.group_file, ['adm:x:4:user,new'])
+    self.assertEqual(self.index.GetUserGroups('new'), set(['adm']))
+    self.assertEqual(self.index.stats['loads'], 2)
+
+  def testInvalidate(self):
+    self.index.GetUser('user')
+    self.index.GetUser('user')
+    self.assertEqual(self.index.stats['loads'], 1)
+    self.index.Invalidate()
+    self.index.GetUser('user')
+    self.assertEqual(self.index.stats['loads'], 2)
+
+  @mock.patch('google_compute_engine.accounts.accounts_index.pwd.getpwnam')
+  def testMissingFiles(self, mock_getpwnam):
+    mock_getpwnam.side_effect = KeyError('Test Error')
+    index = accounts_index.AccountsIndex(
+        passwd_file=os.path.join(self.temp_dir, 'missing'),
+        group_file=os.path.join(self.temp_dir, 'missing'))
+    self.assertEqual(index.GetUser('user'), None)
+    self.assertEqual(index.GetUserGroups('user'), set())
+
+
+if __name__ == '__main__':
+  unittest.main()
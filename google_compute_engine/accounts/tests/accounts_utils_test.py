@@ -15,7 +15,14 @@
 
 """Unittest for accounts_utils.py module."""
 
+import grp
+import json
+import os
+import pwd
+import shutil
 import subprocess
+import tempfile
+import threading
 
 from google_compute_engine.accounts import accounts_utils
 from google_compute_engine.test_compat import builtin
@@ -39,35 +46,35 @@ class AccountsUtilsTest(unittest.TestCase):
     self.mock_utils.google_users_dir = self.users_dir
     self.mock_utils.google_users_file = self.users_file
     self.mock_utils.logger = self.mock_logger
+    self.mock_utils.index = mock.Mock()
+    self.mock_utils.accounts_lock = threading.Lock()
+    self.mock_utils.lazy_home = False
 
+  @mock.patch('google_compute_engine.accounts.accounts_utils.home_dir_deleter')
   @mock.patch('google_compute_engine.accounts.accounts_utils.AccountsUtils._GetGroup')
   @mock.patch('google_compute_engine.accounts.accounts_utils.AccountsUtils._CreateSudoersGroup')
-  def testAccountsUtils(self, mock_create, mock_group):
+  def testAccountsUtils(self, mock_create, mock_group, mock_deleter):
     mock_logger = mock.Mock()
     mock_group.side_effect = lambda group: 'google' in group
+    mock_deleter.TRASH_DIR = '.trash'
 
     utils = accounts_utils.AccountsUtils(
         logger=mock_logger, groups='foo,google,bar', remove=True)
     mock_create.assert_called_once_with()
+    mock_deleter.HomeDirDeleter.assert_called_once_with(mock_logger)
+    mock_deleter.HomeDirDeleter().Recover.assert_called_once_with(
+        '/home/.trash')
     self.assertEqual(utils.logger, mock_logger)
     self.assertEqual(sorted(utils.groups), ['google', 'google-sudoers'])
     self.assertTrue(utils.remove)
+    self.assertFalse(utils.lazy_home)
 
-  @mock.patch('google_compute_engine.accounts.accounts_utils.grp')
-  def testGetGroup(self, mock_grp):
-    mock_grp.getgrnam.return_value = 'Test'
+  def testGetGroup(self):
+    self.mock_utils.index.GetGroup.return_value = 'Test'
     self.assertEqual(
         accounts_utils.AccountsUtils._GetGroup(self.mock_utils, 'valid'),
         'Test')
-    mock_grp.getgrnam.side_effect = KeyError('Test Error')
-    self.assertEqual(
-        accounts_utils.AccountsUtils._GetGroup(self.mock_utils, 'invalid'),
-        None)
-    expected_calls = [
-        mock.call.getgrnam('valid'),
-        mock.call.getgrnam('invalid'),
-    ]
-    self.assertEqual(mock_grp.mock_calls, expected_calls)
+    self.mock_utils.index.GetGroup.assert_called_once_with('valid')
 
   @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
   @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
@@ -148,21 +155,12 @@ class AccountsUtilsTest(unittest.TestCase):
     ]
     self.assertEqual(mocks.mock_calls, expected_calls)
 
-  @mock.patch('google_compute_engine.accounts.accounts_utils.pwd')
-  def testGetUser(self, mock_pwd):
-    mock_pwd.getpwnam.return_value = 'Test'
+  def testGetUser(self):
+    self.mock_utils.index.GetUser.return_value = 'Test'
     self.assertEqual(
         accounts_utils.AccountsUtils._GetUser(self.mock_utils, 'valid'),
         'Test')
-    mock_pwd.getpwnam.side_effect = KeyError('Test Error')
-    self.assertEqual(
-        accounts_utils.AccountsUtils._GetUser(self.mock_utils, 'invalid'),
-        None)
-    expected_calls = [
-        mock.call.getpwnam('valid'),
-        mock.call.getpwnam('invalid'),
-    ]
-    self.assertEqual(mock_pwd.mock_calls, expected_calls)
+    self.mock_utils.index.GetUser.assert_called_once_with('valid')
 
   @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
   def testAddUser(self, mock_call):
@@ -172,9 +170,20 @@ class AccountsUtilsTest(unittest.TestCase):
     self.assertTrue(
         accounts_utils.AccountsUtils._AddUser(self.mock_utils, user))
     mock_call.assert_called_once_with(command)
+    self.mock_utils.index.Invalidate.assert_called_once_with()
     expected_calls = [mock.call.info(mock.ANY, user)] * 2
     self.assertEqual(self.mock_logger.mock_calls, expected_calls)
 
+  @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
+  def testAddUserLazyHome(self, mock_call):
+    user = 'user'
+    command = ['useradd', '-M', '-s', '/bin/bash', '-p', '*', user]
+    self.mock_utils.lazy_home = True
+
+    self.assertTrue(
+        accounts_utils.AccountsUtils._AddUser(self.mock_utils, user))
+    mock_call.assert_called_once_with(command)
+
   @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
   def testAddUserError(self, mock_call):
     user = 'user'
@@ -206,6 +215,16 @@ class AccountsUtilsTest(unittest.TestCase):
     ]
     self.assertEqual(self.mock_logger.mock_calls, expected_calls)
 
+  @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
+  def testUpdateUserGroupsUnchanged(self, mock_call):
+    self.mock_utils.index.GetUserGroups.return_value = set(['a', 'b'])
+
+    self.assertTrue(
+        accounts_utils.AccountsUtils._UpdateUserGroups(
+            self.mock_utils, 'user', ['b', 'a']))
+    mock_call.assert_not_called()
+    self.mock_utils.index.GetUserGroups.assert_called_once_with('user')
+
   @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
   def testUpdateUserGroupsError(self, mock_call):
     user = 'user'
@@ -223,107 +242,172 @@ class AccountsUtilsTest(unittest.TestCase):
     ]
     self.assertEqual(self.mock_logger.mock_calls, expected_calls)
 
+  def _SetUpAuthorizedKeys(self, lines=None):
+    """Create a home directory with an optional authorized keys file.
+
+    Args:
+      lines: list, the lines of the authorized keys file or None.
+
+    Returns:
+      tuple, the home directory and the authorized keys file path.
+    """
+    home_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, home_dir)
+    ssh_dir = os.path.join(home_dir, '.ssh')
+    os.mkdir(ssh_dir)
+    authorized_keys_file = os.path.join(ssh_dir, 'authorized_keys')
+    if lines is not None:
+      with open(authorized_keys_file, 'w') as authorized_keys:
+        authorized_keys.write(''.join(lines))
+      os.chmod(authorized_keys_file, 0o600)
+    self.mock_utils._GetUser.return_value = pwd.struct_passwd(
+        ('', '', os.getuid(), os.getgid(), '', home_dir, ''))
+    self.mock_utils.stats = {
+        'authorized_keys_rewritten': 0,
+        'authorized_keys_skipped': 0,
+    }
+    self.mock_utils._Count.side_effect = (
+        lambda name: self.mock_utils.stats.__setitem__(
+            name, self.mock_utils.stats[name] + 1))
+    return home_dir, authorized_keys_file
+
   @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.shutil.copy')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.tempfile.NamedTemporaryFile')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.os.path.exists')
-  def testUpdateAuthorizedKeys(self, mock_exists, mock_tempfile, mock_copy,
-                               mock_permissions):
-    mock_open = mock.mock_open()
-    user = 'user'
+  def testUpdateAuthorizedKeys(self, mock_permissions):
     ssh_keys = ['Google key 1', 'Google key 2']
-    temp_dest = '/tmp/dest'
-    pw_uid = 1
-    pw_gid = 2
-    pw_dir = '/home'
-    ssh_dir = '/home/.ssh'
-    authorized_keys_file = '/home/.ssh/authorized_keys'
-    pw_entry = accounts_utils.pwd.struct_passwd(
-        ('', '', pw_uid, pw_gid, '', pw_dir, ''))
-    self.mock_utils._GetUser.return_value = pw_entry
-    mock_exists.return_value = True
-    mock_tempfile.return_value = mock_tempfile
-    mock_tempfile.__enter__.return_value.name = temp_dest
-    self.mock_logger.name = 'test'
+    home_dir, authorized_keys_file = self._SetUpAuthorizedKeys([
+        'User key a\n',
+        'User key b\n',
+        '\n',
+        self.mock_utils.google_comment + '\n',
+        'Google key a\n',
+        self.mock_utils.google_comment + '\n',
+        'Google key b\n',
+        'User key c',
+    ])
+    uid = os.getuid()
+    gid = os.getgid()
 
-    with mock.patch('%s.open' % builtin, mock_open, create=False):
-      mock_open().readlines.return_value = [
-          'User key a\n',
-          'User key b\n',
-          '\n',
-          self.mock_utils.google_comment + '\n',
-          'Google key a\n',
-          self.mock_utils.google_comment + '\n',
-          'Google key b\n',
-          'User key c\n',
-      ]
-      accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
-          self.mock_utils, user, ssh_keys)
-
-    expected_calls = [
-        mock.call(mode='w', prefix='test-', delete=True),
-        mock.call.__enter__(),
-        mock.call.__enter__().write('User key a\n'),
-        mock.call.__enter__().write('User key b\n'),
-        mock.call.__enter__().write('\n'),
-        mock.call.__enter__().write('User key c\n'),
-        mock.call.__enter__().write(self.mock_utils.google_comment + '\n'),
-        mock.call.__enter__().write('Google key 1\n'),
-        mock.call.__enter__().write(self.mock_utils.google_comment + '\n'),
-        mock.call.__enter__().write('Google key 2\n'),
-        mock.call.__enter__().flush(),
-        mock.call.__exit__(None, None, None),
-    ]
-    self.assertEqual(mock_tempfile.mock_calls, expected_calls)
-    mock_copy.assert_called_once_with(temp_dest, authorized_keys_file)
+    accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
+        self.mock_utils, 'user', ssh_keys)
+    with open(authorized_keys_file) as authorized_keys:
+      self.assertEqual(
+          authorized_keys.readlines(),
+          [
+              'User key a\n',
+              'User key b\n',
+              '\n',
+              'User key c\n',
+              self.mock_utils.google_comment + '\n',
+              'Google key 1\n',
+              self.mock_utils.google_comment + '\n',
+              'Google key 2\n',
+          ])
+    self.assertEqual(os.stat(authorized_keys_file).st_mode & 0o777, 0o600)
+    self.assertEqual(
+        os.listdir(os.path.join(home_dir, '.ssh')), ['authorized_keys'])
+    ssh_dir = os.path.join(home_dir, '.ssh')
     expected_calls = [
-        mock.call(pw_dir, mode=0o755, uid=pw_uid, gid=pw_gid, mkdir=True),
-        mock.call(ssh_dir, mode=0o700, uid=pw_uid, gid=pw_gid, mkdir=True),
-        mock.call(authorized_keys_file, mode=0o600, uid=pw_uid, gid=pw_gid),
+        mock.call(home_dir, mode=0o755, uid=uid, gid=gid, mkdir=True),
+        mock.call(ssh_dir, mode=0o700, uid=uid, gid=gid, mkdir=True),
     ]
     self.assertEqual(mock_permissions.mock_calls, expected_calls)
+    self.assertEqual(self.mock_utils.stats['authorized_keys_rewritten'], 1)
 
   @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.shutil.copy')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.tempfile.NamedTemporaryFile')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.os.path.exists')
-  def testUpdateAuthorizedKeysNoKeys(self, mock_exists, mock_tempfile,
-                                     mock_copy, mock_permissions):
-    user = 'user'
-    ssh_keys = ['Google key 1']
-    temp_dest = '/tmp/dest'
-    pw_uid = 1
-    pw_gid = 2
-    pw_dir = '/home'
-    ssh_dir = '/home/.ssh'
-    authorized_keys_file = '/home/.ssh/authorized_keys'
-    pw_entry = accounts_utils.pwd.struct_passwd(
-        ('', '', pw_uid, pw_gid, '', pw_dir, ''))
-    self.mock_utils._GetUser.return_value = pw_entry
-    mock_exists.return_value = False
-    mock_tempfile.return_value = mock_tempfile
-    mock_tempfile.__enter__.return_value.name = temp_dest
-    self.mock_logger.name = 'test'
+  def testUpdateAuthorizedKeysSymlink(self, _):
+    home_dir, authorized_keys_file = self._SetUpAuthorizedKeys()
+    target = os.path.join(home_dir, 'secret')
+    with open(target, 'w') as secret:
+      secret.write('secret\n')
+    os.symlink(target, authorized_keys_file)
+
+    # The target of a symbolic link is not copied into the new file.
+    accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
+        self.mock_utils, 'user', ['Google key 1'])
+    self.assertFalse(os.path.islink(authorized_keys_file))
+    with open(authorized_keys_file) as authorized_keys:
+      self.assertEqual(
+          authorized_keys.read(),
+          self.mock_utils.google_comment + '\nGoogle key 1\n')
+    with open(target) as secret:
+      self.assertEqual(secret.read(), 'secret\n')
+    self.mock_logger.warning.assert_called_once_with(
+        mock.ANY, authorized_keys_file, 'user')
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
+  def testUpdateAuthorizedKeysOtherOwner(self, _):
+    home_dir, authorized_keys_file = self._SetUpAuthorizedKeys(['Other key\n'])
+    self.mock_utils._GetUser.return_value = pwd.struct_passwd(
+        ('', '', os.getuid() + 1, os.getgid(), '', home_dir, ''))
+
+    # The lines of a file owned by another user are not kept.
+    with mock.patch('google_compute_engine.accounts.accounts_utils.os.fchown'):
+      accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
+          self.mock_utils, 'user', ['Google key 1'])
+    with open(authorized_keys_file) as authorized_keys:
+      self.assertEqual(
+          authorized_keys.read(),
+          self.mock_utils.google_comment + '\nGoogle key 1\n')
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
+  def testUpdateAuthorizedKeysNoKeys(self, mock_permissions):
+    _, authorized_keys_file = self._SetUpAuthorizedKeys()
 
     # The authorized keys file does not exist so write a new one.
     accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
-        self.mock_utils, user, ssh_keys)
-    expected_calls = [
-        mock.call(mode='w', prefix='test-', delete=True),
-        mock.call.__enter__(),
-        mock.call.__enter__().write(self.mock_utils.google_comment + '\n'),
-        mock.call.__enter__().write('Google key 1\n'),
-        mock.call.__enter__().flush(),
-        mock.call.__exit__(None, None, None),
-    ]
-    self.assertEqual(mock_tempfile.mock_calls, expected_calls)
-    mock_copy.assert_called_once_with(temp_dest, authorized_keys_file)
-    expected_calls = [
-        mock.call(pw_dir, mode=0o755, uid=pw_uid, gid=pw_gid, mkdir=True),
-        mock.call(ssh_dir, mode=0o700, uid=pw_uid, gid=pw_gid, mkdir=True),
-        mock.call(authorized_keys_file, mode=0o600, uid=pw_uid, gid=pw_gid),
+        self.mock_utils, 'user', ['Google key 1'])
+    with open(authorized_keys_file) as authorized_keys:
+      self.assertEqual(
+          authorized_keys.read(),
+          self.mock_utils.google_comment + '\nGoogle key 1\n')
+    self.assertEqual(mock_permissions.call_count, 2)
+    self.assertEqual(self.mock_utils.stats['authorized_keys_rewritten'], 1)
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
+  def testUpdateAuthorizedKeysUnchanged(self, mock_permissions):
+    lines = [
+        'User key a\n',
+        self.mock_utils.google_comment + '\n',
+        'Google key 1\n',
     ]
-    self.assertEqual(mock_permissions.mock_calls, expected_calls)
+    _, authorized_keys_file = self._SetUpAuthorizedKeys(lines)
+    inode = os.stat(authorized_keys_file).st_ino
+
+    # The contents are unchanged so the file is not rewritten.
+    accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
+        self.mock_utils, 'user', ['Google key 1'])
+    self.assertEqual(os.stat(authorized_keys_file).st_ino, inode)
+    self.assertEqual(mock_permissions.call_count, 2)
+    self.assertEqual(
+        self.mock_utils.stats,
+        {'authorized_keys_rewritten': 0, 'authorized_keys_skipped': 1})
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
+  @mock.patch('google_compute_engine.accounts.accounts_utils.os.chown')
+  @mock.patch('google_compute_engine.accounts.accounts_utils.os.chmod')
+  @mock.patch('google_compute_engine.accounts.accounts_utils.os.fchown')
+  def testUpdateAuthorizedKeysOwner(
+      self, mock_fchown, mock_chmod, mock_chown, _):
+    self._SetUpAuthorizedKeys()
+
+    # The owner of the temporary file is only set through its descriptor.
+    accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
+        self.mock_utils, 'user', ['Google key 1'])
+    mock_fchown.assert_called_once_with(mock.ANY, os.getuid(), os.getgid())
+    mock_chown.assert_not_called()
+    mock_chmod.assert_not_called()
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
+  @mock.patch('google_compute_engine.accounts.accounts_utils.os.rename')
+  def testUpdateAuthorizedKeysError(self, mock_rename, _):
+    home_dir, _ = self._SetUpAuthorizedKeys()
+    mock_rename.side_effect = OSError('Test Error')
+
+    # The temporary file is removed when the file cannot be replaced.
+    with self.assertRaises(OSError):
+      accounts_utils.AccountsUtils._UpdateAuthorizedKeys(
+          self.mock_utils, 'user', ['Google key 1'])
+    self.assertEqual(os.listdir(os.path.join(home_dir, '.ssh')), [])
 
   @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
   def testUpdateAuthorizedKeysNoUser(self, mock_permissions):
@@ -343,7 +427,7 @@ class AccountsUtilsTest(unittest.TestCase):
     user = 'user'
     pw_dir = '/home'
     authorized_keys_file = '/home/.ssh/authorized_keys'
-    pw_entry = accounts_utils.pwd.struct_passwd(
+    pw_entry = pwd.struct_passwd(
         ('', '', '', '', '', pw_dir, ''))
     self.mock_utils._GetUser.return_value = pw_entry
     mock_exists.return_value = True
@@ -360,7 +444,7 @@ class AccountsUtilsTest(unittest.TestCase):
     user = 'user'
     pw_dir = '/home'
     authorized_keys_file = '/home/.ssh/authorized_keys'
-    pw_entry = accounts_utils.pwd.struct_passwd(
+    pw_entry = pwd.struct_passwd(
         ('', '', '', '', '', pw_dir, ''))
     self.mock_utils._GetUser.return_value = pw_entry
     mock_exists.return_value = False
@@ -385,7 +469,7 @@ class AccountsUtilsTest(unittest.TestCase):
     user = 'user'
     pw_dir = '/home'
     authorized_keys_file = '/home/.ssh/authorized_keys'
-    pw_entry = accounts_utils.pwd.struct_passwd(
+    pw_entry = pwd.struct_passwd(
         ('', '', '', '', '', pw_dir, ''))
     self.mock_utils._GetUser.return_value = pw_entry
     mock_exists.return_value = True
@@ -415,34 +499,163 @@ class AccountsUtilsTest(unittest.TestCase):
 
   @mock.patch('google_compute_engine.accounts.accounts_utils.os.makedirs')
   @mock.patch('google_compute_engine.accounts.accounts_utils.os.path.exists')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.SetPermissions')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.shutil.copy')
-  @mock.patch('google_compute_engine.accounts.accounts_utils.tempfile.NamedTemporaryFile')
-  def testSetConfiguredUsers(self, mock_tempfile, mock_copy, mock_permissions,
-                             mock_exists, mock_makedirs):
-    temp_dest = '/temp/dest'
+  @mock.patch('google_compute_engine.accounts.accounts_utils.file_utils.WriteFile')
+  def testSetConfiguredUsers(self, mock_write, mock_exists, mock_makedirs):
     users = ['a', 'b', 'c']
-    mock_tempfile.return_value = mock_tempfile
-    mock_tempfile.__enter__.return_value.name = temp_dest
     mock_exists.return_value = False
-    self.mock_logger.name = 'test'
 
     accounts_utils.AccountsUtils.SetConfiguredUsers(self.mock_utils, users)
+    mock_makedirs.assert_called_once_with(self.users_dir)
+    mock_write.assert_called_once_with(
+        self.users_file, 'a\nb\nc\n', mode=0o600, uid=0, gid=0)
+
+  def testGetUserState(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    self.mock_utils.google_state_file = os.path.join(temp_dir, 'state.json')
+    get_state = accounts_utils.AccountsUtils.GetUserState
+
+    # A missing state file is an empty state.
+    self.assertEqual(get_state(self.mock_utils), {})
+
+    users = {'a': {'fingerprint': '1', 'groups': ['g'], 'applied': 100}}
+    with open(self.mock_utils.google_state_file, 'w') as state_file:
+      json.dump({'version': accounts_utils.STATE_VERSION, 'users': users},
+                state_file)
+    self.assertEqual(get_state(self.mock_utils), users)
+
+    with open(self.mock_utils.google_state_file, 'w') as state_file:
+      json.dump({'version': -1, 'users': users}, state_file)
+    self.assertEqual(get_state(self.mock_utils), {})
+
+    with open(self.mock_utils.google_state_file, 'w') as state_file:
+      state_file.write('{invalid')
+    self.assertEqual(get_state(self.mock_utils), {})
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+
+  def testSetUserState(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    self.mock_utils.google_users_dir = os.path.join(temp_dir, 'google')
+    self.mock_utils.google_state_file = os.path.join(
+        self.mock_utils.google_users_dir, 'state.json')
+    users = {'a': {'fingerprint': '1', 'groups': ['g'], 'applied': 100}}
+
+    accounts_utils.AccountsUtils.SetUserState(self.mock_utils, users)
+    accounts_utils.AccountsUtils.SetUserState(self.mock_utils, users)
+    with open(self.mock_utils.google_state_file) as state_file:
+      self.assertEqual(
+          json.load(state_file),
+          {'version': accounts_utils.STATE_VERSION, 'users': users})
+    self.assertEqual(
+        os.stat(self.mock_utils.google_state_file).st_mode & 0o777, 0o600)
+    self.assertEqual(
+        os.listdir(self.mock_utils.google_users_dir), ['state.json'])
+
+  def testCheckUser(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    os.mkdir(os.path.join(temp_dir, '.ssh'))
+    authorized_keys_file = os.path.join(temp_dir, '.ssh', 'authorized_keys')
+    with open(authorized_keys_file, 'w') as keys_file:
+      keys_file.write('user key\n# Added by Google\nkey1\n'
+                      '# Added by Google\nkey2\n')
+    pw_entry = pwd.struct_passwd(
+        ('user', '', os.getuid(), os.getgid(), '', temp_dir, '/bin/bash'))
+    gr_entry = grp.struct_group(('g', '', 1, ['user']))
+    self.mock_utils._GetUser.return_value = pw_entry
+    self.mock_utils._GetGroup.return_value = gr_entry
+    self.mock_utils.groups = ['g']
+    check_user = accounts_utils.AccountsUtils.CheckUser
+
+    self.assertTrue(check_user(self.mock_utils, 'user', ['key1', 'key2']))
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key1']))
+    self.assertFalse(check_user(self.mock_utils, 'other', ['key1', 'key2']))
+    # A symbolic link is not followed.
+    target = os.path.join(temp_dir, 'target')
+    os.rename(authorized_keys_file, target)
+    os.symlink(target, authorized_keys_file)
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key1', 'key2']))
+    # A file owned by another user is not read.
+    os.remove(authorized_keys_file)
+    os.rename(target, authorized_keys_file)
+    self.mock_utils._GetUser.return_value = pwd.struct_passwd(
+        ('user', '', os.getuid() + 1, 1, '', temp_dir, '/bin/bash'))
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key1', 'key2']))
+    self.mock_utils._GetUser.return_value = pw_entry
+    os.remove(authorized_keys_file)
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key1', 'key2']))
+    self.mock_utils._GetUser.return_value = None
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key1', 'key2']))
+
+  def testCheckUserLazyHome(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    home_dir = os.path.join(temp_dir, 'user')
+    self.mock_utils._GetUser.return_value = pwd.struct_passwd(
+        ('user', '', 1000, 1000, '', home_dir, '/bin/bash'))
+    self.mock_utils.groups = []
+    check_user = accounts_utils.AccountsUtils.CheckUser
+
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key']))
+    self.mock_utils.lazy_home = True
+    self.assertTrue(check_user(self.mock_utils, 'user', ['key']))
+    os.mkdir(home_dir)
+    self.assertFalse(check_user(self.mock_utils, 'user', ['key']))
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
+  def testUpdateGroups(self, mock_call):
+    user_groups = {
+        'a': set(['google-sudoers', 'adm']),
+        'b': set(['google-sudoers', 'other']),
+        'c': set(),
+        'd': set(['adm', 'google-sudoers']),
+    }
+    group_members = {
+        'adm': ['a', 'admin', 'd'],
+        'google-sudoers': ['a', 'b', 'd'],
+        'other': ['b', 'x'],
+    }
+    self.mock_utils.groups = ['google-sudoers', 'adm']
+    self.mock_utils._GetUser.side_effect = lambda user: user != 'missing'
+    self.mock_utils.index.GetGroup.side_effect = (
+        lambda group: grp.struct_group((group, 'x', 1, group_members[group])))
+    self.mock_utils.index.GetUserGroups.side_effect = user_groups.get
 
+    self.assertTrue(
+        accounts_utils.AccountsUtils.UpdateGroups(
+            self.mock_utils, ['a', 'b', 'c', 'd', 'missing']))
     expected_calls = [
-        mock.call(mode='w', prefix='test-', delete=True),
-        mock.call.__enter__(),
-        mock.call.__enter__().write('a\n'),
-        mock.call.__enter__().write('b\n'),
-        mock.call.__enter__().write('c\n'),
-        mock.call.__enter__().flush(),
-        mock.call.__exit__(None, None, None),
+        mock.call(['gpasswd', '-M', 'a,admin,b,c,d', 'adm']),
+        mock.call(['gpasswd', '-M', 'a,b,c,d', 'google-sudoers']),
+        mock.call(['gpasswd', '-M', 'x', 'other']),
     ]
-    self.assertEqual(mock_tempfile.mock_calls, expected_calls)
-    mock_makedirs.assert_called_once_with(self.users_dir)
-    mock_copy.assert_called_once_with(temp_dest, self.users_file)
-    mock_permissions.assert_called_once_with(
-        self.users_file, mode=0o600, uid=0, gid=0)
+    self.assertEqual(mock_call.mock_calls, expected_calls)
+    self.mock_utils.index.Invalidate.assert_called_once_with()
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
+  def testUpdateGroupsUnchanged(self, mock_call):
+    self.mock_utils.groups = ['google-sudoers']
+    self.mock_utils.index.GetUserGroups.return_value = set(['google-sudoers'])
+
+    self.assertTrue(
+        accounts_utils.AccountsUtils.UpdateGroups(self.mock_utils, ['a', 'b']))
+    mock_call.assert_not_called()
+    self.mock_utils.index.Invalidate.assert_not_called()
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
+  def testUpdateGroupsError(self, mock_call):
+    self.mock_utils.groups = ['google-sudoers']
+    self.mock_utils.index.GetUserGroups.return_value = set()
+    self.mock_utils.index.GetGroup.return_value = grp.struct_group(
+        ('google-sudoers', 'x', 1, []))
+    mock_call.side_effect = subprocess.CalledProcessError(1, 'Test')
+
+    self.assertFalse(
+        accounts_utils.AccountsUtils.UpdateGroups(self.mock_utils, ['a']))
+    self.mock_logger.warning.assert_called_once_with(
+        mock.ANY, 'google-sudoers', mock.ANY)
+    self.mock_utils.index.Invalidate.assert_called_once_with()
 
   def testUpdateUser(self):
     valid_users = [
@@ -456,7 +669,7 @@ class AccountsUtilsTest(unittest.TestCase):
     ]
     groups = ['a', 'b', 'c']
     keys = ['Key 1', 'Key 2']
-    pw_entry = accounts_utils.pwd.struct_passwd(tuple(['']*7))
+    pw_entry = pwd.struct_passwd(tuple(['']*7))
     self.mock_utils.groups = groups
     self.mock_utils._GetUser.return_value = pw_entry
     self.mock_utils._AddUser.return_value = True
@@ -519,7 +732,7 @@ class AccountsUtilsTest(unittest.TestCase):
     user = 'user'
     groups = ['a', 'b', 'c']
     pw_shell = '/sbin/nologin'
-    pw_entry = accounts_utils.pwd.struct_passwd(
+    pw_entry = pwd.struct_passwd(
         ('', '', '', '', '', '', pw_shell))
     self.mock_utils.groups = groups
     self.mock_utils._GetUser.return_value = pw_entry
@@ -529,11 +742,29 @@ class AccountsUtilsTest(unittest.TestCase):
         accounts_utils.AccountsUtils.UpdateUser(self.mock_utils, user, []))
     self.mock_utils._UpdateAuthorizedKeys.assert_not_called()
 
+  def testUpdateUserLazyHome(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    home_dir = os.path.join(temp_dir, 'user')
+    self.mock_utils.lazy_home = True
+    self.mock_utils.groups = []
+    self.mock_utils._GetUser.return_value = pwd.struct_passwd(
+        ('user', '', 1000, 1000, '', home_dir, '/bin/bash'))
+    self.mock_utils._UpdateUserGroups.return_value = True
+
+    self.assertTrue(
+        accounts_utils.AccountsUtils.UpdateUser(self.mock_utils, 'user', []))
+    self.mock_utils._UpdateAuthorizedKeys.assert_not_called()
+    os.mkdir(home_dir)
+    self.assertTrue(
+        accounts_utils.AccountsUtils.UpdateUser(self.mock_utils, 'user', []))
+    self.mock_utils._UpdateAuthorizedKeys.assert_called_once_with('user', [])
+
   def testUpdateUserError(self):
     user = 'user'
     groups = ['a', 'b', 'c']
     keys = ['Key 1', 'Key 2']
-    pw_entry = accounts_utils.pwd.struct_passwd(tuple(['']*7))
+    pw_entry = pwd.struct_passwd(tuple(['']*7))
     self.mock_utils.groups = groups
     self.mock_utils._GetUser.return_value = pw_entry
     self.mock_utils._AddUser.return_value = True
@@ -555,19 +786,22 @@ class AccountsUtilsTest(unittest.TestCase):
   @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
   def testRemoveUserForce(self, mock_call):
     user = 'user'
-    command = ['userdel', '-r', user]
+    command = ['userdel', user]
+    pw_entry = pwd.struct_passwd(('user', '', 1, 1, '', '/home/user', ''))
+    self.mock_utils._GetUser.return_value = pw_entry
     self.mock_utils.remove = True
 
     accounts_utils.AccountsUtils.RemoveUser(self.mock_utils, user)
     mock_call.assert_called_once_with(command)
     expected_calls = [mock.call.info(mock.ANY, user)] * 2
     self.assertEqual(self.mock_logger.mock_calls, expected_calls)
+    self.mock_utils._TrashHomeDir.assert_called_once_with(user, pw_entry)
     self.mock_utils._RemoveAuthorizedKeys.assert_called_once_with(user)
 
   @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
   def testRemoveUserError(self, mock_call):
     user = 'user'
-    command = ['userdel', '-r', user]
+    command = ['userdel', user]
     mock_call.side_effect = subprocess.CalledProcessError(1, 'Test')
     self.mock_utils.remove = True
 
@@ -578,8 +812,23 @@ class AccountsUtilsTest(unittest.TestCase):
         mock.call.warning(mock.ANY, user, mock.ANY),
     ]
     self.assertEqual(self.mock_logger.mock_calls, expected_calls)
+    self.mock_utils._TrashHomeDir.assert_not_called()
     self.mock_utils._RemoveAuthorizedKeys.assert_called_once_with(user)
 
+  def testTrashHomeDir(self):
+    pw_entry = pwd.struct_passwd(('user', '', 1, 1, '', '/home/user', ''))
+    self.mock_utils.deleter = mock.Mock()
+
+    accounts_utils.AccountsUtils._TrashHomeDir(
+        self.mock_utils, 'user', pw_entry)
+    self.mock_utils.deleter.Trash.assert_called_once_with('/home/user', 1)
+
+    self.mock_utils.deleter.Trash.side_effect = OSError('Test Error')
+    accounts_utils.AccountsUtils._TrashHomeDir(
+        self.mock_utils, 'user', pw_entry)
+    self.mock_logger.warning.assert_called_once_with(
+        mock.ANY, 'user', 'Test Error')
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for authorized_keys_index.py module."""
+
+import os
+import shutil
+import tempfile
+
+from google_compute_engine.accounts import authorized_keys_index
+from google_compute_engine.test_compat import mock
+from google_compute_engine.test_compat import unittest
+
+
+class AuthorizedKeysIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.temp_dir, 'google', 'keys.idx')
+    self.index = authorized_keys_index.AuthorizedKeysIndex(
+        index_file=self.index_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testGetKeys(self):
+    users = dict(
+        ('user%d' % i, [('ssh-rsa key%d user%d' % (i, i), None)])
+        for i in range(100))
+    users['expiring'] = [('key1', 1000), ('key2\n', 2000), ('key3', None)]
+
+    self.index.Write(users)
+    self.assertEqual(os.stat(self.index_file).st_mode & 0o777, 0o644)
+    for i in range(100):
+      self.assertEqual(
+          self.index.GetKeys('user%d' % i), ['ssh-rsa key%d user%d' % (i, i)])
+    self.assertEqual(
+        self.index.GetKeys('expiring', now=500), ['key1', 'key2', 'key3'])
+    self.assertEqual(
+        self.index.GetKeys('expiring', now=1500), ['key2', 'key3'])
+    self.assertEqual(self.index.GetKeys('expiring', now=2500), ['key3'])
+    self.assertEqual(self.index.GetKeys('missing'), [])
+
+  def testGetKeysEmpty(self):
+    self.index.Write({})
+    self.assertEqual(self.index.GetKeys('user'), [])
+
+  def testGetKeysMissing(self):
+    self.assertEqual(self.index.GetKeys('user'), [])
+
+  def testGetKeysInvalid(self):
+    os.makedirs(os.path.dirname(self.index_file))
+    with open(self.index_file, 'wb') as index:
+      index.write(b'invalid')
+    self.assertEqual(self.index.GetKeys('user'), [])
+    with open(self.index_file, 'wb') as index:
+      index.write(b'invalid index contents')
+    self.assertEqual(self.index.GetKeys('user'), [])
+
+  def testWriteReplace(self):
+    self.index.Write({'a': [('key1', None)]})
+    self.index.Write({'b': [('key2', None)]})
+    self.assertEqual(self.index.GetKeys('a'), [])
+    self.assertEqual(self.index.GetKeys('b'), ['key2'])
+    self.assertEqual(
+        os.listdir(os.path.dirname(self.index_file)), ['keys.idx'])
+
+  @mock.patch('google_compute_engine.accounts.authorized_keys_index.AuthorizedKeysIndex')
+  @mock.patch('google_compute_engine.accounts.authorized_keys_index.sys.stdout')
+  def testMain(self, mock_stdout, mock_index):
+    mock_index.return_value.GetKeys.return_value = ['key1', 'key2']
+
+    with mock.patch('sys.argv', ['google_authorized_keys', 'user']):
+      authorized_keys_index.main()
+    mock_index.return_value.GetKeys.assert_called_once_with('user')
+    expected_calls = [mock.call.write('key1\n'), mock.call.write('key2\n')]
+    self.assertEqual(mock_stdout.mock_calls, expected_calls)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for home_dir_deleter.py module."""
+
+import errno
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from google_compute_engine.accounts import home_dir_deleter
+from google_compute_engine.test_compat import mock
+from google_compute_engine.test_compat import unittest
+
+
+class HomeDirDeleterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mock_logger = mock.Mock()
+    self.temp_dir = tempfile.mkdtemp()
+    self.home_dir = os.path.join(self.temp_dir, 'user')
+    self.trash_dir = os.path.join(self.temp_dir, home_dir_deleter.TRASH_DIR)
+    os.makedirs(os.path.join(self.home_dir, '.ssh'))
+    with open(os.path.join(self.home_dir, 'file'), 'w') as home_file:
+      home_file.write('x' * 100)
+    self.deleter = home_dir_deleter.HomeDirDeleter(self.mock_logger)
+    # Do not start the deletion thread.
+    self.deleter.thread = mock.Mock()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testTrash(self):
+    self.assertTrue(self.deleter.Trash(self.home_dir, os.getuid()))
+    self.assertFalse(os.path.exists(self.home_dir))
+    trash_paths = os.listdir(self.trash_dir)
+    self.assertEqual(len(trash_paths), 1)
+    self.assertTrue(trash_paths[0].startswith('user-'))
+    trash_path = os.path.join(self.trash_dir, trash_paths[0])
+    self.assertEqual(
+        sorted(os.listdir(os.path.join(trash_path, 'home'))), ['.ssh', 'file'])
+    self.assertEqual(list(self.deleter.queue), [[trash_path, None]])
+    self.assertEqual(self.deleter.GetStats()['pending_dirs'], 1)
+    self.deleter.thread.start.assert_not_called()
+
+  def testTrashConcurrent(self):
+    home_dirs = [self.home_dir]
+    for name in ['user2', 'user3', 'user4']:
+      home_dir = os.path.join(self.temp_dir, name)
+      os.mkdir(home_dir)
+      home_dirs.append(home_dir)
+    barrier = threading.Event()
+    results = []
+
+    def _Trash(home_dir):
+      barrier.wait()
+      results.append(self.deleter.Trash(home_dir, os.getuid()))
+
+    # Every home directory is trashed while the trash directory is created.
+    threads = [
+        threading.Thread(target=_Trash, args=(home_dir,))
+        for home_dir in home_dirs]
+    for thread in threads:
+      thread.start()
+    barrier.set()
+    for thread in threads:
+      thread.join(5)
+    self.assertEqual(results, [True] * 4)
+    self.assertEqual(len(os.listdir(self.trash_dir)), 4)
+    self.assertEqual(len(self.deleter.queue), 4)
+
+  def testTrashDirCreated(self):
+    real_mkdir = os.mkdir
+
+    def _Mkdir(path, mode=0o777):
+      real_mkdir(path, mode)
+      if path == self.trash_dir:
+        # Another thread created the trash directory first.
+        raise OSError(errno.EEXIST, 'File exists')
+
+    with mock.patch.object(home_dir_deleter.os, 'mkdir', side_effect=_Mkdir):
+      self.assertTrue(self.deleter.Trash(self.home_dir, os.getuid()))
+    self.assertFalse(os.path.exists(self.home_dir))
+    self.assertEqual(len(self.deleter.queue), 1)
+
+  @mock.patch('google_compute_engine.accounts.home_dir_deleter.os.mkdir')
+  def testTrashMkdirError(self, mock_mkdir):
+    mock_mkdir.side_effect = OSError(errno.EACCES, 'Test Error')
+
+    with self.assertRaises(OSError):
+      self.deleter.Trash(self.home_dir, os.getuid())
+    self.assertTrue(os.path.isdir(self.home_dir))
+
+  def testTrashInvalid(self):
+    # The home directory is missing.
+    self.assertFalse(
+        self.deleter.Trash(os.path.join(self.temp_dir, 'missing'), 0))
+
+    # The home directory is owned by another user.
+    self.assertFalse(self.deleter.Trash(self.home_dir, os.getuid() + 1))
+
+    # Symbolic links are not followed.
+    link = os.path.join(self.temp_dir, 'link')
+    os.symlink(self.home_dir, link)
+    self.assertFalse(self.deleter.Trash(link, os.getuid()))
+    self.assertTrue(os.path.isdir(self.home_dir))
+    self.assertEqual(len(self.deleter.queue), 0)
+    self.assertEqual(self.mock_logger.warning.call_count, 2)
+
+  @mock.patch('google_compute_engine.accounts.home_dir_deleter.os.rename')
+  def testTrashError(self, mock_rename):
+    mock_rename.side_effect = OSError('Test Error')
+
+    with self.assertRaises(OSError):
+      self.deleter.Trash(self.home_dir, os.getuid())
+    self.assertEqual(os.listdir(self.trash_dir), [])
+    self.assertEqual(len(self.deleter.queue), 0)
+
+  def testRecover(self):
+    os.makedirs(os.path.join(self.trash_dir, 'b'))
+    os.makedirs(os.path.join(self.trash_dir, 'a'))
+
+    self.deleter.Recover(self.trash_dir)
+    self.assertEqual(
+        [path for path, _ in self.deleter.queue],
+        [os.path.join(self.trash_dir, 'a'), os.path.join(self.trash_dir, 'b')])
+    self.deleter.Recover(os.path.join(self.temp_dir, 'missing'))
+    self.assertEqual(len(self.deleter.queue), 2)
+
+  @mock.patch('google_compute_engine.accounts.home_dir_deleter.threading')
+  def testQueueStartsThread(self, mock_threading):
+    self.deleter.thread = None
+    self.deleter._Queue('a')
+    self.deleter._Queue('b')
+    mock_threading.Thread.assert_called_once_with(target=self.deleter._Run)
+    mock_threading.Thread().start.assert_called_once_with()
+
+  def testGetSize(self):
+    self.assertGreaterEqual(self.deleter._GetSize(self.home_dir), 100)
+
+  @mock.patch('google_compute_engine.accounts.home_dir_deleter.subprocess.check_call')
+  def testDelete(self, mock_call):
+    self.deleter._Delete(self.home_dir)
+    mock_call.assert_called_once_with([
+        'ionice', '-c', '3', 'nice', '-n', '19',
+        'rm', '-rf', '--one-file-system', self.home_dir,
+    ])
+    self.assertTrue(os.path.exists(self.home_dir))
+
+    # Fall back to deleting in the thread when ionice is not installed.
+    mock_call.side_effect = OSError('Test Error')
+    self.deleter._Delete(self.home_dir)
+    self.assertFalse(os.path.exists(self.home_dir))
+
+  def testDeleteNext(self):
+    self.deleter.Trash(self.home_dir, os.getuid())
+    self.deleter._Delete = mock.Mock()
+
+    self.deleter._DeleteNext()
+    self.deleter._Delete.assert_called_once_with(mock.ANY)
+    stats = self.deleter.GetStats()
+    self.assertEqual(stats['pending_dirs'], 0)
+    self.assertEqual(stats['pending_bytes'], 0)
+    self.assertEqual(stats['deleted_dirs'], 1)
+    self.assertGreaterEqual(stats['deleted_bytes'], 100)
+    self.assertEqual(len(self.deleter.queue), 0)
+    self.mock_logger.info.assert_called_once_with(
+        mock.ANY, mock.ANY, stats['deleted_bytes'], mock.ANY, 0)
+
+  def testDeleteNextError(self):
+    self.deleter.Trash(self.home_dir, os.getuid())
+    self.deleter._Delete = mock.Mock()
+    self.deleter._Delete.side_effect = subprocess.CalledProcessError(1, 'rm')
+
+    self.deleter._DeleteNext()
+    stats = self.deleter.GetStats()
+    self.assertEqual(stats['pending_dirs'], 0)
+    self.assertEqual(stats['pending_bytes'], 0)
+    self.assertEqual(stats['deleted_dirs'], 0)
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for nss_cache_utils.py module."""
+
+import json
+import os
+import pwd
+import shutil
+import stat
+import tempfile
+import threading
+
+from google_compute_engine.accounts import accounts_index
+from google_compute_engine.accounts import nss_cache_utils
+from google_compute_engine.test_compat import mock
+from google_compute_engine.test_compat import unittest
+
+PASSWD = [
+    'root:x:0:0:root:/root:/bin/bash',
+    'local:x:5000:5000::/home/local:/bin/bash',
+]
+GROUP = [
+    'root:x:0:',
+    'adm:x:4:local',
+    'local:x:5000:',
+    'google-sudoers:x:1001:',
+]
+
+
+class NssCacheUtilsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.passwd_file = os.path.join(self.test_dir, 'passwd')
+    self.group_file = os.path.join(self.test_dir, 'group')
+    self._WriteFile(self.passwd_file, PASSWD)
+    self._WriteFile(self.group_file, GROUP)
+    self.mock_logger = mock.Mock()
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _WriteFile(self, path, lines):
+    with open(path, 'w') as database:
+      database.write(''.join(line + '\n' for line in lines))
+
+  def _ReadFile(self, path):
+    with open(path) as database:
+      return database.read().splitlines()
+
+  def _CreateUtils(self, groups='adm', remove=False):
+    index = accounts_index.AccountsIndex(
+        passwd_file=self.passwd_file, group_file=self.group_file)
+    with mock.patch(
+        'google_compute_engine.accounts.accounts_utils.accounts_index'
+    ) as mock_index:
+      mock_index.AccountsIndex.return_value = index
+      with mock.patch(
+          'google_compute_engine.accounts.accounts_utils.AccountsUtils.'
+          '_CreateSudoersGroup'):
+        with mock.patch.object(
+            nss_cache_utils.NssCacheUtils, '_LoadCache'):
+          with mock.patch(
+              'google_compute_engine.accounts.accounts_utils.home_dir_deleter'):
+            utils = nss_cache_utils.NssCacheUtils(
+                logger=self.mock_logger, groups=groups, remove=remove,
+                cache_dir=self.test_dir)
+    utils.google_users_dir = os.path.join(self.test_dir, 'google')
+    utils.google_uids_file = os.path.join(
+        utils.google_users_dir, 'google_uids.json')
+    utils._LoadCache()
+    return utils
+
+  def testNssCacheUtils(self):
+    utils = self._CreateUtils(groups='adm,missing')
+    self.assertEqual(utils.groups, ['adm', 'google-sudoers'])
+    self.assertEqual(utils.cache_users, {})
+    self.assertFalse(utils.dirty)
+
+  def testAddUser(self):
+    utils = self._CreateUtils()
+    self.assertTrue(utils._AddUser('user'))
+    pw_entry = utils._GetUser('user')
+    self.assertEqual(pw_entry.pw_uid, 5001)
+    self.assertEqual(pw_entry.pw_gid, 5001)
+    self.assertEqual(pw_entry.pw_dir, '/home/user')
+    self.assertTrue(utils.dirty)
+    self.assertEqual(utils._GetUser('local').pw_uid, 5000)
+
+  def testAllocateUid(self):
+    utils = self._CreateUtils()
+    utils.uids = {'old': 5003}
+    self.assertEqual(utils._AllocateUid('old'), 5003)
+    self.assertEqual(utils._AllocateUid('new'), 5004)
+    self.assertEqual(utils.uids, {'old': 5003, 'new': 5004})
+
+  def testAllocateUidExhausted(self):
+    utils = self._CreateUtils()
+    utils.uids = {'last': nss_cache_utils.UID_MAX}
+    self.assertIsNone(utils._AllocateUid('user'))
+    self.assertFalse(utils._AddUser('user'))
+    self.assertIsNone(utils._GetUser('user'))
+
+  def testUpdateUserGroups(self):
+    utils = self._CreateUtils()
+    utils._AddUser('user')
+    utils.cache_members = {'video': set(['user', 'other'])}
+    self.assertTrue(utils._UpdateUserGroups('user', ['adm']))
+    self.assertEqual(
+        utils.cache_members, {'video': set(['other']), 'adm': set(['user'])})
+    self.assertEqual(utils._GetGroup('adm').gr_mem, ['local', 'user'])
+    self.assertEqual(utils._GetGroup('root').gr_mem, [])
+    self.assertIsNone(utils._GetGroup('missing'))
+
+  def testUpdateUserGroupsLocal(self):
+    utils = self._CreateUtils()
+    with mock.patch(
+        'google_compute_engine.accounts.accounts_utils.AccountsUtils.'
+        '_UpdateUserGroups') as mock_update:
+      mock_update.return_value = True
+      self.assertTrue(utils._UpdateUserGroups('local', ['adm']))
+      mock_update.assert_called_once_with('local', ['adm'])
+    self.assertEqual(utils.cache_members, {})
+
+  def testUpdateGroups(self):
+    utils = self._CreateUtils()
+    utils._AddUser('user')
+    with mock.patch(
+        'google_compute_engine.accounts.accounts_utils.AccountsUtils.'
+        'UpdateGroups') as mock_update:
+      mock_update.return_value = True
+      self.assertTrue(utils.UpdateGroups(['local', 'user']))
+      mock_update.assert_called_once_with(['local'])
+    self.assertEqual(
+        utils.cache_members,
+        {'adm': set(['user']), 'google-sudoers': set(['user'])})
+
+  @mock.patch('google_compute_engine.accounts.accounts_utils.subprocess.check_call')
+  def testUpdateGroupsLocalChanged(self, mock_call):
+    utils = self._CreateUtils()
+    utils._AddUser('user')
+    utils._UpdateUserGroups('user', utils.groups)
+
+    # A local user with different groups is updated without a deadlock.
+    thread = threading.Thread(
+        target=utils.UpdateGroups, args=(['local', 'user'],))
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    # The cached members are not written to the group file.
+    mock_call.assert_called_once_with(
+        ['gpasswd', '-M', 'local', 'google-sudoers'])
+
+  def testRemoveUser(self):
+    utils = self._CreateUtils(remove=True)
+    utils._AddUser('user')
+    utils._UpdateUserGroups('user', ['adm'])
+    utils.dirty = False
+    with mock.patch.object(utils, '_RemoveAuthorizedKeys') as mock_remove:
+      with mock.patch.object(utils, '_TrashHomeDir') as mock_trash:
+        utils.RemoveUser('user')
+        mock_remove.assert_called_once_with('user')
+        mock_trash.assert_called_once_with('user', mock.ANY)
+        self.assertEqual(mock_trash.call_args[0][1].pw_dir, '/home/user')
+    self.assertIsNone(utils._GetUser('user'))
+    self.assertEqual(utils.cache_members, {'adm': set()})
+    self.assertEqual(utils.uids, {'user': 5001})
+    self.assertTrue(utils.dirty)
+
+  def testAddUserInvalid(self):
+    utils = self._CreateUtils()
+    for user in ['.', '..', '.user', '1user', 'a/b', 'u' * 33]:
+      self.assertFalse(utils._AddUser(user))
+    self.assertEqual(utils.cache_users, {})
+    self.assertFalse(utils.dirty)
+
+  def testGetHomeDir(self):
+    utils = self._CreateUtils()
+    self.assertEqual(utils._GetHomeDir('user'), '/home/user')
+    self.assertIsNone(utils._GetHomeDir('..'))
+    self.assertIsNone(utils._GetHomeDir('.'))
+    self.assertIsNone(utils._GetHomeDir('a/b'))
+
+  def testTrashHomeDir(self):
+    utils = self._CreateUtils(remove=True)
+    utils.deleter = mock.Mock()
+    pw_entry = pwd.struct_passwd(('user', 'x', 1, 1, '', '/home/user', ''))
+    utils._TrashHomeDir('user', pw_entry)
+    utils.deleter.Trash.assert_called_once_with('/home/user', 1)
+
+    # Home directories outside of /home are never deleted.
+    utils.deleter.reset_mock()
+    utils._TrashHomeDir('..', pwd.struct_passwd(
+        ('..', 'x', 1, 1, '', '/home/..', '')))
+    utils._TrashHomeDir('user', pwd.struct_passwd(
+        ('user', 'x', 1, 1, '', '/', '')))
+    utils.deleter.Trash.assert_not_called()
+    self.assertEqual(self.mock_logger.warning.call_count, 2)
+
+  def testRemoveUserLocal(self):
+    utils = self._CreateUtils()
+    with mock.patch(
+        'google_compute_engine.accounts.accounts_utils.AccountsUtils.'
+        'RemoveUser') as mock_remove:
+      utils.RemoveUser('local')
+      mock_remove.assert_called_once_with('local')
+    self.assertFalse(utils.dirty)
+
+  def testFlush(self):
+    utils = self._CreateUtils()
+    utils._AddUser('user')
+    utils._AddUser('admin')
+    utils._UpdateUserGroups('user', ['adm'])
+    utils._UpdateUserGroups('admin', ['adm', 'google-sudoers'])
+    utils.Flush()
+
+    passwd_cache_file = os.path.join(self.test_dir, 'passwd.cache')
+    group_cache_file = os.path.join(self.test_dir, 'group.cache')
+    self.assertEqual(self._ReadFile(passwd_cache_file), [
+        'admin:x:5002:5002::/home/admin:/bin/bash',
+        'user:x:5001:5001::/home/user:/bin/bash',
+    ])
+    self.assertEqual(self._ReadFile(group_cache_file), [
+        'adm:x:4:admin,user',
+        'admin:x:5002:',
+        'google-sudoers:x:1001:admin',
+        'user:x:5001:',
+    ])
+    self.assertEqual(
+        stat.S_IMODE(os.stat(passwd_cache_file).st_mode), 0o644)
+    self.assertEqual(
+        stat.S_IMODE(os.stat(utils.google_uids_file).st_mode), 0o600)
+    with open(utils.google_uids_file) as uids_file:
+      self.assertEqual(json.load(uids_file), {'user': 5001, 'admin': 5002})
+    self.assertFalse(utils.dirty)
+
+    # The caches are reloaded when the daemon restarts.
+    utils = self._CreateUtils()
+    self.assertEqual(utils._GetUser('user').pw_uid, 5001)
+    self.assertEqual(utils.cache_members['adm'], set(['admin', 'user']))
+    self.assertEqual(utils._AllocateUid('new'), 5003)
+
+  def testFlushUnchanged(self):
+    utils = self._CreateUtils()
+    with mock.patch.object(utils, '_WriteCacheFile') as mock_write:
+      utils.Flush()
+      mock_write.assert_not_called()
+
+  def testFlushError(self):
+    utils = self._CreateUtils()
+    utils._AddUser('user')
+    utils.group_cache_file = os.path.join(self.test_dir, 'missing', 'group')
+    with self.assertRaises((IOError, OSError)):
+      utils.Flush()
+    self.assertTrue(utils.dirty)
+    self.assertEqual(
+        sorted(os.listdir(self.test_dir)), ['group', 'passwd', 'passwd.cache'])
+
+
+if __name__ == '__main__':
+  unittest.main()
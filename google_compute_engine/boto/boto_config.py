@@ -49,7 +49,9 @@ class BotoConfig(object):
       project_id: string, the project ID to use in the config file.
     """
     self.logger = logger.Logger(name='boto-setup')
-    self.watcher = metadata_watcher.MetadataWatcher(logger=self.logger)
+    cache = metadata_watcher.MetadataCache(logger=self.logger)
+    self.watcher = metadata_watcher.MetadataWatcher(
+        logger=self.logger, cache=cache)
     self._CreateConfig(project_id)
 
   def _GetNumericProjectId(self):
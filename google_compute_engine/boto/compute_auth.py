@@ -15,7 +15,14 @@
 
 """Authentication module for using Google Compute service accounts."""
 
+import json
+import os
+import re
+import threading
+import time
+
 from boto import auth_handler
+from google_compute_engine import file_utils
 from google_compute_engine import logger
 from google_compute_engine import metadata_watcher
 
@@ -36,8 +43,22 @@ class ComputeAuth(auth_handler.AuthHandler):
 
   capability = ['google-oauth2', 's3']
 
+  # Access tokens are refreshed this many seconds before they expire.
+  token_expiry_margin = 60
+
+  # Scopes and access tokens are shared by all handlers in the process.
+  scopes_cache = {}
+  token_cache = {}
+  token_lock = threading.Lock()
+
+  # Access tokens are shared with other processes of the same user through a
+  # file in this directory. The default is a per user directory under /run.
+  token_cache_dir = None
+
   def __init__(self, path, config, provider):
     self.logger = logger.Logger(name='compute-auth')
+    # The shared metadata snapshot cache is not used, so access tokens never
+    # land in a snapshot readable by other tools.
     self.watcher = metadata_watcher.MetadataWatcher(logger=self.logger)
     self.service_account = config.get('GoogleCompute', 'service_account', '')
     self.scopes = None
@@ -48,15 +69,109 @@ class ComputeAuth(auth_handler.AuthHandler):
 
   def _GetGsScopes(self):
     """Return all Google Storage scopes available on this VM."""
+    if self.service_account in self.scopes_cache:
+      return self.scopes_cache[self.service_account]
     scopes_key = 'instance/service-accounts/%s/scopes' % self.service_account
     scopes = self.watcher.GetMetadata(metadata_key=scopes_key, recursive=False)
-    return list(GS_SCOPES.intersection(set(scopes))) if scopes else None
+    scopes = list(GS_SCOPES.intersection(set(scopes))) if scopes else None
+    if scopes:
+      self.scopes_cache[self.service_account] = scopes
+    return scopes
 
-  def _GetAccessToken(self):
-    """Return an oauth2 access token for Google Storage."""
+  def _GetCachedAccessToken(self):
+    """Return a cached oauth2 access token that is not about to expire."""
+    token, expiry = self.token_cache.get(self.service_account, (None, 0))
+    if token and time.time() < expiry - self.token_expiry_margin:
+      return token
+    return None
+
+  def _GetTokenCacheFile(self):
+    """Return the location of the token cache file of the current user."""
+    uid = os.getuid()
+    cache_dir = self.token_cache_dir
+    if not cache_dir:
+      cache_dir = '/run' if uid == 0 else '/run/user/%d' % uid
+    name = re.sub(r'[^\w.@-]', '_', self.service_account)
+    return os.path.join(cache_dir, 'google_compute_auth_%s.json' % name)
+
+  def _ReadTokenCacheFile(self, cache_file):
+    """Return the access token and expiry time stored in the token cache.
+
+    Args:
+      cache_file: string, the location of the token cache file.
+
+    Returns:
+      tuple, the access token and its expiry time or None and 0 if not cached.
+    """
+    try:
+      with open(cache_file) as cache_fp:
+        stat = os.fstat(cache_fp.fileno())
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+          self.logger.warning(
+              'Ignoring token cache %s with unsafe permissions.', cache_file)
+          return None, 0
+        cache = json.load(cache_fp)
+      return cache['access_token'], float(cache['expiry'])
+    except (IOError, OSError, KeyError, TypeError, ValueError):
+      return None, 0
+
+  def _WriteTokenCacheFile(self, cache_file, token, expiry):
+    """Store an access token and its expiry time in the token cache.
+
+    Args:
+      cache_file: string, the location of the token cache file.
+      token: string, the oauth2 access token.
+      expiry: float, the time the access token expires.
+    """
+    try:
+      file_utils.WriteFile(
+          cache_file, json.dumps({'access_token': token, 'expiry': expiry}),
+          mode=0o600, sync=False)
+    except (IOError, OSError) as e:
+      self.logger.debug('Could not cache the access token. %s.', str(e))
+
+  def _RefreshAccessToken(self, cache_file=None):
+    """Return an access token from the token cache or the metadata server.
+
+    Args:
+      cache_file: string, the location of the token cache file or None.
+
+    Returns:
+      string, the oauth2 access token or None if unavailable.
+    """
+    if cache_file:
+      token, expiry = self._ReadTokenCacheFile(cache_file)
+      if token and time.time() < expiry - self.token_expiry_margin:
+        self.token_cache[self.service_account] = (token, expiry)
+        return token
     token_key = 'instance/service-accounts/%s/token' % self.service_account
     token = self.watcher.GetMetadata(metadata_key=token_key, recursive=False)
-    return token['access_token'] if token else None
+    if not token:
+      return None
+    expiry = time.time() + int(token.get('expires_in', 0))
+    self.token_cache[self.service_account] = (token['access_token'], expiry)
+    if cache_file:
+      self._WriteTokenCacheFile(cache_file, token['access_token'], expiry)
+    return token['access_token']
+
+  def _GetAccessToken(self):
+    """Return an oauth2 access token for Google Storage."""
+    token = self._GetCachedAccessToken()
+    if token:
+      return token
+    # Only one thread refreshes the token while the others wait for it.
+    with self.token_lock:
+      token = self._GetCachedAccessToken()
+      if token:
+        return token
+      # Only one process refreshes the token shared through the token cache.
+      cache_file = self._GetTokenCacheFile()
+      try:
+        with file_utils.LockFile(cache_file + '.lock', blocking=True):
+          return self._RefreshAccessToken(cache_file)
+      except (IOError, OSError) as e:
+        self.logger.debug('Could not use the token cache. %s.', str(e))
+        return self._RefreshAccessToken()
 
   def add_auth(self, http_request):
     http_request.headers['Authorization'] = 'OAuth %s' % self._GetAccessToken()
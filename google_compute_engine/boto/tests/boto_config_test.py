@@ -47,7 +47,10 @@ class BotoConfigTest(unittest.TestCase):
     boto_config.BotoConfig(self.project_id)
     expected_calls = [
         mock.call.logger.Logger(name=mock.ANY),
-        mock.call.watcher.MetadataWatcher(logger=mock_logger_instance),
+        mock.call.watcher.MetadataCache(logger=mock_logger_instance),
+        mock.call.watcher.MetadataWatcher(
+            logger=mock_logger_instance,
+            cache=mock_watcher.MetadataCache.return_value),
         mock.call.config(
             config_file='template', config_header='/tmp/test.py template'),
         mock.call.set('GSUtil', 'default_project_id', self.project_id),
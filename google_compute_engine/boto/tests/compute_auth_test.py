@@ -15,6 +15,11 @@
 
 """Unittest for compute_auth.py module."""
 
+import json
+import os
+import shutil
+import tempfile
+
 from google_compute_engine.boto import compute_auth
 from google_compute_engine.test_compat import mock
 from google_compute_engine.test_compat import unittest
@@ -28,6 +33,16 @@ class ComputeAuthTest(unittest.TestCase):
     self.mock_config.get.return_value = self.service_account
     self.mock_provider = mock.Mock()
     self.mock_provider.name = 'google'
+    compute_auth.ComputeAuth.scopes_cache = {}
+    compute_auth.ComputeAuth.token_cache = {}
+    self.temp_dir = tempfile.mkdtemp()
+    compute_auth.ComputeAuth.token_cache_dir = self.temp_dir
+    self.cache_file = os.path.join(
+        self.temp_dir, 'google_compute_auth_service_account.json')
+
+  def tearDown(self):
+    compute_auth.ComputeAuth.token_cache_dir = None
+    shutil.rmtree(self.temp_dir)
 
   @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
   @mock.patch('google_compute_engine.boto.compute_auth.logger')
@@ -81,6 +96,132 @@ class ComputeAuthTest(unittest.TestCase):
     ]
     self.assertEqual(mock_watcher.GetMetadata.mock_calls, expected_calls)
 
+  @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
+  def testGetGsScopesCache(self, mock_watcher):
+    scopes = list(compute_auth.GS_SCOPES)[1:2]
+    mock_watcher.MetadataWatcher.return_value = mock_watcher
+    mock_watcher.GetMetadata.return_value = scopes
+
+    compute_auth.ComputeAuth(None, self.mock_config, self.mock_provider)
+    mock_compute_auth = compute_auth.ComputeAuth(
+        None, self.mock_config, self.mock_provider)
+    self.assertEqual(mock_compute_auth.scopes, scopes)
+    self.assertEqual(mock_watcher.GetMetadata.call_count, 1)
+
+  @mock.patch('google_compute_engine.boto.compute_auth.time')
+  @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
+  def testGetAccessTokenCache(self, mock_watcher, mock_time):
+    mock_time.time.return_value = 1000
+    mock_watcher.MetadataWatcher.return_value = mock_watcher
+    mock_watcher.GetMetadata.side_effect = [
+        list(compute_auth.GS_SCOPES),  # The Google Storage scopes.
+        {'access_token': 'token', 'expires_in': 3600},
+        {'access_token': 'refreshed', 'expires_in': 3600},
+    ]
+    mock_compute_auth = compute_auth.ComputeAuth(
+        None, self.mock_config, self.mock_provider)
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'token')
+
+    # The token is reused until shortly before it expires.
+    mock_time.time.return_value = 4539
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'token')
+    mock_time.time.return_value = 4540
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'refreshed')
+    self.assertEqual(mock_watcher.GetMetadata.call_count, 3)
+
+  @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
+  def testGetAccessTokenConcurrent(self, mock_watcher):
+    mock_watcher.MetadataWatcher.return_value = mock_watcher
+    mock_watcher.GetMetadata.return_value = list(compute_auth.GS_SCOPES)
+    mock_compute_auth = compute_auth.ComputeAuth(
+        None, self.mock_config, self.mock_provider)
+    token = {'access_token': 'token', 'expires_in': 3600}
+    mock_watcher.GetMetadata.side_effect = (
+        lambda **_: compute_auth.time.sleep(0.1) or token)
+    tokens = []
+    threads = [
+        compute_auth.threading.Thread(
+            target=lambda: tokens.append(mock_compute_auth._GetAccessToken()))
+        for _ in range(5)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # A single thread fetches the token for all the others.
+    self.assertEqual(tokens, ['token'] * 5)
+    self.assertEqual(mock_watcher.GetMetadata.call_count, 2)
+
+  @mock.patch('google_compute_engine.boto.compute_auth.os.getuid')
+  def testGetTokenCacheFile(self, mock_getuid):
+    mock_compute_auth = mock.create_autospec(compute_auth.ComputeAuth)
+    mock_compute_auth.service_account = 'a@b.com/../c'
+    mock_compute_auth.token_cache_dir = None
+    mock_getuid.return_value = 0
+    self.assertEqual(
+        compute_auth.ComputeAuth._GetTokenCacheFile(mock_compute_auth),
+        '/run/google_compute_auth_a@b.com_.._c.json')
+    mock_getuid.return_value = 1000
+    self.assertEqual(
+        compute_auth.ComputeAuth._GetTokenCacheFile(mock_compute_auth),
+        '/run/user/1000/google_compute_auth_a@b.com_.._c.json')
+
+  @mock.patch('google_compute_engine.boto.compute_auth.time')
+  @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
+  def testGetAccessTokenShared(self, mock_watcher, mock_time):
+    mock_time.time.return_value = 1000
+    mock_watcher.MetadataWatcher.return_value = mock_watcher
+    mock_watcher.GetMetadata.side_effect = [
+        list(compute_auth.GS_SCOPES),  # The Google Storage scopes.
+        {'access_token': 'token', 'expires_in': 3600},
+    ]
+    mock_compute_auth = compute_auth.ComputeAuth(
+        None, self.mock_config, self.mock_provider)
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'token')
+    self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+    with open(self.cache_file) as cache_fp:
+      self.assertEqual(
+          json.load(cache_fp), {'access_token': 'token', 'expiry': 4600})
+
+    # Another process reads the access token from the token cache.
+    compute_auth.ComputeAuth.token_cache = {}
+    mock_time.time.return_value = 2000
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'token')
+    self.assertEqual(mock_watcher.GetMetadata.call_count, 2)
+
+  @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
+  def testGetAccessTokenSharedUnsafe(self, mock_watcher):
+    mock_watcher.MetadataWatcher.return_value = mock_watcher
+    mock_watcher.GetMetadata.side_effect = [
+        list(compute_auth.GS_SCOPES),  # The Google Storage scopes.
+        {'access_token': 'token', 'expires_in': 3600},
+    ]
+    with open(self.cache_file, 'w') as cache_fp:
+      json.dump({'access_token': 'unsafe', 'expiry': 1e10}, cache_fp)
+    os.chmod(self.cache_file, 0o644)
+    mock_compute_auth = compute_auth.ComputeAuth(
+        None, self.mock_config, self.mock_provider)
+    mock_compute_auth.logger = mock.Mock()
+
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'token')
+    self.assertEqual(mock_compute_auth.logger.warning.call_count, 1)
+
+  @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
+  def testGetAccessTokenSharedUnavailable(self, mock_watcher):
+    compute_auth.ComputeAuth.token_cache_dir = os.path.join(
+        self.temp_dir, 'missing')
+    mock_watcher.MetadataWatcher.return_value = mock_watcher
+    mock_watcher.GetMetadata.side_effect = [
+        list(compute_auth.GS_SCOPES),  # The Google Storage scopes.
+        {'access_token': 'token', 'expires_in': 3600},
+    ]
+    mock_compute_auth = compute_auth.ComputeAuth(
+        None, self.mock_config, self.mock_provider)
+
+    self.assertEqual(mock_compute_auth._GetAccessToken(), 'token')
+    self.assertEqual(mock_watcher.GetMetadata.call_count, 2)
+
   @mock.patch('google_compute_engine.boto.compute_auth.metadata_watcher')
   def testAddAuth(self, mock_watcher):
     mock_request = mock.Mock()
@@ -22,14 +22,20 @@ if sys.version_info >= (3,):
   # Python 3 imports.
   import configparser as parser
   import http.client as httpclient
+  import http.server as httpserver
+  import io as stringio
+  import socketserver
   import urllib.error as urlerror
   import urllib.parse as urlparse
   import urllib.request as urlrequest
   import urllib.request as urlretrieve
 else:
   # Python 2 imports.
+  import BaseHTTPServer as httpserver
   import ConfigParser as parser
   import httplib as httpclient
+  import SocketServer as socketserver
+  import StringIO as stringio
   import urllib as urlparse
   import urllib as urlretrieve
   import urllib2 as urlrequest
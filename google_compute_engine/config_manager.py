@@ -20,6 +20,7 @@ import textwrap
 
 from google_compute_engine import file_utils
 from google_compute_engine.compat import parser
+from google_compute_engine.compat import stringio
 
 CONFIG = '/etc/default/instance_configs.cfg'
 
@@ -94,7 +95,7 @@ class ConfigManager(object):
     self.config.set(section, option, str(value))
 
   def WriteConfig(self, config_file=None):
-    """Write the config values to a given file.
+    """Write the config values to a given file, if they changed.
 
     Args:
       config_file: string, the file location of the config file to write.
@@ -102,8 +103,9 @@ class ConfigManager(object):
     config_file = config_file or self.config_file
     config_name = os.path.splitext(os.path.basename(config_file))[0]
     config_lock = '/var/lock/google_%s.lock' % config_name
+    config_fp = stringio.StringIO()
+    if self.config_header:
+      self._AddHeader(config_fp)
+    self.config.write(config_fp)
     with file_utils.LockFile(config_lock):
-      with open(config_file, 'w') as config_fp:
-        if self.config_header:
-          self._AddHeader(config_fp)
-        self.config.write(config_fp)
+      file_utils.WriteFile(config_file, config_fp.getvalue())
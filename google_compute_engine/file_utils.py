@@ -13,20 +13,138 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A library providing file utilities for setting permissions and locking."""
+"""A library providing file utilities for writing, permissions and locking."""
 
 import contextlib
 import errno
 import fcntl
+import hashlib
 import os
+import stat
 import subprocess
+import tempfile
+import threading
+
+try:
+  import selinux
+except ImportError:
+  selinux = None
+
+RESTORECON = '/sbin/restorecon'
+# The maximum number of paths passed to one restorecon command.
+RESTORECON_MAX_PATHS = 1000
+
+
+class _SELinuxRelabeler(object):
+  """Set SELinux contexts, deferring restorecon while a batch is open."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.batches = 0
+    self.paths = []
+    self.restorecon = None
+
+  def _HasRestorecon(self):
+    """Check once whether restorecon is installed.
+
+    Returns:
+      bool, True if restorecon can be executed.
+    """
+    if self.restorecon is None:
+      self.restorecon = bool(
+          os.path.isfile(RESTORECON) and os.access(RESTORECON, os.X_OK))
+    return self.restorecon
+
+  def _RunRestorecon(self, paths):
+    """Run restorecon on a list of paths, as few times as possible.
+
+    Args:
+      paths: list, the paths on which to fix the SELinux context.
+    """
+    for index in range(0, len(paths), RESTORECON_MAX_PATHS):
+      subprocess.call([RESTORECON] + paths[index:index + RESTORECON_MAX_PATHS])
+
+  def LabelFile(self, fd, path, mode):
+    """Give an open file the SELinux context of the path it will replace.
+
+    Args:
+      fd: int, the file descriptor of the open file.
+      path: string, the path the file will be renamed to.
+      mode: int, the file type and permissions of the file.
+
+    Returns:
+      bool, True if the path does not need to be relabeled after the rename.
+    """
+    if not selinux:
+      return False
+    if selinux.is_selinux_enabled() > 0:
+      try:
+        selinux.fsetfilecon(fd, selinux.matchpathcon(path, mode)[1])
+      except OSError:
+        pass
+    return True
+
+  def Relabel(self, path):
+    """Set the SELinux context of a path, or defer it until the batch ends.
+
+    Args:
+      path: string, the path on which to fix the SELinux context.
+    """
+    if selinux:
+      if selinux.is_selinux_enabled() > 0:
+        try:
+          selinux.restorecon(path)
+        except OSError:
+          pass
+      return
+    if not self._HasRestorecon():
+      return
+    with self.lock:
+      if self.batches:
+        self.paths.append(path)
+        return
+    self._RunRestorecon([path])
+
+  @contextlib.contextmanager
+  def Batch(self):
+    """Defer restorecon until the outermost batch ends.
+
+    Yields:
+      None, yields while relabels are deferred.
+    """
+    with self.lock:
+      self.batches += 1
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.batches -= 1
+        paths = []
+        if not self.batches:
+          paths, self.paths = self.paths, []
+      # Each path is relabeled once, in the order it was first changed.
+      seen = set()
+      unique_paths = []
+      for path in paths:
+        if path not in seen:
+          seen.add(path)
+          unique_paths.append(path)
+      if unique_paths:
+        self._RunRestorecon(unique_paths)
+
+
+_relabeler = _SELinuxRelabeler()
+_write_lock = threading.Lock()
+_write_stats = {'skipped': 0, 'written': 0}
 
 
 def _SetSELinuxContext(path):
   """Set the appropriate SELinux context, if SELinux tools are installed.
 
-  Calls /sbin/restorecon on the provided path to set the SELinux context as
-  specified by policy. This call does not operate recursively.
+  Uses libselinux when its Python bindings are installed. Otherwise calls
+  /sbin/restorecon on the provided path to set the SELinux context as
+  specified by policy. Inside BatchSELinuxContext, the path is relabeled
+  when the batch ends. This call does not operate recursively.
 
   Only some OS configurations use SELinux. It is therefore acceptable for
   restorecon to be missing, in which case we do nothing.
@@ -34,14 +152,28 @@ def _SetSELinuxContext(path):
   Args:
     path: string, the path on which to fix the SELinux context.
   """
-  restorecon = '/sbin/restorecon'
-  if os.path.isfile(restorecon) and os.access(restorecon, os.X_OK):
-    subprocess.call([restorecon, path])
+  _relabeler.Relabel(path)
+
+
+def BatchSELinuxContext():
+  """Relabel every path changed inside the block with one restorecon call.
+
+  Batches may be nested and opened from several threads. The paths are
+  relabeled when the outermost batch ends.
+
+  Returns:
+    context manager, deferring SELinux relabels until it exits.
+  """
+  return _relabeler.Batch()
 
 
 def SetPermissions(path, mode=None, uid=None, gid=None, mkdir=False):
   """Set the permissions and ownership of a path.
 
+  The path is checked first and only the attributes that differ are changed.
+  The SELinux context is set when the path is created or changed, or when no
+  mode or owner is given.
+
   Args:
     path: string, the path for which owner ID and group ID needs to be setup.
     mode: octal string, the permissions to set on the path.
@@ -49,13 +181,141 @@ def SetPermissions(path, mode=None, uid=None, gid=None, mkdir=False):
     gid: int, the group ID to be set for the path.
     mkdir: bool, True if the directory needs to be created.
   """
+  set_owner = bool(uid and gid)
+  changed = not (mode or set_owner)
+  path_stat = None
   if mkdir and not os.path.exists(path):
     os.mkdir(path, mode or 0o777)
-  elif mode:
+    changed = True
+  elif mode or set_owner:
+    path_stat = os.stat(path)
+  if mode and path_stat and stat.S_IMODE(path_stat.st_mode) != mode:
     os.chmod(path, mode)
-  if uid and gid:
+    changed = True
+  if set_owner and (
+      not path_stat or (path_stat.st_uid, path_stat.st_gid) != (uid, gid)):
     os.chown(path, uid, gid)
-  _SetSELinuxContext(path)
+    changed = True
+  if changed:
+    _SetSELinuxContext(path)
+
+
+def _ToBytes(contents):
+  """Encode text contents as UTF-8.
+
+  Args:
+    contents: string or bytes, the file contents.
+
+  Returns:
+    bytes, the encoded file contents.
+  """
+  if isinstance(contents, bytes):
+    return contents
+  return contents.encode('utf-8')
+
+
+def _IsCurrent(path, contents, mode, uid, gid):
+  """Check whether a file already has the given contents and attributes.
+
+  The file is opened without following a symbolic link, and a file with
+  several hard links is never considered current, so it is always replaced
+  rather than changed.
+
+  Args:
+    path: string, the path of the file.
+    contents: bytes, the file contents.
+    mode: int, the permissions the file should have, or None.
+    uid: int, the owner ID the file should have, or None.
+    gid: int, the group ID the file should have, or None.
+
+  Returns:
+    tuple, True if the file is current, and the stat of the file or None.
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+  except (IOError, OSError):
+    return False, None
+  with os.fdopen(fd, 'rb') as current_file:
+    path_stat = os.fstat(current_file.fileno())
+    if (not stat.S_ISREG(path_stat.st_mode) or path_stat.st_nlink != 1 or
+        path_stat.st_size != len(contents)):
+      return False, path_stat
+    if mode is not None and stat.S_IMODE(path_stat.st_mode) != mode:
+      return False, path_stat
+    if uid is not None and (path_stat.st_uid, path_stat.st_gid) != (uid, gid):
+      return False, path_stat
+    digest = hashlib.sha256(current_file.read()).hexdigest()
+  return digest == hashlib.sha256(contents).hexdigest(), path_stat
+
+
+def WriteFile(path, contents, mode=None, uid=None, gid=None, sync=True):
+  """Atomically replace a file, unless it already has the contents.
+
+  The contents are written to a temporary file in the same directory, which
+  gets its permissions, owner and SELinux context through its file
+  descriptor, and is then renamed in place. Readers see either the old or the
+  new file, never a partial one.
+
+  Args:
+    path: string, the path of the file.
+    contents: string or bytes, the file contents.
+    mode: int, the permissions of the file, or None to keep the permissions of
+        an existing file, else 0o644.
+    uid: int, the owner ID of the file, or None to use the current user.
+    gid: int, the group ID of the file, used when a uid is given.
+    sync: bool, True if the file should be on disk before it is renamed.
+
+  Returns:
+    bool, True if the file was written, False if it was already current.
+
+  Raises:
+    IOError, raised when there is an exception writing the file.
+    OSError, raised when there is an exception replacing the file.
+  """
+  contents = _ToBytes(contents)
+  current, path_stat = _IsCurrent(path, contents, mode, uid, gid)
+  if current:
+    with _write_lock:
+      _write_stats['skipped'] += 1
+    return False
+
+  if mode is None:
+    mode = stat.S_IMODE(path_stat.st_mode) if path_stat else 0o644
+  directory, name = os.path.split(path)
+  fd, temp_path = tempfile.mkstemp(prefix='.%s-' % name, dir=directory or '.')
+  try:
+    with os.fdopen(fd, 'wb') as temp_file:
+      temp_file.write(contents)
+      temp_file.flush()
+      os.fchmod(temp_file.fileno(), mode)
+      if uid is not None:
+        os.fchown(temp_file.fileno(), uid, gid)
+      labeled = _relabeler.LabelFile(
+          temp_file.fileno(), path, stat.S_IFREG | mode)
+      if sync:
+        os.fsync(temp_file.fileno())
+    os.rename(temp_path, path)
+  except (IOError, OSError):
+    if os.path.lexists(temp_path):
+      os.remove(temp_path)
+    raise
+
+  if not labeled:
+    _SetSELinuxContext(path)
+  with _write_lock:
+    _write_stats['written'] += 1
+  return True
+
+
+def GetWriteStats():
+  """Get the number of files written and skipped by WriteFile.
+
+  Returns:
+    dict, the number of files written and of writes skipped because the file
+        was already current.
+  """
+  with _write_lock:
+    return dict(_write_stats)
 
 
 def Lock(fd, path, blocking):
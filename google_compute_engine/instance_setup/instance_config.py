@@ -42,6 +42,9 @@ class InstanceConfig(config_manager.ConfigManager):
       'Accounts': {
           'deprovision_remove': 'false',
           'groups': 'adm,dip,lxd,plugdev,video',
+          'lazy_home': 'false',
+          'nss_cache': 'false',
+          'workers': '4',
       },
       'Daemons': {
           'accounts_daemon': 'true',
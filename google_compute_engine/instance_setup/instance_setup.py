@@ -30,6 +30,9 @@ from google_compute_engine import metadata_watcher
 from google_compute_engine.boto import boto_config
 from google_compute_engine.instance_setup import instance_config
 
+# Seconds to retry the metadata server before booting without its contents.
+METADATA_MAX_ELAPSED = 300
+
 
 class InstanceSetup(object):
   """Initialize the instance the first time it boots."""
@@ -43,7 +46,13 @@ class InstanceSetup(object):
     facility = logging.handlers.SysLogHandler.LOG_DAEMON
     self.logger = logger.Logger(
         name='instance-setup', debug=debug, facility=facility)
-    self.watcher = metadata_watcher.MetadataWatcher(logger=self.logger)
+    # Keep retries frequent since instance setup blocks the boot process, and
+    # give up eventually so the boot continues without the metadata server.
+    retry_policy = metadata_watcher.RetryPolicy(
+        max_delay=5, max_elapsed=METADATA_MAX_ELAPSED)
+    cache = metadata_watcher.MetadataCache(logger=self.logger)
+    self.watcher = metadata_watcher.MetadataWatcher(
+        logger=self.logger, retry_policy=retry_policy, cache=cache)
     self.metadata_dict = None
     self.instance_config = instance_config.InstanceConfig()
 
@@ -53,7 +62,7 @@ class InstanceSetup(object):
     if self.instance_config.GetOptionBool('InstanceSetup', 'set_multiqueue'):
       self._RunScript('set_multiqueue')
     if self.instance_config.GetOptionBool('InstanceSetup', 'network_enabled'):
-      self.metadata_dict = self.watcher.GetMetadata()
+      self.metadata_dict = self.watcher.GetMetadata() or {}
       if self.instance_config.GetOptionBool('InstanceSetup', 'set_host_keys'):
         self._SetSshHostKeys()
       if self.instance_config.GetOptionBool('InstanceSetup', 'set_boto_config'):
@@ -55,7 +55,12 @@ class InstanceSetupTest(unittest.TestCase):
         # Setup and reading the configuration file.
         mock.call.logger.Logger(
             name=mock.ANY, debug=False, facility=mock.ANY),
-        mock.call.watcher.MetadataWatcher(logger=mock_logger_instance),
+        mock.call.watcher.RetryPolicy(
+            max_delay=5, max_elapsed=instance_setup.METADATA_MAX_ELAPSED),
+        mock.call.watcher.MetadataCache(logger=mock_logger_instance),
+        mock.call.watcher.MetadataWatcher(
+            logger=mock_logger_instance, retry_policy=mock.ANY,
+            cache=mock.ANY),
         mock.call.config.InstanceConfig(),
         # Setup for local SSD.
         mock.call.config.InstanceConfig().GetOptionBool(
@@ -104,7 +109,12 @@ class InstanceSetupTest(unittest.TestCase):
     expected_calls = [
         mock.call.logger.Logger(
             name=mock.ANY, debug=False, facility=mock.ANY),
-        mock.call.watcher.MetadataWatcher(logger=mock_logger_instance),
+        mock.call.watcher.RetryPolicy(
+            max_delay=5, max_elapsed=instance_setup.METADATA_MAX_ELAPSED),
+        mock.call.watcher.MetadataCache(logger=mock_logger_instance),
+        mock.call.watcher.MetadataWatcher(
+            logger=mock_logger_instance, retry_policy=mock.ANY,
+            cache=mock.ANY),
         mock.call.config.InstanceConfig(),
         mock.call.config.InstanceConfig().GetOptionBool(
             'InstanceSetup', 'optimize_local_ssd'),
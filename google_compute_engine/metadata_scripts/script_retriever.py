@@ -25,6 +25,9 @@ from google_compute_engine.compat import httpclient
 from google_compute_engine.compat import urlerror
 from google_compute_engine.compat import urlretrieve
 
+# Seconds to retry the metadata server before running no scripts.
+METADATA_MAX_ELAPSED = 120
+
 
 class ScriptRetriever(object):
   """A class for retrieving and storing user provided metadata scripts."""
@@ -38,7 +41,13 @@ class ScriptRetriever(object):
     """
     self.logger = logger
     self.script_type = script_type
-    self.watcher = metadata_watcher.MetadataWatcher(logger=self.logger)
+    # Keep retries frequent since metadata scripts run during boot and shutdown,
+    # and give up eventually since a shutdown does not wait for long.
+    retry_policy = metadata_watcher.RetryPolicy(
+        max_delay=5, max_elapsed=METADATA_MAX_ELAPSED)
+    cache = metadata_watcher.MetadataCache(logger=self.logger)
+    self.watcher = metadata_watcher.MetadataWatcher(
+        logger=self.logger, retry_policy=retry_policy, cache=cache)
 
   def _DownloadGsUrl(self, url, dest_dir):
     """Download a Google Storage URL using gsutil.
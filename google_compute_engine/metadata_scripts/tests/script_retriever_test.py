@@ -33,6 +33,13 @@ class ScriptRetrieverTest(unittest.TestCase):
     self.retriever = script_retriever.ScriptRetriever(
         self.mock_logger, self.script_type)
 
+  def testWatcher(self):
+    self.assertEqual(self.retriever.watcher.retry_policy.max_delay, 5)
+    self.assertEqual(
+        self.retriever.watcher.retry_policy.max_elapsed,
+        script_retriever.METADATA_MAX_ELAPSED)
+    self.assertIsNotNone(self.retriever.watcher.cache)
+
   @mock.patch('google_compute_engine.metadata_scripts.script_retriever.subprocess.check_call')
   @mock.patch('google_compute_engine.metadata_scripts.script_retriever.tempfile.NamedTemporaryFile')
   def testDownloadGsUrl(self, mock_tempfile, mock_call):
@@ -16,18 +16,25 @@
 """A library for watching changes in the metadata server."""
 
 import functools
+import hashlib
+import io
 import json
 import logging
 import os
+import random
 import socket
+import threading
 import time
 
+from google_compute_engine import file_utils
 from google_compute_engine.compat import httpclient
 from google_compute_engine.compat import urlerror
 from google_compute_engine.compat import urlparse
-from google_compute_engine.compat import urlrequest
 
-METADATA_SERVER = 'http://metadata.google.internal/computeMetadata/v1'
+METADATA_HOST = 'metadata.google.internal'
+METADATA_IP = '169.254.169.254'
+METADATA_SERVER = 'http://%s/computeMetadata/v1' % METADATA_HOST
+CACHE_DIR = '/run/google_metadata'
 
 
 class StatusException(urlerror.HTTPError):
@@ -40,17 +47,90 @@ class StatusException(urlerror.HTTPError):
     super(StatusException, self).__init__(url, code, message, headers, response)
 
 
+class RetryPolicy(object):
+  """Capped exponential backoff with full jitter for metadata requests."""
+
+  def __init__(self, initial_delay=1, max_delay=30, multiplier=2,
+               max_elapsed=None):
+    """Constructor.
+
+    Args:
+      initial_delay: float, the delay cap in seconds for the first retry.
+      max_delay: float, the maximum delay in seconds between two retries.
+      multiplier: float, the growth factor of the delay cap between retries.
+      max_elapsed: float, seconds before giving up, or None to retry forever.
+    """
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.multiplier = multiplier
+    self.max_elapsed = max_elapsed
+    self.stats = {
+        'expired': 0,
+        'retries': 0,
+    }
+
+  def GetDelay(self, attempt):
+    """Get a randomized delay before retrying a request.
+
+    Args:
+      attempt: int, the number of retries already performed.
+
+    Returns:
+      float, the delay in seconds, uniformly chosen below the capped backoff.
+    """
+    backoff = self.initial_delay * self.multiplier ** min(attempt, 32)
+    return random.uniform(0, min(self.max_delay, backoff))
+
+  def Expired(self, start_time):
+    """Check whether the retry budget is exhausted.
+
+    Args:
+      start_time: float, the time in seconds of the first attempt.
+
+    Returns:
+      bool, True if no further retries should be attempted.
+    """
+    if self.max_elapsed is None:
+      return False
+    if time.time() - start_time < self.max_elapsed:
+      return False
+    self.stats['expired'] += 1
+    return True
+
+  def Sleep(self, attempt, stopped=None):
+    """Wait before retrying a request.
+
+    Args:
+      attempt: int, the number of retries already performed.
+      stopped: threading.Event, ends the wait early when set.
+    """
+    self.stats['retries'] += 1
+    delay = self.GetDelay(attempt)
+    if stopped is None:
+      time.sleep(delay)
+    else:
+      stopped.wait(delay)
+
+
 def RetryOnUnavailable(func):
-  """Function decorator to retry on a service unavailable exception."""
+  """Method decorator to retry on a service unavailable exception.
+
+  The instance retry policy determines the delay between retries.
+  """
 
   @functools.wraps(func)
-  def Wrapper(*args, **kwargs):
+  def Wrapper(self, *args, **kwargs):
+    start_time = time.time()
+    attempt = 0
     while True:
       try:
-        response = func(*args, **kwargs)
+        response = func(self, *args, **kwargs)
       except urlerror.HTTPError as e:
-        if e.getcode() == httpclient.SERVICE_UNAVAILABLE:
-          time.sleep(5)
+        if (e.getcode() == httpclient.SERVICE_UNAVAILABLE and
+            not self.stopped.is_set() and
+            not self.retry_policy.Expired(start_time)):
+          self.retry_policy.Sleep(attempt, stopped=self.stopped)
+          attempt += 1
         else:
           raise
       else:
@@ -61,19 +141,397 @@ def RetryOnUnavailable(func):
   return Wrapper
 
 
+class MetadataResponse(object):
+  """A fully read HTTP response from the metadata server."""
+
+  def __init__(self, url, code, headers, body):
+    """Constructor.
+
+    Args:
+      url: string, the URL of the request.
+      code: int, the HTTP status code of the response.
+      headers: dict, the response headers with lower case field names.
+      body: bytes, the contents of the response.
+    """
+    self.url = url
+    self.code = code
+    self.headers = headers
+    self.fp = io.BytesIO(body)
+    self.read = self.fp.read
+    self.readline = self.fp.readline
+    self.close = self.fp.close
+
+  def geturl(self):
+    return self.url
+
+  def getcode(self):
+    return self.code
+
+  def info(self):
+    return self.headers
+
+
+class ConnectionPool(object):
+  """A pool of persistent HTTP/1.1 connections to the metadata server.
+
+  The metadata server address is resolved once and connections are kept open
+  between requests, avoiding a DNS lookup and a TCP handshake for every poll.
+  """
+
+  def __init__(self, logger=logging, host=METADATA_HOST, port=80,
+               fallback_address=METADATA_IP, max_idle=4):
+    """Constructor.
+
+    Args:
+      logger: logger object, used to write to SysLog and serial port.
+      host: string, the host name of the metadata server.
+      port: int, the port of the metadata server.
+      fallback_address: string, the address used if the host does not resolve.
+      max_idle: int, the maximum number of idle connections kept open.
+    """
+    self.logger = logger
+    self.host = host
+    self.port = port
+    self.fallback_address = fallback_address
+    self.max_idle = max_idle
+    self.address = None
+    self.idle = []
+    self.lock = threading.Lock()
+    self.stats = {
+        'connections': 0,
+        'reconnects': 0,
+        'requests': 0,
+        'reused': 0,
+    }
+
+  def _ResolveAddress(self):
+    """Resolve the address of the metadata server once.
+
+    Returns:
+      string, the IP address of the metadata server.
+    """
+    if not self.address:
+      try:
+        address_info = socket.getaddrinfo(
+            self.host, self.port, socket.AF_INET, socket.SOCK_STREAM)
+        self.address = address_info[0][4][0]
+      except (socket.error, IndexError) as e:
+        self.logger.warning(
+            'Could not resolve %s, using %s. %s.',
+            self.host, self.fallback_address, str(e))
+        self.address = self.fallback_address
+    return self.address
+
+  def _GetConnection(self, timeout):
+    """Get an idle connection or open a new one.
+
+    Args:
+      timeout: float, the socket timeout in seconds for the request.
+
+    Returns:
+      tuple, the HTTP connection and True if the connection is reused.
+    """
+    with self.lock:
+      connection = self.idle.pop() if self.idle else None
+      if connection:
+        self.stats['reused'] += 1
+      else:
+        self.stats['connections'] += 1
+    if connection:
+      if connection.sock:
+        connection.sock.settimeout(timeout)
+      return connection, True
+    address = self._ResolveAddress()
+    return httpclient.HTTPConnection(address, self.port, timeout=timeout), False
+
+  def _ReleaseConnection(self, connection):
+    """Return a connection to the pool of idle connections.
+
+    Args:
+      connection: HTTP connection, the connection to keep open.
+    """
+    with self.lock:
+      if len(self.idle) < self.max_idle:
+        self.idle.append(connection)
+        return
+    connection.close()
+
+  def _Send(self, connection, path, headers):
+    """Send a GET request on a connection and read the complete response.
+
+    Args:
+      connection: HTTP connection, the connection for sending the request.
+      path: string, the path and query of the request.
+      headers: dict, the request headers.
+
+    Returns:
+      tuple, the HTTP response and the response contents.
+    """
+    connection.request('GET', path, headers=headers)
+    response = connection.getresponse()
+    return response, response.read()
+
+  def Request(self, url, headers=None, timeout=None):
+    """Perform a GET request reusing a persistent connection when possible.
+
+    Args:
+      url: string, the URL to perform a GET request on.
+      headers: dict, the request headers.
+      timeout: float, the socket timeout in seconds for the request.
+
+    Returns:
+      MetadataResponse, the fully read response.
+
+    Raises:
+      httpclient.HTTPException: raises when the response is invalid.
+      socket.error: raises when the connection fails.
+    """
+    path = '/' + url.split('/', 3)[3] if url.count('/') >= 3 else '/'
+    headers = dict(headers or {})
+    headers['Host'] = self.host
+    with self.lock:
+      self.stats['requests'] += 1
+    connection, reused = self._GetConnection(timeout)
+    try:
+      response, body = self._Send(connection, path, headers)
+    except socket.timeout:
+      connection.close()
+      raise
+    except (httpclient.HTTPException, socket.error):
+      connection.close()
+      if not reused:
+        raise
+      # The server may close an idle keep-alive connection at any time.
+      with self.lock:
+        self.stats['reconnects'] += 1
+        self.stats['connections'] += 1
+      connection = httpclient.HTTPConnection(
+          self._ResolveAddress(), self.port, timeout=timeout)
+      try:
+        response, body = self._Send(connection, path, headers)
+      except (httpclient.HTTPException, socket.error):
+        connection.close()
+        raise
+
+    if response.will_close:
+      connection.close()
+    else:
+      self._ReleaseConnection(connection)
+    response_headers = dict(
+        (key.lower(), value) for key, value in response.getheaders())
+    return MetadataResponse(url, response.status, response_headers, body)
+
+  def GetStats(self):
+    """Get the connection reuse counters of the pool.
+
+    Returns:
+      dict, the connection counters and the ratio of reused connections.
+    """
+    with self.lock:
+      stats = dict(self.stats)
+    requests = stats['requests']
+    stats['reuse_ratio'] = float(stats['reused']) / requests if requests else 0
+    return stats
+
+  def Close(self):
+    """Close all idle connections."""
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for connection in idle:
+      connection.close()
+
+
+class MetadataDelta(object):
+  """The structural difference between two metadata snapshots.
+
+  Paths are slash separated metadata keys of the leaf values in a snapshot.
+  Lists are compared as leaf values.
+  """
+
+  def __init__(self, old, new):
+    """Constructor.
+
+    Args:
+      old: json, the previous metadata contents or None.
+      new: json, the updated metadata contents.
+    """
+    self.old = old
+    self.new = new
+    old_values = self._Flatten(old) if old is not None else {}
+    new_values = self._Flatten(new)
+    self.added = dict(
+        (path, value) for path, value in new_values.items()
+        if path not in old_values)
+    self.removed = dict(
+        (path, value) for path, value in old_values.items()
+        if path not in new_values)
+    self.modified = dict(
+        (path, (old_values[path], value)) for path, value in new_values.items()
+        if path in old_values and old_values[path] != value)
+
+  def _Flatten(self, metadata, prefix=''):
+    """Map the paths of the leaf values in metadata contents to their values.
+
+    Args:
+      metadata: json, the deserialized metadata contents.
+      prefix: string, the path of the metadata contents.
+
+    Returns:
+      dict, a mapping of slash separated paths to leaf values.
+    """
+    if not isinstance(metadata, dict) or not metadata:
+      return {prefix: metadata}
+    values = {}
+    for key, value in metadata.items():
+      path = '%s/%s' % (prefix, key) if prefix else key
+      values.update(self._Flatten(value, prefix=path))
+    return values
+
+  def GetChangedPaths(self):
+    """Get the added, removed, and modified paths.
+
+    Returns:
+      list, the sorted paths that changed between the snapshots.
+    """
+    return sorted(
+        set(self.added) | set(self.removed) | set(self.modified))
+
+  def HasChanged(self, prefix=''):
+    """Check whether any value under a metadata path changed.
+
+    Args:
+      prefix: string, the slash separated path of a metadata key.
+
+    Returns:
+      bool, True if a leaf value at or under the path changed.
+    """
+    prefix = prefix.strip('/')
+    for path in self.GetChangedPaths():
+      if not prefix or path == prefix or path.startswith(prefix + '/'):
+        return True
+    return False
+
+
+class MetadataCache(object):
+  """An on-disk cache of metadata snapshots keyed by metadata key.
+
+  Each snapshot is stored with the etag of the response. The modification
+  time of a cache file is the time the snapshot was last known to be current.
+  """
+
+  def __init__(self, logger=logging, cache_dir=CACHE_DIR, ttl=60):
+    """Constructor.
+
+    Args:
+      logger: logger object, used to write to SysLog and serial port.
+      cache_dir: string, the directory storing the metadata snapshots.
+      ttl: int, the number of seconds a snapshot is served without a request.
+    """
+    self.logger = logger
+    self.cache_dir = cache_dir
+    self.ttl = ttl
+    self.stats = {
+        'hits': 0,
+        'misses': 0,
+        'revalidated': 0,
+    }
+
+  def _GetCacheFile(self, metadata_key, recursive):
+    """Get the location of the cache file for a metadata request.
+
+    Args:
+      metadata_key: string, the metadata key of the snapshot.
+      recursive: bool, True if the snapshot contains the recursive contents.
+
+    Returns:
+      string, the path of the cache file.
+    """
+    key = '%s:%s' % (metadata_key.strip('/'), bool(recursive))
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, '%s.json' % name)
+
+  def Get(self, metadata_key, recursive):
+    """Retrieve a cached metadata snapshot.
+
+    Args:
+      metadata_key: string, the metadata key of the snapshot.
+      recursive: bool, True if the snapshot contains the recursive contents.
+
+    Returns:
+      dict, the snapshot contents, etag, and freshness or None if not cached.
+    """
+    cache_file = self._GetCacheFile(metadata_key, recursive)
+    try:
+      age = time.time() - os.path.getmtime(cache_file)
+      with open(cache_file) as cache_fp:
+        snapshot = json.load(cache_fp)
+      snapshot['fresh'] = 0 <= age < self.ttl
+    except (IOError, OSError, ValueError):
+      self.stats['misses'] += 1
+      return None
+    self.stats['hits' if snapshot['fresh'] else 'misses'] += 1
+    return snapshot
+
+  def Set(self, metadata_key, recursive, etag, contents, snapshot=None):
+    """Store a metadata snapshot.
+
+    Args:
+      metadata_key: string, the metadata key of the snapshot.
+      recursive: bool, True if the snapshot contains the recursive contents.
+      etag: string, the etag of the metadata response.
+      contents: json, the deserialized contents of the metadata server.
+      snapshot: dict, the previously cached snapshot, if any.
+    """
+    cache_file = self._GetCacheFile(metadata_key, recursive)
+    try:
+      if snapshot and etag and snapshot.get('etag') == etag:
+        # The cached snapshot is current, so only update its timestamp.
+        os.utime(cache_file, None)
+        self.stats['revalidated'] += 1
+        return
+      if not os.path.exists(self.cache_dir):
+        os.makedirs(self.cache_dir, 0o700)
+      # The snapshot can be fetched again, so it is not synced to disk.
+      if not file_utils.WriteFile(
+          cache_file, json.dumps({'etag': etag, 'contents': contents}),
+          mode=0o600, sync=False):
+        os.utime(cache_file, None)
+    except (IOError, OSError, TypeError, ValueError) as e:
+      self.logger.debug('Could not cache metadata snapshot. %s.', str(e))
+
+
 class MetadataWatcher(object):
   """Watches for changes in metadata."""
 
-  def __init__(self, logger=logging, timeout=60):
+  # Bounds in seconds between the start of two consecutive hanging GET requests
+  # that return without a metadata change.
+  min_poll_interval = 1
+  max_poll_interval = 60
+
+  def __init__(
+      self, logger=logging, timeout=60, pool=None, retry_policy=None,
+      cache=None):
     """Constructor.
 
     Args:
       logger: logger object, used to write to SysLog and serial port.
       timeout: int, timeout in seconds for metadata requests.
+      pool: ConnectionPool, persistent connections to the metadata server.
+      retry_policy: RetryPolicy, the backoff between failed requests.
+      cache: MetadataCache, the metadata snapshots shared with other processes.
     """
     self.etag = 0
     self.logger = logger
     self.timeout = timeout
+    self.pool = pool or ConnectionPool(logger=logger)
+    self.retry_policy = retry_policy or RetryPolicy()
+    self.cache = cache
+    self.stopped = threading.Event()
+    self.poll_interval = self.min_poll_interval
+    self.stats = {
+        'early_polls': 0,
+        'wasted_polls': 0,
+    }
 
   @RetryOnUnavailable
   def _GetMetadataRequest(self, metadata_url, params=None):
@@ -92,8 +550,10 @@ class MetadataWatcher(object):
     headers = {'Metadata-Flavor': 'Google'}
     params = urlparse.urlencode(params or {})
     url = '%s?%s' % (metadata_url, params)
-    request = urlrequest.Request(url, headers=headers)
-    return urlrequest.urlopen(request, timeout=self.timeout*1.1)
+    response = self.pool.Request(url, headers=headers, timeout=self.timeout*1.1)
+    if response.getcode() != httpclient.OK:
+      raise StatusException(response)
+    return response
 
   def _UpdateEtag(self, response):
     """Update the etag from an API response.
@@ -109,6 +569,32 @@ class MetadataWatcher(object):
     self.etag = etag
     return etag_updated
 
+  def _WaitForNextPoll(self, elapsed):
+    """Rate limit hanging GET requests that return without a metadata change.
+
+    A request that returns early with an unchanged etag, for example through a
+    misbehaving proxy, doubles the interval between requests up to a maximum.
+    A request that waited for the full timeout resets the interval.
+
+    Args:
+      elapsed: float, the duration in seconds of the wasted request.
+    """
+    self.stats['wasted_polls'] += 1
+    if elapsed < self.timeout * 0.9:
+      self.stats['early_polls'] += 1
+      delay = self.poll_interval - elapsed
+      self.poll_interval = min(self.poll_interval * 2, self.max_poll_interval)
+      if self.stats['early_polls'] % 100 == 1:
+        self.logger.warning(
+            'Metadata request returned early without a change (%d times).',
+            self.stats['early_polls'])
+    else:
+      self.poll_interval = self.min_poll_interval
+      delay = self.poll_interval - elapsed
+    if delay > 0:
+      # Return as soon as the watcher is stopped.
+      self.stopped.wait(delay)
+
   def _GetMetadataUpdate(self, metadata_key='', recursive=True, wait=True):
     """Request the contents of metadata server and deserialize the response.
 
@@ -130,13 +616,16 @@ class MetadataWatcher(object):
         'wait_for_change': wait,
     }
     while True:
+      request_time = time.time()
       response = self._GetMetadataRequest(metadata_url, params=params)
       etag_updated = self._UpdateEtag(response)
-      if wait and not etag_updated:
-        # Retry until the etag is updated.
+      if wait and not etag_updated and not self.stopped.is_set():
+        # Retry until the etag is updated or the watcher is stopped.
+        self._WaitForNextPoll(time.time() - request_time)
         continue
       else:
         # Waiting for change is not required or the etag is updated.
+        self.poll_interval = self.min_poll_interval
         break
     return json.loads(response.read().decode('utf-8'))
 
@@ -149,36 +638,112 @@ class MetadataWatcher(object):
       wait: bool, True if we should wait for a metadata change.
 
     Returns:
-      json, the deserialized contents of the metadata server.
+      json, the deserialized contents of the metadata server or None if the
+          retry budget of the retry policy is exhausted.
     """
     exception = None
+    start_time = time.time()
+    attempt = 0
     while True:
       try:
         return self._GetMetadataUpdate(
             metadata_key=metadata_key, recursive=recursive, wait=wait)
       except (httpclient.HTTPException, socket.error, urlerror.URLError) as e:
-        if isinstance(e, type(exception)):
-          continue
-        else:
+        if not isinstance(e, type(exception)):
           exception = e
           self.logger.exception('GET request error retrieving metadata.')
+        if self.stopped.is_set():
+          return None
+        if self.retry_policy.Expired(start_time):
+          self.logger.warning(
+              'Giving up retrieving metadata key %s.', metadata_key or '/')
+          return None
+        self.retry_policy.Sleep(attempt, stopped=self.stopped)
+        attempt += 1
+
+  def _SelectMetadata(self, metadata, selector):
+    """Project the metadata contents onto the selected sub-trees.
+
+    Args:
+      metadata: json, the deserialized contents of the metadata server.
+      selector: callable or list, a projection function applied to the metadata
+          contents or the slash separated paths of metadata keys to select.
+
+    Returns:
+      json, the selected metadata contents.
+    """
+    if callable(selector):
+      return selector(metadata)
+    selection = {}
+    for path in selector:
+      value = metadata
+      for key in path.strip('/').split('/'):
+        if isinstance(value, dict) and key in value:
+          value = value[key]
+        else:
+          value = None
+          break
+      selection[path] = value
+    return selection
+
+  def _GetFingerprint(self, metadata):
+    """Compute a digest of metadata contents.
 
-  def WatchMetadata(self, handler, metadata_key='', recursive=True):
+    Args:
+      metadata: json, the deserialized metadata contents.
+
+    Returns:
+      string, the hex digest of the serialized metadata contents.
+    """
+    contents = json.dumps(metadata, sort_keys=True)
+    return hashlib.sha256(contents.encode('utf-8')).hexdigest()
+
+  def WatchMetadata(
+      self, handler, metadata_key='', recursive=True, selector=None,
+      delta=False):
     """Watch for changes to the contents of the metadata server.
 
     Args:
       handler: callable, a function to call with the updated metadata contents.
       metadata_key: string, the metadata key to watch for changes.
       recursive: bool, True if we should recursively watch for metadata changes.
+      selector: callable or list, a projection function or the slash separated
+          paths of metadata keys; if set, the handler is only called when the
+          selected metadata contents change.
+      delta: bool, True if the handler should be called with a MetadataDelta
+          against the contents of the last successful handler call.
     """
-    while True:
+    fingerprint = None
+    snapshot = None
+    while not self.stopped.is_set():
       response = self._HandleMetadataUpdate(
           metadata_key=metadata_key, recursive=recursive, wait=True)
+      if self.stopped.is_set():
+        break
+      if response is None:
+        # The retry budget is exhausted; keep the last contents and retry.
+        continue
       try:
-        handler(response)
+        if selector is not None:
+          selected_fingerprint = self._GetFingerprint(
+              self._SelectMetadata(response, selector))
+          if selected_fingerprint == fingerprint:
+            self.logger.debug('Selected metadata contents are unchanged.')
+            continue
+        if delta:
+          handler(MetadataDelta(snapshot, response))
+          snapshot = response
+        else:
+          handler(response)
+        if selector is not None:
+          fingerprint = selected_fingerprint
       except Exception as e:
         self.logger.exception('Exception calling the response handler. %s.', e)
 
+  def Stop(self):
+    """Stop watching for changes, ending any wait between requests."""
+    self.stopped.set()
+
   def GetMetadata(self, metadata_key='', recursive=True):
     """Retrieve the contents of metadata server for a metadata key.
 
@@ -189,5 +754,126 @@ class MetadataWatcher(object):
     Returns:
       json, the deserialized contents of the metadata server or None if error.
     """
-    return self._HandleMetadataUpdate(
+    if not self.cache:
+      return self._HandleMetadataUpdate(
+          metadata_key=metadata_key, recursive=recursive, wait=False)
+
+    snapshot = self.cache.Get(metadata_key, recursive)
+    if snapshot and snapshot['fresh']:
+      return snapshot['contents']
+    contents = self._HandleMetadataUpdate(
         metadata_key=metadata_key, recursive=recursive, wait=False)
+    if contents is not None:
+      self.cache.Set(
+          metadata_key, recursive, self.etag, contents, snapshot=snapshot)
+    elif snapshot:
+      self.logger.warning('Using a cached metadata snapshot.')
+      contents = snapshot['contents']
+    return contents
+
+
+class WatchGroup(object):
+  """Runs independent metadata watches concurrently in one process.
+
+  Each watch has its own etag, retry policy, and thread, and all watches share
+  a pool of persistent connections to the metadata server. Handlers are called
+  from the thread of their watch.
+  """
+
+  def __init__(self, logger=logging, timeout=60, pool=None):
+    """Constructor.
+
+    Args:
+      logger: logger object, used to write to SysLog and serial port.
+      timeout: int, timeout in seconds for metadata requests.
+      pool: ConnectionPool, persistent connections to the metadata server.
+    """
+    self.logger = logger
+    self.timeout = timeout
+    self.pool = pool or ConnectionPool(logger=logger)
+    self.watches = []
+    self.lock = threading.Lock()
+
+  def _Watch(self, watcher, handler, metadata_key, recursive, selector, delta):
+    """Run a metadata watch until it is cancelled.
+
+    Args:
+      watcher: MetadataWatcher, the watcher of the metadata key.
+      handler: callable, a function to call with the updated metadata contents.
+      metadata_key: string, the metadata key to watch for changes.
+      recursive: bool, True if we should recursively watch for metadata changes.
+      selector: callable or list, the metadata contents triggering the handler.
+      delta: bool, True if the handler should be called with a MetadataDelta.
+    """
+    try:
+      watcher.WatchMetadata(
+          handler, metadata_key=metadata_key, recursive=recursive,
+          selector=selector, delta=delta)
+    except Exception as e:
+      self.logger.exception('Exception watching %s. %s.', metadata_key, e)
+
+  def AddWatch(
+      self, handler, metadata_key='', recursive=True, selector=None,
+      delta=False, retry_policy=None):
+    """Start watching a metadata key in a new thread.
+
+    Args:
+      handler: callable, a function to call with the updated metadata contents.
+      metadata_key: string, the metadata key to watch for changes.
+      recursive: bool, True if we should recursively watch for metadata changes.
+      selector: callable or list, the metadata contents triggering the handler.
+      delta: bool, True if the handler should be called with a MetadataDelta.
+      retry_policy: RetryPolicy, the backoff between failed requests.
+
+    Returns:
+      MetadataWatcher, the watcher used to cancel the watch.
+    """
+    watcher = MetadataWatcher(
+        logger=self.logger, timeout=self.timeout, pool=self.pool,
+        retry_policy=retry_policy or RetryPolicy())
+    thread = threading.Thread(
+        target=self._Watch,
+        args=(watcher, handler, metadata_key, recursive, selector, delta))
+    thread.daemon = True
+    with self.lock:
+      self.watches.append((watcher, thread))
+      # Keep a connection open for each concurrent hanging GET request.
+      self.pool.max_idle = max(self.pool.max_idle, len(self.watches))
+    thread.start()
+    return watcher
+
+  def CancelWatch(self, watcher):
+    """Stop a metadata watch after its pending request completes.
+
+    Args:
+      watcher: MetadataWatcher, the watcher returned when adding the watch.
+    """
+    watcher.Stop()
+
+  def Cancel(self):
+    """Stop all the metadata watches."""
+    with self.lock:
+      watchers = [watcher for watcher, _ in self.watches]
+    for watcher in watchers:
+      watcher.Stop()
+
+  def Join(self, timeout=None):
+    """Wait for all the metadata watches to end.
+
+    Args:
+      timeout: float, the maximum number of seconds to wait or None.
+
+    Returns:
+      bool, True if all the watches ended.
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    while True:
+      with self.lock:
+        threads = [thread for _, thread in self.watches if thread.is_alive()]
+      if not threads:
+        return True
+      remaining = deadline - time.time() if deadline is not None else 1
+      if remaining <= 0:
+        return False
+      # Join with a timeout so signals are handled while waiting.
+      threads[0].join(min(remaining, 1))
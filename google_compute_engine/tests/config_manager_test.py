@@ -16,7 +16,6 @@
 """Unittest for config_manager.py module."""
 
 from google_compute_engine import config_manager
-from google_compute_engine.test_compat import builtin
 from google_compute_engine.test_compat import mock
 from google_compute_engine.test_compat import unittest
 
@@ -138,37 +137,43 @@ class ConfigManagerTest(unittest.TestCase):
     ]
     self.assertEqual(self.mock_config.mock_calls, expected_calls)
 
-  def testWriteConfig(self):
-    mock_open = mock.mock_open()
-    with mock.patch('%s.open' % builtin, mock_open, create=False):
-      self.mock_config_manager.WriteConfig()
-      expected_calls = [
-          mock.call('# %s' % self.config_header),
-          mock.call('\n\n'),
-      ]
-      self.assertEqual(mock_open().write.mock_calls, expected_calls)
+  @mock.patch('google_compute_engine.config_manager.file_utils')
+  def testWriteConfig(self, mock_file_utils):
+    mocks = mock.Mock()
+    mocks.attach_mock(mock_file_utils.LockFile, 'lock')
+    mocks.attach_mock(mock_file_utils.WriteFile, 'write')
+    self.mock_config.write.side_effect = (
+        lambda fp: fp.write('[section]\noption = value\n'))
+    self.mock_config_manager.WriteConfig()
+    expected_calls = [
+        mock.call.lock('/var/lock/google_test.lock'),
+        mock.call.lock().__enter__(),
+        mock.call.write(
+            self.config_file,
+            '# %s\n\n[section]\noption = value\n' % self.config_header),
+        mock.call.lock().__exit__(None, None, None),
+    ]
+    self.assertEqual(mocks.mock_calls, expected_calls)
 
   @mock.patch('google_compute_engine.config_manager.file_utils')
-  def testWriteConfigNoHeader(self, mock_lock):
+  def testWriteConfigNoHeader(self, mock_file_utils):
     self.mock_config_manager = config_manager.ConfigManager(
         config_file='/tmp/file.cfg')
-    mock_open = mock.mock_open()
-    with mock.patch('%s.open' % builtin, mock_open, create=False):
-      self.mock_config_manager.WriteConfig()
-      mock_open().write.assert_not_called()
-    mock_lock.LockFile.assert_called_once_with('/var/lock/google_file.lock')
+    self.mock_config_manager.WriteConfig()
+    mock_file_utils.LockFile.assert_called_once_with(
+        '/var/lock/google_file.lock')
+    mock_file_utils.WriteFile.assert_called_once_with('/tmp/file.cfg', '')
 
   @mock.patch('google_compute_engine.config_manager.file_utils')
-  def testWriteConfigLocked(self, mock_lock):
+  def testWriteConfigLocked(self, mock_file_utils):
     ioerror = IOError('Test Error')
-    mock_lock.LockFile.side_effect = ioerror
-    mock_open = mock.mock_open()
-    with mock.patch('%s.open' % builtin, mock_open, create=False):
-      with self.assertRaises(IOError) as error:
-        self.mock_config_manager.WriteConfig()
-      self.assertEqual(error.exception, ioerror)
-      mock_open().write.assert_not_called()
-    mock_lock.LockFile.assert_called_once_with('/var/lock/google_test.lock')
+    mock_file_utils.LockFile.side_effect = ioerror
+    with self.assertRaises(IOError) as error:
+      self.mock_config_manager.WriteConfig()
+    self.assertEqual(error.exception, ioerror)
+    mock_file_utils.WriteFile.assert_not_called()
+    mock_file_utils.LockFile.assert_called_once_with(
+        '/var/lock/google_test.lock')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the metadata server used in tests and benchmarks.
+
+The server emulates the metadata server query parameters used by the guest
+environment: alt=json, recursive, wait_for_change, last_etag, and timeout_sec.
+It can also answer with bursts of service unavailable errors and add a delay
+to every response.
+
+Metadata contents are set in process with SetMetadata, or from another process
+with a PUT request of a JSON value to a metadata path. A GET request to
+/fake/stats returns the request counters of the server, and a PUT request of a
+JSON object to /fake/config sets the response delay and the number of upcoming
+service unavailable errors.
+"""
+
+import hashlib
+import json
+import socket
+import threading
+import time
+
+from google_compute_engine.compat import httpclient
+from google_compute_engine.compat import httpserver
+from google_compute_engine.compat import socketserver
+from google_compute_engine.compat import urlparse
+
+METADATA_PATH = '/computeMetadata/v1'
+CONFIG_PATH = '/fake/config'
+STATS_PATH = '/fake/stats'
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+  """An HTTP server handling each connection in a thread."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _MetadataRequestHandler(httpserver.BaseHTTPRequestHandler):
+  """Answers metadata requests with the contents of a FakeMetadataServer."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    httpserver.BaseHTTPRequestHandler.setup(self)
+    # Headers and body are written separately, avoid delayed acknowledgements.
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.server.metadata_server.Count('connections')
+
+  def log_message(self, *args):
+    pass
+
+  def _SendResponse(self, code, body, etag=None, content_type='text/plain'):
+    """Send a complete response on the keep-alive connection.
+
+    Args:
+      code: int, the HTTP status code.
+      body: string, the contents of the response.
+      etag: string, the etag of the metadata contents.
+      content_type: string, the media type of the contents.
+    """
+    body = body.encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('Metadata-Flavor', 'Google')
+    if etag:
+      self.send_header('ETag', etag)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _ParseRequest(self):
+    """Split the request into a metadata key path and query parameters.
+
+    Returns:
+      tuple, the list of metadata keys and a dictionary of query parameters.
+    """
+    path, _, query = self.path.partition('?')
+    params = {}
+    for param in query.split('&'):
+      if '=' in param:
+        name, value = param.split('=', 1)
+        params[urlparse.unquote(name)] = urlparse.unquote(value)
+    path = urlparse.unquote(path)[len(METADATA_PATH):]
+    return [key for key in path.split('/') if key], params
+
+  def do_GET(self):
+    server = self.server.metadata_server
+    if self.path == STATS_PATH:
+      self._SendResponse(
+          httpclient.OK, json.dumps(server.GetStats()),
+          content_type='application/json')
+      return
+
+    server.Count('requests')
+    if self.headers.get('Metadata-Flavor') != 'Google':
+      self._SendResponse(httpclient.FORBIDDEN, 'Missing Metadata-Flavor.')
+      return
+    if not self.path.startswith(METADATA_PATH):
+      self._SendResponse(httpclient.NOT_FOUND, 'Not found.')
+      return
+    if server.ConsumeUnavailable():
+      self._SendResponse(httpclient.SERVICE_UNAVAILABLE, 'Unavailable.')
+      return
+
+    keys, params = self._ParseRequest()
+    recursive = params.get('recursive', '').lower() in ('true', '1')
+    if params.get('wait_for_change', '').lower() in ('true', '1'):
+      timeout = float(params.get('timeout_sec', 300))
+      server.WaitForChange(keys, params.get('last_etag'), timeout)
+    if server.delay:
+      time.sleep(server.delay)
+
+    found, value, etag = server.Lookup(keys)
+    if not found:
+      self._SendResponse(httpclient.NOT_FOUND, 'Not found.')
+      return
+    if isinstance(value, dict) and not recursive:
+      value = sorted(k + '/' if isinstance(v, dict) else k
+                     for k, v in value.items())
+    if params.get('alt') == 'json':
+      self._SendResponse(
+          httpclient.OK, json.dumps(value), etag=etag,
+          content_type='application/json')
+    elif isinstance(value, list):
+      self._SendResponse(httpclient.OK, '\n'.join(value), etag=etag)
+    else:
+      self._SendResponse(httpclient.OK, str(value), etag=etag)
+
+  def do_PUT(self):
+    server = self.server.metadata_server
+    length = int(self.headers.get('Content-Length', 0))
+    try:
+      value = json.loads(self.rfile.read(length).decode('utf-8'))
+    except ValueError:
+      self._SendResponse(httpclient.BAD_REQUEST, 'Invalid JSON.')
+      return
+    if self.path == CONFIG_PATH:
+      server.delay = float(value.get('delay', server.delay))
+      server.SetUnavailable(int(value.get('unavailable', 0)))
+    else:
+      keys, _ = self._ParseRequest()
+      server.SetMetadata('/'.join(keys), value)
+    self._SendResponse(httpclient.OK, '')
+
+
+class FakeMetadataServer(object):
+  """An HTTP server emulating the metadata server on the local host."""
+
+  def __init__(self, metadata=None, host='127.0.0.1', port=0):
+    """Constructor.
+
+    Args:
+      metadata: dict, the initial metadata contents.
+      host: string, the address the server listens on.
+      port: int, the port the server listens on or 0 for any free port.
+    """
+    self.metadata = metadata or {}
+    self.host = host
+    self.port = port
+    self.delay = 0
+    self.unavailable = 0
+    self.stopped = False
+    self.condition = threading.Condition()
+    self.server = None
+    self.thread = None
+    self.stats = {
+        'changes': 0,
+        'connections': 0,
+        'requests': 0,
+        'unavailable': 0,
+    }
+
+  def _GetEtag(self, value):
+    """Compute the etag of metadata contents.
+
+    Args:
+      value: json, the metadata contents.
+
+    Returns:
+      string, a digest of the metadata contents.
+    """
+    contents = json.dumps(value, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(contents).hexdigest()[:16]
+
+  def Count(self, name):
+    """Increment a request counter.
+
+    Args:
+      name: string, the name of the counter.
+    """
+    with self.condition:
+      self.stats[name] += 1
+
+  def GetStats(self):
+    """Get the request counters.
+
+    Returns:
+      dict, the counters of the server.
+    """
+    with self.condition:
+      return dict(self.stats)
+
+  def ConsumeUnavailable(self):
+    """Check whether the next request should fail as service unavailable.
+
+    Returns:
+      bool, True if the request should fail.
+    """
+    with self.condition:
+      if self.unavailable <= 0:
+        return False
+      self.unavailable -= 1
+      self.stats['unavailable'] += 1
+      return True
+
+  def SetUnavailable(self, count):
+    """Answer a number of upcoming requests with a service unavailable error.
+
+    Args:
+      count: int, the number of requests to fail.
+    """
+    with self.condition:
+      self.unavailable = count
+
+  def Lookup(self, keys):
+    """Find the metadata contents of a metadata key.
+
+    Args:
+      keys: list, the metadata keys forming the path of the contents.
+
+    Returns:
+      tuple, True if the key exists, the contents, and their etag.
+    """
+    with self.condition:
+      value = self.metadata
+      for key in keys:
+        if not isinstance(value, dict) or key not in value:
+          return False, None, None
+        value = value[key]
+      return True, value, self._GetEtag(value)
+
+  def SetMetadata(self, metadata_key, value):
+    """Set the contents of a metadata key and wake up waiting requests.
+
+    Args:
+      metadata_key: string, the slash separated metadata key or '' for all.
+      value: json, the metadata contents.
+    """
+    keys = [key for key in metadata_key.split('/') if key]
+    with self.condition:
+      if not keys:
+        self.metadata = value
+      else:
+        parent = self.metadata
+        for key in keys[:-1]:
+          parent = parent.setdefault(key, {})
+        parent[keys[-1]] = value
+      self.stats['changes'] += 1
+      self.condition.notify_all()
+
+  def WaitForChange(self, keys, last_etag, timeout):
+    """Block until the etag of a metadata key differs from the last etag.
+
+    Args:
+      keys: list, the metadata keys forming the path of the contents.
+      last_etag: string, the etag known by the client or None.
+      timeout: float, the maximum number of seconds to wait.
+    """
+    deadline = time.time() + timeout
+    with self.condition:
+      while not self.stopped:
+        if self.Lookup(keys)[2] != last_etag:
+          return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return
+        self.condition.wait(remaining)
+
+  def Start(self):
+    """Start serving requests in a background thread.
+
+    Returns:
+      int, the port the server listens on.
+    """
+    self.server = _ThreadingHTTPServer(
+        (self.host, self.port), _MetadataRequestHandler)
+    self.server.metadata_server = self
+    self.port = self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self.port
+
+  def Stop(self):
+    """Stop serving requests and release waiting requests."""
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.thread.join()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for fake_metadata_server.py module."""
+
+import json
+import threading
+import time
+
+from google_compute_engine import metadata_watcher
+from google_compute_engine.compat import httpclient
+from google_compute_engine.test_compat import mock
+from google_compute_engine.test_compat import unittest
+
+import fake_metadata_server
+
+
+class FakeMetadataServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.metadata = {
+        'instance': {
+            'attributes': {'hello': 'world'},
+            'id': 123,
+        },
+        'project': {'projectId': 'project'},
+    }
+    self.server = fake_metadata_server.FakeMetadataServer(
+        metadata=self.metadata)
+    self.port = self.server.Start()
+    self.pool = metadata_watcher.ConnectionPool(
+        logger=mock.Mock(), host='127.0.0.1', port=self.port)
+    self.retry_policy = metadata_watcher.RetryPolicy(
+        initial_delay=0.01, max_delay=0.01)
+    self.watcher = metadata_watcher.MetadataWatcher(
+        logger=mock.Mock(), timeout=1, pool=self.pool,
+        retry_policy=self.retry_policy)
+
+  def tearDown(self):
+    self.pool.Close()
+    self.server.Stop()
+
+  def _Request(self, method, path, body=None, headers=None):
+    connection = httpclient.HTTPConnection('127.0.0.1', self.port, timeout=5)
+    try:
+      connection.request(method, path, body=body, headers=headers or {})
+      response = connection.getresponse()
+      return response.status, response.read().decode('utf-8')
+    finally:
+      connection.close()
+
+  def testGetMetadata(self):
+    self.assertEqual(self.watcher.GetMetadata(), self.metadata)
+    self.assertEqual(
+        self.watcher.GetMetadata(metadata_key='instance/id', recursive=False),
+        123)
+    self.assertEqual(
+        self.watcher.GetMetadata(metadata_key='instance', recursive=False),
+        ['attributes/', 'id'])
+    stats = self.server.GetStats()
+    self.assertEqual(stats['requests'], 3)
+    self.assertEqual(stats['connections'], 1)
+    self.assertEqual(self.pool.GetStats()['reused'], 2)
+
+  def testGetMetadataText(self):
+    headers = {'Metadata-Flavor': 'Google'}
+    path = '/computeMetadata/v1/instance/attributes/hello'
+    self.assertEqual(self._Request('GET', path, headers=headers),
+                     (httpclient.OK, 'world'))
+    path = '/computeMetadata/v1/instance/missing'
+    self.assertEqual(self._Request('GET', path, headers=headers)[0],
+                     httpclient.NOT_FOUND)
+
+  def testGetMetadataForbidden(self):
+    path = '/computeMetadata/v1/instance/id'
+    self.assertEqual(self._Request('GET', path)[0], httpclient.FORBIDDEN)
+
+  def testGetMetadataUnavailable(self):
+    self.server.SetUnavailable(3)
+
+    self.assertEqual(self.watcher.GetMetadata(), self.metadata)
+    self.assertEqual(self.server.GetStats()['unavailable'], 3)
+    self.assertEqual(self.retry_policy.stats['retries'], 3)
+
+  def testGetMetadataDelay(self):
+    self.server.delay = 0.2
+    start_time = time.time()
+
+    self.watcher.GetMetadata(metadata_key='instance/id', recursive=False)
+    self.assertTrue(time.time() - start_time >= 0.2)
+
+  def testWaitForChange(self):
+    self.watcher.GetMetadata(metadata_key='instance/id', recursive=False)
+    timer = threading.Timer(
+        0.2, self.server.SetMetadata, args=('instance/id', 456))
+    timer.start()
+
+    result = self.watcher._GetMetadataUpdate(
+        metadata_key='instance/id', recursive=False, wait=True)
+    timer.join()
+    self.assertEqual(result, 456)
+
+  def testWaitForChangeTimeout(self):
+    self.watcher.GetMetadata(metadata_key='instance/id', recursive=False)
+    etag = self.watcher.etag
+    start_time = time.time()
+
+    # The request returns the unchanged contents after the timeout.
+    response = self.watcher._GetMetadataRequest(
+        metadata_watcher.METADATA_SERVER + '/instance/id',
+        params={'last_etag': etag, 'timeout_sec': 0.3,
+                'wait_for_change': True})
+    self.assertTrue(time.time() - start_time >= 0.3)
+    self.assertEqual(response.headers['etag'], etag)
+
+  def testWatchMetadata(self):
+    results = []
+    event = threading.Event()
+
+    def _Handler(response):
+      results.append(response)
+      if len(results) == 2:
+        event.set()
+
+    group = metadata_watcher.WatchGroup(
+        logger=mock.Mock(), timeout=1, pool=self.pool)
+    group.AddWatch(_Handler, metadata_key='instance/attributes')
+    time.sleep(0.2)
+    self.server.SetMetadata('instance/attributes/hello', 'you')
+    self.assertTrue(event.wait(5))
+    group.Cancel()
+    self.assertTrue(group.Join(timeout=5))
+    self.assertEqual(results, [{'hello': 'world'}, {'hello': 'you'}])
+
+  def testPutMetadata(self):
+    path = '/computeMetadata/v1/instance/attributes/new'
+    self.assertEqual(
+        self._Request('PUT', path, body=json.dumps({'a': 1}))[0],
+        httpclient.OK)
+    self.assertEqual(
+        self.watcher.GetMetadata(metadata_key='instance/attributes/new'),
+        {'a': 1})
+    self.assertEqual(
+        self._Request('PUT', path, body='invalid')[0], httpclient.BAD_REQUEST)
+
+  def testPutConfig(self):
+    config = {'delay': 0.5, 'unavailable': 2}
+    self.assertEqual(
+        self._Request(
+            'PUT', fake_metadata_server.CONFIG_PATH, body=json.dumps(config))[0],
+        httpclient.OK)
+    self.assertEqual(self.server.delay, 0.5)
+    self.assertEqual(self.server.unavailable, 2)
+
+  def testGetStats(self):
+    self.watcher.GetMetadata()
+    status, body = self._Request('GET', fake_metadata_server.STATS_PATH)
+    self.assertEqual(status, httpclient.OK)
+    self.assertEqual(json.loads(body)['requests'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,6 +15,10 @@
 
 """Unittest for file_utils_test.py module."""
 
+import os
+import shutil
+import tempfile
+
 from google_compute_engine import file_utils
 from google_compute_engine.test_compat import mock
 from google_compute_engine.test_compat import unittest
@@ -26,6 +30,7 @@ class FileUtilsTest(unittest.TestCase):
     self.fd = 1
     self.path = '/tmp/path'
 
+  @mock.patch('google_compute_engine.file_utils.selinux', None)
   @mock.patch('google_compute_engine.file_utils.subprocess.call')
   @mock.patch('google_compute_engine.file_utils.os.access')
   @mock.patch('google_compute_engine.file_utils.os.path.isfile')
@@ -34,40 +39,100 @@ class FileUtilsTest(unittest.TestCase):
     path = 'path'
     mock_isfile.return_value = True
     mock_access.return_value = True
-    file_utils._SetSELinuxContext(path)
+    with mock.patch.object(
+        file_utils, '_relabeler', file_utils._SELinuxRelabeler()):
+      file_utils._SetSELinuxContext(path)
+      file_utils._SetSELinuxContext(path)
+    # Whether restorecon is installed is only checked once.
     mock_isfile.assert_called_once_with(restorecon)
     mock_access.assert_called_once_with(restorecon, file_utils.os.X_OK)
-    mock_call.assert_called_once_with([restorecon, path])
+    self.assertEqual(
+        mock_call.mock_calls,
+        [mock.call([restorecon, path]), mock.call([restorecon, path])])
 
+  @mock.patch('google_compute_engine.file_utils.selinux', None)
   @mock.patch('google_compute_engine.file_utils.subprocess.call')
   @mock.patch('google_compute_engine.file_utils.os.access')
   @mock.patch('google_compute_engine.file_utils.os.path.isfile')
   def testSetSELinuxContextSkip(self, mock_isfile, mock_access, mock_call):
     mock_isfile.side_effect = [True, False, False]
     mock_access.side_effect = [False, True, False]
-    file_utils._SetSELinuxContext('1')
-    file_utils._SetSELinuxContext('2')
-    file_utils._SetSELinuxContext('3')
+    for path in ['1', '2', '3']:
+      relabeler = file_utils._SELinuxRelabeler()
+      with relabeler.Batch():
+        relabeler.Relabel(path)
+      relabeler.Relabel(path)
+    mock_call.assert_not_called()
+
+  @mock.patch('google_compute_engine.file_utils.selinux')
+  @mock.patch('google_compute_engine.file_utils.subprocess.call')
+  def testSetSELinuxContextLibrary(self, mock_call, mock_selinux):
+    relabeler = file_utils._SELinuxRelabeler()
+    mock_selinux.is_selinux_enabled.return_value = 1
+    mock_selinux.restorecon.side_effect = [None, OSError('Test Error')]
+    relabeler.Relabel('1')
+    relabeler.Relabel('2')
+    mock_selinux.is_selinux_enabled.return_value = 0
+    relabeler.Relabel('3')
+    self.assertEqual(
+        mock_selinux.restorecon.mock_calls, [mock.call('1'), mock.call('2')])
     mock_call.assert_not_called()
 
+  @mock.patch('google_compute_engine.file_utils.RESTORECON_MAX_PATHS', 2)
+  @mock.patch('google_compute_engine.file_utils.selinux', None)
+  @mock.patch('google_compute_engine.file_utils.subprocess.call')
+  def testBatchSELinuxContext(self, mock_call):
+    restorecon = '/sbin/restorecon'
+    relabeler = file_utils._SELinuxRelabeler()
+    relabeler.restorecon = True
+    with relabeler.Batch():
+      relabeler.Relabel('a')
+      with relabeler.Batch():
+        relabeler.Relabel('b')
+        relabeler.Relabel('a')
+      # The paths are relabeled when the outermost batch ends.
+      mock_call.assert_not_called()
+      relabeler.Relabel('c')
+    with relabeler.Batch():
+      pass
+    expected_calls = [
+        mock.call([restorecon, 'a', 'b']),
+        mock.call([restorecon, 'c']),
+    ]
+    self.assertEqual(mock_call.mock_calls, expected_calls)
+    self.assertEqual(relabeler.paths, [])
+    self.assertEqual(relabeler.batches, 0)
+
+  @mock.patch('google_compute_engine.file_utils._relabeler')
+  def testBatchSELinuxContextShared(self, mock_relabeler):
+    self.assertEqual(
+        file_utils.BatchSELinuxContext(), mock_relabeler.Batch.return_value)
+
   @mock.patch('google_compute_engine.file_utils._SetSELinuxContext')
+  @mock.patch('google_compute_engine.file_utils.os.stat')
   @mock.patch('google_compute_engine.file_utils.os.path.exists')
   @mock.patch('google_compute_engine.file_utils.os.mkdir')
   @mock.patch('google_compute_engine.file_utils.os.chown')
   @mock.patch('google_compute_engine.file_utils.os.chmod')
   def testSetPermissions(self, mock_chmod, mock_chown, mock_mkdir, mock_exists,
-                         mock_context):
+                         mock_stat, mock_context):
     mocks = mock.Mock()
     mocks.attach_mock(mock_chmod, 'chmod')
     mocks.attach_mock(mock_chown, 'chown')
     mocks.attach_mock(mock_mkdir, 'mkdir')
     mocks.attach_mock(mock_exists, 'exists')
+    mocks.attach_mock(mock_stat, 'stat')
     mocks.attach_mock(mock_context, 'context')
     path = 'path'
-    mode = 'mode'
-    uid = 'uid'
-    gid = 'gid'
+    mode = 0o600
+    uid = 1000
+    gid = 1001
+    unchanged = mock.Mock(st_mode=0o100600, st_uid=uid, st_gid=gid)
+    changed = mock.Mock(st_mode=0o100644, st_uid=0, st_gid=0)
+    changed_mode = mock.Mock(st_mode=0o100644, st_uid=uid, st_gid=gid)
     mock_exists.side_effect = [False, True, False]
+    mock_stat.side_effect = [
+        changed, changed, changed, changed_mode, unchanged]
 
     # Create a new directory.
     file_utils.SetPermissions(path, mode=mode, uid=uid, gid=gid, mkdir=True)
@@ -79,6 +144,10 @@ class FileUtilsTest(unittest.TestCase):
     file_utils.SetPermissions(path, mode=mode, uid=uid, gid=gid, mkdir=False)
     # Do not set an owner when a UID or GID is not specified.
     file_utils.SetPermissions(path, mode=mode, mkdir=False)
+    # Do not change the owner when only the mode differs.
+    file_utils.SetPermissions(path, mode=mode, uid=uid, gid=gid, mkdir=False)
+    # Do not change a path that already has the mode.
+    file_utils.SetPermissions(path, mode=mode, mkdir=False)
     # Set the SELinux context when no parameters are specified.
     file_utils.SetPermissions(path)
     expected_calls = [
@@ -89,6 +158,7 @@ class FileUtilsTest(unittest.TestCase):
         mock.call.context(path),
         # Attempt to create a new path but reuse existing path.
         mock.call.exists(path),
+        mock.call.stat(path),
         mock.call.chmod(path, mode),
         mock.call.chown(path, uid, gid),
         mock.call.context(path),
@@ -98,17 +168,134 @@ class FileUtilsTest(unittest.TestCase):
         mock.call.chown(path, uid, gid),
         mock.call.context(path),
         # Set permissions and owner on an existing path.
+        mock.call.stat(path),
         mock.call.chmod(path, mode),
         mock.call.chown(path, uid, gid),
         mock.call.context(path),
         # Set permissions, without changing ownership, of an existing path.
+        mock.call.stat(path),
         mock.call.chmod(path, mode),
         mock.call.context(path),
+        # Only change the mode of an existing path.
+        mock.call.stat(path),
+        mock.call.chmod(path, mode),
+        mock.call.context(path),
+        # Leave an unchanged path alone.
+        mock.call.stat(path),
         # Set SELinux context on an existing path.
         mock.call.context(path),
     ]
     self.assertEqual(mocks.mock_calls, expected_calls)
 
+  def _SetUpWriteFile(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    return temp_dir, os.path.join(temp_dir, 'file')
+
+  @mock.patch.dict(
+      'google_compute_engine.file_utils._write_stats',
+      {'skipped': 0, 'written': 0})
+  @mock.patch('google_compute_engine.file_utils._relabeler')
+  def testWriteFile(self, mock_relabeler):
+    mock_relabeler.LabelFile.return_value = False
+    temp_dir, path = self._SetUpWriteFile()
+
+    # A new file gets the default mode.
+    self.assertTrue(file_utils.WriteFile(path, 'a\n'))
+    self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+    inode = os.stat(path).st_ino
+    # The file is not replaced when the contents are the same.
+    self.assertFalse(file_utils.WriteFile(path, b'a\n'))
+    self.assertEqual(os.stat(path).st_ino, inode)
+    # The file is replaced when the contents change, keeping its mode.
+    os.chmod(path, 0o640)
+    self.assertTrue(file_utils.WriteFile(path, 'b\n', sync=False))
+    self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+    # The file is replaced when the mode changes.
+    self.assertTrue(file_utils.WriteFile(path, 'b\n', mode=0o600))
+    self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+    self.assertFalse(file_utils.WriteFile(
+        path, 'b\n', mode=0o600, uid=os.getuid(), gid=os.getgid()))
+    with open(path) as written_file:
+      self.assertEqual(written_file.read(), 'b\n')
+    self.assertEqual(os.listdir(temp_dir), ['file'])
+    self.assertEqual(
+        file_utils.GetWriteStats(), {'skipped': 2, 'written': 3})
+    self.assertEqual(mock_relabeler.Relabel.mock_calls, [mock.call(path)] * 3)
+
+  @mock.patch('google_compute_engine.file_utils._relabeler')
+  def testWriteFileLinks(self, mock_relabeler):
+    mock_relabeler.LabelFile.return_value = True
+    temp_dir, path = self._SetUpWriteFile()
+    target = os.path.join(temp_dir, 'target')
+    with open(target, 'w') as target_file:
+      target_file.write('a\n')
+    os.chmod(target, 0o644)
+
+    # A symbolic link is replaced, not followed.
+    os.symlink(target, path)
+    self.assertTrue(file_utils.WriteFile(path, 'a\n', mode=0o644))
+    self.assertFalse(os.path.islink(path))
+    # A file with several hard links is replaced, not changed.
+    os.remove(path)
+    os.link(target, path)
+    self.assertTrue(file_utils.WriteFile(path, 'a\n', mode=0o644))
+    self.assertEqual(os.stat(target).st_nlink, 1)
+    mock_relabeler.Relabel.assert_not_called()
+    self.assertEqual(mock_relabeler.LabelFile.call_count, 2)
+
+  @mock.patch('google_compute_engine.file_utils.os.rename')
+  def testWriteFileError(self, mock_rename):
+    temp_dir, path = self._SetUpWriteFile()
+    mock_rename.side_effect = OSError('Test Error')
+
+    # The temporary file is removed when the file cannot be replaced.
+    with self.assertRaises(OSError):
+      file_utils.WriteFile(path, 'a\n')
+    self.assertEqual(os.listdir(temp_dir), [])
+
+  @mock.patch('google_compute_engine.file_utils.os.fchown')
+  @mock.patch('google_compute_engine.file_utils.os.fsync')
+  @mock.patch('google_compute_engine.file_utils._relabeler')
+  def testWriteFileDescriptor(self, mock_relabeler, mock_fsync, mock_fchown):
+    mocks = mock.Mock()
+    mocks.attach_mock(mock_fchown, 'fchown')
+    mocks.attach_mock(mock_relabeler.LabelFile, 'label')
+    mocks.attach_mock(mock_fsync, 'fsync')
+    mock_relabeler.LabelFile.return_value = True
+    _, path = self._SetUpWriteFile()
+
+    # The owner and SELinux context are set before the file is synced.
+    file_utils.WriteFile(path, 'a\n', mode=0o600, uid=1, gid=2)
+    expected_calls = [
+        mock.call.fchown(mock.ANY, 1, 2),
+        mock.call.label(mock.ANY, path, 0o100600),
+        mock.call.fsync(mock.ANY),
+    ]
+    self.assertEqual(mocks.mock_calls, expected_calls)
+
+  @mock.patch('google_compute_engine.file_utils.selinux')
+  def testLabelFile(self, mock_selinux):
+    relabeler = file_utils._SELinuxRelabeler()
+    mock_selinux.is_selinux_enabled.return_value = 1
+    mock_selinux.matchpathcon.return_value = [0, 'context']
+    self.assertTrue(relabeler.LabelFile(3, 'path', 0o100600))
+    mock_selinux.matchpathcon.assert_called_once_with('path', 0o100600)
+    mock_selinux.fsetfilecon.assert_called_once_with(3, 'context')
+    mock_selinux.is_selinux_enabled.return_value = 0
+    self.assertTrue(relabeler.LabelFile(3, 'path', 0o100600))
+    self.assertEqual(mock_selinux.fsetfilecon.call_count, 1)
+
+    # Without libselinux, the path is relabeled after the rename.
+    with mock.patch.object(file_utils, 'selinux', None):
+      self.assertFalse(relabeler.LabelFile(3, 'path', 0o100600))
+
+  def testGetWriteStats(self):
+    stats = file_utils.GetWriteStats()
+    self.assertEqual(sorted(stats), ['skipped', 'written'])
+    stats['written'] = -1
+    self.assertNotEqual(file_utils.GetWriteStats()['written'], -1)
+
   @mock.patch('google_compute_engine.file_utils.fcntl.flock')
   def testLock(self, mock_flock):
     operation = file_utils.fcntl.LOCK_EX | file_utils.fcntl.LOCK_NB
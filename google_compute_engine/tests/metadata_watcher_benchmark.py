@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the metadata watcher against a local fake metadata server.
+
+The fake metadata server runs in a child process so the CPU time reported for
+each scenario only covers the watcher. Run from the repository root:
+
+  PYTHONPATH=. python google_compute_engine/tests/metadata_watcher_benchmark.py
+"""
+
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import threading
+import time
+
+from google_compute_engine import metadata_watcher
+from google_compute_engine.compat import httpclient
+
+import fake_metadata_server
+
+HOST = '127.0.0.1'
+
+
+def _ServeMetadata(metadata, connection):
+  """Run a fake metadata server until the parent process stops it.
+
+  Args:
+    metadata: dict, the initial metadata contents.
+    connection: multiprocessing.Connection, used to report the port.
+  """
+  server = fake_metadata_server.FakeMetadataServer(metadata=metadata, host=HOST)
+  connection.send(server.Start())
+  connection.recv()
+  server.Stop()
+
+
+def _GetCpuTime():
+  """Get the user and system CPU time consumed by this process.
+
+  Returns:
+    float, the CPU time in seconds.
+  """
+  times = os.times()
+  return times[0] + times[1]
+
+
+def _GetPercentile(values, percent):
+  """Get a percentile of a list of values.
+
+  Args:
+    values: list, the measured values.
+    percent: int, the percentile between 0 and 100.
+
+  Returns:
+    float, the value at the percentile or 0 if there are no values.
+  """
+  if not values:
+    return 0
+  values = sorted(values)
+  index = int(round(percent / 100.0 * (len(values) - 1)))
+  return values[index]
+
+
+class MetadataWatcherBenchmark(object):
+  """Measure the metadata watcher in a set of scenarios."""
+
+  def __init__(self, options):
+    """Constructor.
+
+    Args:
+      options: optparse.Values, the benchmark parameters.
+    """
+    self.options = options
+    self.logger = logging.getLogger('metadata_watcher_benchmark')
+    self.logger.addHandler(logging.NullHandler())
+    self.port = None
+    self.process = None
+    self.connection = None
+
+  def Start(self):
+    """Start the fake metadata server process."""
+    metadata = {
+        'instance': {'attributes': {'counter': 0}, 'id': 123},
+        'project': {'attributes': {}, 'projectId': 'benchmark'},
+    }
+    self.connection, child_connection = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(
+        target=_ServeMetadata, args=(metadata, child_connection))
+    self.process.daemon = True
+    self.process.start()
+    self.port = self.connection.recv()
+
+  def Stop(self):
+    """Stop the fake metadata server process."""
+    self.connection.send(None)
+    self.process.join()
+
+  def _Control(self, method, path, body=None):
+    """Send a request to the fake metadata server outside the watcher pool.
+
+    Args:
+      method: string, the HTTP method.
+      path: string, the request path.
+      body: json, the contents to send or None.
+
+    Returns:
+      json, the decoded response contents or None.
+    """
+    connection = httpclient.HTTPConnection(HOST, self.port, timeout=10)
+    try:
+      if body is not None:
+        body = json.dumps(body)
+      connection.request(method, path, body=body)
+      contents = connection.getresponse().read().decode('utf-8')
+      return json.loads(contents) if contents else None
+    finally:
+      connection.close()
+
+  def _GetServerStats(self):
+    return self._Control('GET', fake_metadata_server.STATS_PATH)
+
+  def _Configure(self, delay=0, unavailable=0):
+    self._Control(
+        'PUT', fake_metadata_server.CONFIG_PATH,
+        body={'delay': delay, 'unavailable': unavailable})
+
+  def _SetCounter(self, value):
+    path = fake_metadata_server.METADATA_PATH + '/instance/attributes/counter'
+    self._Control('PUT', path, body=value)
+
+  def _CreateWatcher(self, timeout=60):
+    """Create a watcher with a fresh connection pool and retry policy.
+
+    Args:
+      timeout: int, timeout in seconds for watching metadata changes.
+
+    Returns:
+      tuple, the metadata watcher, its connection pool and its retry policy.
+    """
+    pool = metadata_watcher.ConnectionPool(
+        logger=self.logger, host=HOST, port=self.port)
+    retry_policy = metadata_watcher.RetryPolicy(
+        initial_delay=0.01, max_delay=0.1)
+    watcher = metadata_watcher.MetadataWatcher(
+        logger=self.logger, timeout=timeout, pool=pool,
+        retry_policy=retry_policy)
+    return watcher, pool, retry_policy
+
+  def BenchmarkWatch(self):
+    """Measure the latency from a metadata change to the handler call.
+
+    Returns:
+      dict, the measured results.
+    """
+    changes = self.options.changes
+    watcher, pool, _ = self._CreateWatcher()
+    sent = {}
+    received = {}
+    done = threading.Event()
+
+    def _Handler(response):
+      value = response.get('counter')
+      if value in sent and value not in received:
+        received[value] = time.time()
+      if len(received) == changes:
+        done.set()
+
+    thread = threading.Thread(
+        target=watcher.WatchMetadata, args=(_Handler,),
+        kwargs={'metadata_key': 'instance/attributes'})
+    thread.daemon = True
+    thread.start()
+    time.sleep(self.options.interval)
+
+    server_stats = self._GetServerStats()
+    cpu_time = _GetCpuTime()
+    for value in range(1, changes + 1):
+      sent[value] = time.time()
+      self._SetCounter(value)
+      time.sleep(self.options.interval)
+    done.wait(10)
+    cpu_time = _GetCpuTime() - cpu_time
+    requests = self._GetServerStats()['requests'] - server_stats['requests']
+    watcher.Stop()
+    self._SetCounter(0)
+    thread.join(10)
+    pool_stats = pool.GetStats()
+    pool.Close()
+
+    latencies = [
+        (received[value] - sent[value]) * 1000 for value in received]
+    return {
+        'changes': changes,
+        'delivered': len(received),
+        'latency_p50_ms': _GetPercentile(latencies, 50),
+        'latency_p90_ms': _GetPercentile(latencies, 90),
+        'latency_p99_ms': _GetPercentile(latencies, 99),
+        'requests_per_change': float(requests) / changes,
+        'cpu_ms': cpu_time * 1000,
+        'connections': pool_stats['connections'],
+        'reconnects': pool_stats['reconnects'],
+        'reuse_ratio': pool_stats['reuse_ratio'],
+        'wasted_polls': watcher.stats['wasted_polls'],
+    }
+
+  def _BenchmarkGet(self, delay=0, unavailable=0):
+    """Measure the throughput of one-shot metadata requests.
+
+    Args:
+      delay: float, the seconds the server waits before each response.
+      unavailable: int, the number of requests failing as unavailable.
+
+    Returns:
+      dict, the measured results.
+    """
+    requests = self.options.requests
+    watcher, pool, retry_policy = self._CreateWatcher()
+    self._Configure(delay=delay, unavailable=unavailable)
+    latencies = []
+    cpu_time = _GetCpuTime()
+    start_time = time.time()
+    for _ in range(requests):
+      request_time = time.time()
+      watcher.GetMetadata(metadata_key='instance/id', recursive=False)
+      latencies.append((time.time() - request_time) * 1000)
+    elapsed = time.time() - start_time
+    cpu_time = _GetCpuTime() - cpu_time
+    self._Configure()
+    pool_stats = pool.GetStats()
+    pool.Close()
+    return {
+        'requests': requests,
+        'requests_per_second': requests / elapsed,
+        'latency_p50_ms': _GetPercentile(latencies, 50),
+        'latency_max_ms': _GetPercentile(latencies, 100),
+        'cpu_ms_per_request': cpu_time * 1000 / requests,
+        'connections': pool_stats['connections'],
+        'reuse_ratio': pool_stats['reuse_ratio'],
+        'retries': retry_policy.stats['retries'],
+    }
+
+  def BenchmarkGet(self):
+    return self._BenchmarkGet()
+
+  def BenchmarkUnavailable(self):
+    return self._BenchmarkGet(unavailable=self.options.unavailable)
+
+  def BenchmarkSlow(self):
+    return self._BenchmarkGet(delay=self.options.delay)
+
+  def Run(self):
+    """Run every scenario and collect the results.
+
+    Returns:
+      dict, the results of each scenario.
+    """
+    scenarios = [
+        ('watch', self.BenchmarkWatch),
+        ('get', self.BenchmarkGet),
+        ('unavailable', self.BenchmarkUnavailable),
+        ('slow', self.BenchmarkSlow),
+    ]
+    results = {}
+    self.Start()
+    try:
+      for name, scenario in scenarios:
+        results[name] = scenario()
+    finally:
+      self.Stop()
+    return results
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '--changes', type='int', default=50,
+      help='number of metadata changes in the watch scenario.')
+  parser.add_option(
+      '--interval', type='float', default=0.05,
+      help='seconds between metadata changes.')
+  parser.add_option(
+      '--requests', type='int', default=500,
+      help='number of requests in the one-shot scenarios.')
+  parser.add_option(
+      '--unavailable', type='int', default=20,
+      help='number of service unavailable errors in the storm scenario.')
+  parser.add_option(
+      '--delay', type='float', default=0.005,
+      help='seconds the server waits before responding in the slow scenario.')
+  parser.add_option(
+      '--json', action='store_true', default=False,
+      help='print the results as JSON.')
+  (options, _) = parser.parse_args()
+
+  results = MetadataWatcherBenchmark(options).Run()
+  if options.json:
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return
+  for name in sorted(results):
+    print(name)
+    for key, value in sorted(results[name].items()):
+      if isinstance(value, float):
+        value = '{0:.3f}'.format(value)
+      print('  {0}: {1}'.format(key, value))
+
+
+if __name__ == '__main__':
+  main()
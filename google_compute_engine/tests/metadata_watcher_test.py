@@ -16,12 +16,314 @@
 """Unittest for metadata_watcher.py module."""
 
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 
 from google_compute_engine import metadata_watcher
 from google_compute_engine.test_compat import mock
 from google_compute_engine.test_compat import unittest
 
 
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mock_logger = mock.Mock()
+    self.url = 'http://metadata.google.internal/computeMetadata/v1/?a=b'
+    self.path = '/computeMetadata/v1/?a=b'
+    self.headers = {'Metadata-Flavor': 'Google'}
+    self.pool = metadata_watcher.ConnectionPool(logger=self.mock_logger)
+    self.pool.address = '10.0.0.1'
+
+  def _CreateResponse(self, will_close=False):
+    mock_response = mock.Mock()
+    mock_response.status = metadata_watcher.httpclient.OK
+    mock_response.will_close = will_close
+    mock_response.read.return_value = bytes(b'{}')
+    mock_response.getheaders.return_value = [('ETag', '1')]
+    return mock_response
+
+  @mock.patch('google_compute_engine.metadata_watcher.socket.getaddrinfo')
+  def testResolveAddress(self, mock_getaddrinfo):
+    self.pool.address = None
+    mock_getaddrinfo.return_value = [(2, 1, 6, '', ('10.0.0.2', 80))]
+
+    self.assertEqual(self.pool._ResolveAddress(), '10.0.0.2')
+    self.assertEqual(self.pool._ResolveAddress(), '10.0.0.2')
+    mock_getaddrinfo.assert_called_once_with(
+        metadata_watcher.METADATA_HOST, 80, metadata_watcher.socket.AF_INET,
+        metadata_watcher.socket.SOCK_STREAM)
+
+  @mock.patch('google_compute_engine.metadata_watcher.socket.getaddrinfo')
+  def testResolveAddressFallback(self, mock_getaddrinfo):
+    self.pool.address = None
+    mock_getaddrinfo.side_effect = metadata_watcher.socket.gaierror()
+
+    self.assertEqual(
+        self.pool._ResolveAddress(), metadata_watcher.METADATA_IP)
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+
+  @mock.patch('google_compute_engine.metadata_watcher.httpclient.HTTPConnection')
+  def testRequest(self, mock_connection):
+    mock_connection.return_value = mock_connection
+    mock_connection.getresponse.return_value = self._CreateResponse()
+    headers = dict(self.headers, Host=metadata_watcher.METADATA_HOST)
+
+    response = self.pool.Request(self.url, headers=self.headers, timeout=5)
+    self.assertEqual(response.getcode(), metadata_watcher.httpclient.OK)
+    self.assertEqual(response.geturl(), self.url)
+    self.assertEqual(response.headers, {'etag': '1'})
+    self.assertEqual(response.read(), bytes(b'{}'))
+    mock_connection.assert_called_once_with('10.0.0.1', 80, timeout=5)
+    mock_connection.request.assert_called_once_with(
+        'GET', self.path, headers=headers)
+    self.assertEqual(self.pool.idle, [mock_connection])
+
+  @mock.patch('google_compute_engine.metadata_watcher.httpclient.HTTPConnection')
+  def testRequestReuse(self, mock_connection):
+    mock_connection.return_value = mock_connection
+    mock_connection.getresponse.return_value = self._CreateResponse()
+
+    self.pool.Request(self.url, timeout=5)
+    self.pool.Request(self.url, timeout=10)
+    self.assertEqual(mock_connection.call_count, 1)
+    mock_connection.sock.settimeout.assert_called_once_with(10)
+    stats = self.pool.GetStats()
+    self.assertEqual(stats['requests'], 2)
+    self.assertEqual(stats['connections'], 1)
+    self.assertEqual(stats['reused'], 1)
+    self.assertEqual(stats['reuse_ratio'], 0.5)
+
+  @mock.patch('google_compute_engine.metadata_watcher.httpclient.HTTPConnection')
+  def testRequestWillClose(self, mock_connection):
+    mock_connection.return_value = mock_connection
+    mock_connection.getresponse.return_value = self._CreateResponse(
+        will_close=True)
+
+    self.pool.Request(self.url)
+    mock_connection.close.assert_called_once_with()
+    self.assertEqual(self.pool.idle, [])
+
+  @mock.patch('google_compute_engine.metadata_watcher.httpclient.HTTPConnection')
+  def testRequestReconnect(self, mock_connection):
+    mock_stale = mock.Mock()
+    mock_stale.request.side_effect = metadata_watcher.httpclient.BadStatusLine(
+        '')
+    self.pool.idle = [mock_stale]
+    mock_connection.return_value = mock_connection
+    mock_connection.getresponse.return_value = self._CreateResponse()
+
+    self.pool.Request(self.url)
+    mock_stale.close.assert_called_once_with()
+    mock_connection.assert_called_once_with('10.0.0.1', 80, timeout=None)
+    self.assertEqual(self.pool.idle, [mock_connection])
+    self.assertEqual(self.pool.GetStats()['reconnects'], 1)
+
+  @mock.patch('google_compute_engine.metadata_watcher.httpclient.HTTPConnection')
+  def testRequestException(self, mock_connection):
+    mock_connection.return_value = mock_connection
+    mock_connection.request.side_effect = metadata_watcher.socket.error()
+
+    with self.assertRaises(metadata_watcher.socket.error):
+      self.pool.Request(self.url)
+    mock_connection.close.assert_called_once_with()
+    self.assertEqual(mock_connection.call_count, 1)
+    self.assertEqual(self.pool.idle, [])
+
+  def testRequestTimeout(self):
+    mock_idle = mock.Mock()
+    mock_idle.getresponse.side_effect = metadata_watcher.socket.timeout()
+    self.pool.idle = [mock_idle]
+
+    with self.assertRaises(metadata_watcher.socket.timeout):
+      self.pool.Request(self.url)
+    mock_idle.close.assert_called_once_with()
+    self.assertEqual(self.pool.GetStats()['reconnects'], 0)
+
+  def testClose(self):
+    mock_idle = mock.Mock()
+    self.pool.idle = [mock_idle]
+
+    self.pool.Close()
+    mock_idle.close.assert_called_once_with()
+    self.assertEqual(self.pool.idle, [])
+
+
+class MetadataDeltaTest(unittest.TestCase):
+
+  def testMetadataDelta(self):
+    old = {
+        'instance': {
+            'attributes': {'a': '1', 'b': '2', 'c': {}},
+            'tags': ['x'],
+        },
+    }
+    new = {
+        'instance': {
+            'attributes': {'a': '1', 'b': '3', 'd': '4'},
+            'tags': ['x', 'y'],
+        },
+    }
+    delta = metadata_watcher.MetadataDelta(old, new)
+    self.assertEqual(delta.old, old)
+    self.assertEqual(delta.new, new)
+    self.assertEqual(delta.added, {'instance/attributes/d': '4'})
+    self.assertEqual(delta.removed, {'instance/attributes/c': {}})
+    expected_modified = {
+        'instance/attributes/b': ('2', '3'),
+        'instance/tags': (['x'], ['x', 'y']),
+    }
+    self.assertEqual(delta.modified, expected_modified)
+    expected_paths = [
+        'instance/attributes/b',
+        'instance/attributes/c',
+        'instance/attributes/d',
+        'instance/tags',
+    ]
+    self.assertEqual(delta.GetChangedPaths(), expected_paths)
+    self.assertTrue(delta.HasChanged())
+    self.assertTrue(delta.HasChanged('instance/attributes/'))
+    self.assertTrue(delta.HasChanged('instance/tags'))
+    self.assertFalse(delta.HasChanged('instance/attributes/a'))
+    self.assertFalse(delta.HasChanged('instance/tag'))
+
+  def testMetadataDeltaInitial(self):
+    delta = metadata_watcher.MetadataDelta(None, {'a': {'b': 1}})
+    self.assertEqual(delta.added, {'a/b': 1})
+    self.assertEqual(delta.removed, {})
+    self.assertEqual(delta.modified, {})
+
+  def testMetadataDeltaLeaf(self):
+    delta = metadata_watcher.MetadataDelta(['1.2.3.4'], ['5.6.7.8'])
+    self.assertEqual(delta.modified, {'': (['1.2.3.4'], ['5.6.7.8'])})
+    self.assertEqual(delta.GetChangedPaths(), [''])
+    self.assertTrue(delta.HasChanged())
+
+  def testMetadataDeltaUnchanged(self):
+    delta = metadata_watcher.MetadataDelta({'a': 1}, {'a': 1})
+    self.assertEqual(delta.GetChangedPaths(), [])
+    self.assertFalse(delta.HasChanged())
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mock_logger = mock.Mock()
+    self.temp_dir = tempfile.mkdtemp()
+    self.cache_dir = os.path.join(self.temp_dir, 'cache')
+    self.cache = metadata_watcher.MetadataCache(
+        logger=self.mock_logger, cache_dir=self.cache_dir, ttl=60)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testGetCacheFile(self):
+    cache_file = self.cache._GetCacheFile('instance/', True)
+    self.assertEqual(os.path.dirname(cache_file), self.cache_dir)
+    self.assertEqual(cache_file, self.cache._GetCacheFile('instance', True))
+    self.assertNotEqual(cache_file, self.cache._GetCacheFile('instance', False))
+
+  def testGetSet(self):
+    self.assertIsNone(self.cache.Get('', True))
+    self.cache.Set('', True, 'etag', {'hello': 'world'})
+
+    snapshot = self.cache.Get('', True)
+    self.assertEqual(snapshot['contents'], {'hello': 'world'})
+    self.assertEqual(snapshot['etag'], 'etag')
+    self.assertTrue(snapshot['fresh'])
+    self.assertIsNone(self.cache.Get('', False))
+    cache_file = self.cache._GetCacheFile('', True)
+    self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+    self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+    self.assertEqual(self.cache.stats['hits'], 1)
+    self.assertEqual(self.cache.stats['misses'], 2)
+
+  def testGetExpired(self):
+    self.cache.Set('', True, 'etag', {})
+    cache_file = self.cache._GetCacheFile('', True)
+    os.utime(cache_file, (0, 0))
+
+    self.assertFalse(self.cache.Get('', True)['fresh'])
+
+  def testSetRevalidate(self):
+    self.cache.Set('', True, 'etag', {'hello': 'world'})
+    cache_file = self.cache._GetCacheFile('', True)
+    os.utime(cache_file, (0, 0))
+    snapshot = self.cache.Get('', True)
+
+    self.cache.Set('', True, 'etag', {'hello': 'world'}, snapshot=snapshot)
+    self.assertTrue(self.cache.Get('', True)['fresh'])
+    self.assertEqual(self.cache.stats['revalidated'], 1)
+
+    self.cache.Set('', True, 'new', {'hello': 'you'}, snapshot=snapshot)
+    self.assertEqual(self.cache.Get('', True)['contents'], {'hello': 'you'})
+
+  def testSetUnchanged(self):
+    self.cache.Set('', True, None, {'hello': 'world'})
+    cache_file = self.cache._GetCacheFile('', True)
+    inode = os.stat(cache_file).st_ino
+    os.utime(cache_file, (0, 0))
+
+    # The same contents are not rewritten, but the snapshot is fresh again.
+    self.cache.Set('', True, None, {'hello': 'world'})
+    self.assertEqual(os.stat(cache_file).st_ino, inode)
+    self.assertTrue(self.cache.Get('', True)['fresh'])
+
+  def testSetError(self):
+    self.cache.cache_dir = os.path.join(self.temp_dir, 'file')
+    open(self.cache.cache_dir, 'w').close()
+
+    self.cache.Set('', True, 'etag', {})
+    self.assertEqual(self.mock_logger.debug.call_count, 1)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.policy = metadata_watcher.RetryPolicy(
+        initial_delay=1, max_delay=10, multiplier=2)
+
+  @mock.patch('google_compute_engine.metadata_watcher.random.uniform')
+  def testGetDelay(self, mock_uniform):
+    mock_uniform.side_effect = lambda low, high: high
+    delays = [self.policy.GetDelay(attempt) for attempt in range(6)]
+    self.assertEqual(delays, [1, 2, 4, 8, 10, 10])
+    self.assertEqual(self.policy.GetDelay(10000), 10)
+    mock_uniform.assert_called_with(0, 10)
+
+  def testGetDelayJitter(self):
+    for attempt in range(10):
+      delay = self.policy.GetDelay(attempt)
+      self.assertTrue(0 <= delay <= 10)
+
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testExpired(self, mock_time):
+    mock_time.time.return_value = 100
+    self.assertFalse(self.policy.Expired(0))
+    self.policy.max_elapsed = 60
+    self.assertFalse(self.policy.Expired(50))
+    self.assertTrue(self.policy.Expired(40))
+    self.assertEqual(self.policy.stats['expired'], 1)
+
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testSleep(self, mock_time):
+    self.policy.GetDelay = mock.Mock(return_value=3)
+    self.policy.Sleep(2)
+    self.policy.GetDelay.assert_called_once_with(2)
+    mock_time.sleep.assert_called_once_with(3)
+    self.assertEqual(self.policy.stats['retries'], 1)
+
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testSleepStopped(self, mock_time):
+    self.policy.GetDelay = mock.Mock(return_value=3)
+    mock_stopped = mock.Mock()
+    self.policy.Sleep(2, stopped=mock_stopped)
+    mock_stopped.wait.assert_called_once_with(3)
+    mock_time.sleep.assert_not_called()
+
+
 class MetadataWatcherTest(unittest.TestCase):
 
   def setUp(self):
@@ -37,97 +339,105 @@ class MetadataWatcherTest(unittest.TestCase):
     }
     self.mock_watcher = metadata_watcher.MetadataWatcher(
         logger=self.mock_logger, timeout=self.timeout)
+    # Waits between requests end early when the watcher is stopped.
+    self.mock_wait = mock.Mock()
+    self.mock_watcher.stopped.wait = self.mock_wait
 
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.urlopen')
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.Request')
-  def testGetMetadataRequest(self, mock_request, mock_urlopen):
-    mock_request.return_value = mock_request
+  def testGetMetadataRequest(self):
+    mock_pool = mock.Mock()
     mock_response = mock.Mock()
     mock_response.getcode.return_value = metadata_watcher.httpclient.OK
-    mock_urlopen.return_value = mock_response
+    mock_pool.Request.return_value = mock_response
+    self.mock_watcher.pool = mock_pool
     request_url = '%s?' % self.url
     headers = {'Metadata-Flavor': 'Google'}
     timeout = self.timeout * 1.1
 
-    self.mock_watcher._GetMetadataRequest(self.url)
-    mock_request.assert_called_once_with(request_url, headers=headers)
-    mock_urlopen.assert_called_once_with(mock_request, timeout=timeout)
+    self.assertEqual(
+        self.mock_watcher._GetMetadataRequest(self.url), mock_response)
+    mock_pool.Request.assert_called_once_with(
+        request_url, headers=headers, timeout=timeout)
 
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.urlopen')
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.Request')
-  def testGetMetadataRequestArgs(self, mock_request, mock_urlopen):
-    mock_request.return_value = mock_request
+  def testGetMetadataRequestArgs(self):
+    mock_pool = mock.Mock()
     mock_response = mock.Mock()
     mock_response.getcode.return_value = metadata_watcher.httpclient.OK
-    mock_urlopen.return_value = mock_response
+    mock_pool.Request.return_value = mock_response
+    self.mock_watcher.pool = mock_pool
     params = {'hello': 'world'}
     request_url = '%s?hello=world' % self.url
     headers = {'Metadata-Flavor': 'Google'}
     timeout = self.timeout * 1.1
 
     self.mock_watcher._GetMetadataRequest(self.url, params=params)
-    mock_request.assert_called_once_with(request_url, headers=headers)
-    mock_urlopen.assert_called_once_with(mock_request, timeout=timeout)
+    mock_pool.Request.assert_called_once_with(
+        request_url, headers=headers, timeout=timeout)
 
   @mock.patch('google_compute_engine.metadata_watcher.time')
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.urlopen')
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.Request')
-  def testGetMetadataRequestRetry(self, mock_request, mock_urlopen, mock_time):
+  def testGetMetadataRequestRetry(self, mock_time):
+    mock_pool = mock.Mock()
     mocks = mock.Mock()
-    mocks.attach_mock(mock_request, 'request')
-    mocks.attach_mock(mock_urlopen, 'urlopen')
+    mocks.attach_mock(mock_pool, 'pool')
     mocks.attach_mock(mock_time, 'time')
-    mock_request.return_value = mock_request
+    mocks.attach_mock(self.mock_wait, 'wait')
     mock_unavailable = mock.Mock()
     mock_unavailable.getcode.return_value = (
         metadata_watcher.httpclient.SERVICE_UNAVAILABLE)
     mock_success = mock.Mock()
     mock_success.getcode.return_value = metadata_watcher.httpclient.OK
+    self.mock_watcher.pool = mock_pool
 
     # Retry after a service unavailable error response.
-    mock_urlopen.side_effect = [
-        metadata_watcher.StatusException(mock_unavailable),
-        mock_success,
-    ]
+    mock_pool.Request.side_effect = [mock_unavailable, mock_success]
 
     self.mock_watcher._GetMetadataRequest(self.url)
     request_url = '%s?' % self.url
     headers = {'Metadata-Flavor': 'Google'}
     timeout = self.timeout * 1.1
     expected_calls = [
-        mock.call.request(request_url, headers=headers),
-        mock.call.urlopen(mock_request, timeout=timeout),
-        mock.call.time.sleep(mock.ANY),
-        mock.call.request(request_url, headers=headers),
-        mock.call.urlopen(mock_request, timeout=timeout),
+        mock.call.time.time(),
+        mock.call.pool.Request(request_url, headers=headers, timeout=timeout),
+        mock.call.wait(mock.ANY),
+        mock.call.pool.Request(request_url, headers=headers, timeout=timeout),
     ]
     self.assertEqual(mocks.mock_calls, expected_calls)
 
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.urlopen')
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.Request')
-  def testGetMetadataRequestHttpException(self, mock_request, mock_urlopen):
-    mock_request.return_value = mock_request
-    mock_response = mock.Mock()
-    mock_response.getcode.return_value = metadata_watcher.httpclient.NOT_FOUND
-    mock_urlopen.side_effect = metadata_watcher.StatusException(mock_response),
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testGetMetadataRequestRetryExpired(self, mock_time):
+    mock_time.time.side_effect = [0, 5, 15]
+    mock_pool = mock.Mock()
+    mock_unavailable = mock.Mock()
+    mock_unavailable.getcode.return_value = (
+        metadata_watcher.httpclient.SERVICE_UNAVAILABLE)
+    mock_pool.Request.return_value = mock_unavailable
+    self.mock_watcher.pool = mock_pool
+    self.mock_watcher.retry_policy = metadata_watcher.RetryPolicy(
+        max_elapsed=10)
 
     with self.assertRaises(metadata_watcher.StatusException):
       self.mock_watcher._GetMetadataRequest(self.url)
-    self.assertEqual(mock_request.call_count, 1)
-    self.assertEqual(mock_urlopen.call_count, 1)
+    self.assertEqual(mock_pool.Request.call_count, 2)
+    self.assertEqual(self.mock_wait.call_count, 1)
 
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.urlopen')
-  @mock.patch('google_compute_engine.metadata_watcher.urlrequest.Request')
-  def testGetMetadataRequestException(self, mock_request, mock_urlopen):
-    mock_request.return_value = mock_request
+  def testGetMetadataRequestHttpException(self):
+    mock_pool = mock.Mock()
     mock_response = mock.Mock()
     mock_response.getcode.return_value = metadata_watcher.httpclient.NOT_FOUND
-    mock_urlopen.side_effect = mock_response
+    mock_pool.Request.return_value = mock_response
+    self.mock_watcher.pool = mock_pool
 
     with self.assertRaises(metadata_watcher.StatusException):
       self.mock_watcher._GetMetadataRequest(self.url)
-    self.assertEqual(mock_request.call_count, 1)
-    self.assertEqual(mock_urlopen.call_count, 1)
+    self.assertEqual(mock_pool.Request.call_count, 1)
+
+  def testGetMetadataRequestException(self):
+    mock_pool = mock.Mock()
+    mock_pool.Request.side_effect = metadata_watcher.socket.error('Test')
+    self.mock_watcher.pool = mock_pool
+
+    with self.assertRaises(metadata_watcher.socket.error):
+      self.mock_watcher._GetMetadataRequest(self.url)
+    self.assertEqual(mock_pool.Request.call_count, 1)
 
   def testUpdateEtag(self):
     mock_response = mock.Mock()
@@ -175,7 +485,9 @@ class MetadataWatcherTest(unittest.TestCase):
     self.assertEqual(self.mock_watcher.etag, 0)
     mock_response.assert_called_once_with(request_url, params=self.params)
 
-  def testGetMetadataUpdateWait(self):
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testGetMetadataUpdateWait(self, mock_time):
+    mock_time.time.return_value = 0
     self.params['last_etag'] = 1
     self.mock_watcher.etag = 1
     mock_unchanged = mock.Mock()
@@ -193,6 +505,48 @@ class MetadataWatcherTest(unittest.TestCase):
     self.assertEqual(self.mock_watcher.etag, 2)
     expected_calls = [mock.call(request_url, params=self.params)] * 3
     self.assertEqual(mock_response.mock_calls, expected_calls)
+    self.assertEqual(self.mock_watcher.stats['wasted_polls'], 2)
+    self.assertEqual(self.mock_watcher.stats['early_polls'], 2)
+    self.assertEqual(
+        self.mock_wait.mock_calls, [mock.call(1), mock.call(2)])
+    self.assertEqual(self.mock_watcher.poll_interval, 1)
+
+  def testWaitForNextPollEarly(self):
+    self.mock_watcher._WaitForNextPoll(0.25)
+    self.mock_wait.assert_called_once_with(0.75)
+    self.assertEqual(self.mock_watcher.poll_interval, 2)
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+
+    # The interval doubles on each early return up to the maximum.
+    for _ in range(10):
+      self.mock_watcher._WaitForNextPoll(0)
+    self.assertEqual(self.mock_watcher.poll_interval, 60)
+    self.mock_wait.assert_called_with(60)
+    self.assertEqual(self.mock_watcher.stats['early_polls'], 11)
+    self.assertEqual(self.mock_watcher.stats['wasted_polls'], 11)
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+
+  def testWaitForNextPollTimeout(self):
+    self.mock_watcher.poll_interval = 16
+
+    # A request waiting for the full timeout resets the interval.
+    self.mock_watcher._WaitForNextPoll(self.timeout)
+    self.mock_wait.assert_not_called()
+    self.assertEqual(self.mock_watcher.poll_interval, 1)
+    self.assertEqual(self.mock_watcher.stats['early_polls'], 0)
+    self.assertEqual(self.mock_watcher.stats['wasted_polls'], 1)
+
+  def testGetMetadataUpdateStop(self):
+    mock_unchanged = mock.Mock()
+    mock_unchanged.headers = {'etag': 0}
+    mock_unchanged.read.return_value = bytes(b'{}')
+    mock_response = mock.Mock()
+    mock_response.return_value = mock_unchanged
+    self.mock_watcher._GetMetadataRequest = mock_response
+    self.mock_watcher.Stop()
+
+    self.assertEqual(self.mock_watcher._GetMetadataUpdate(), {})
+    self.assertEqual(mock_response.call_count, 1)
 
   def testHandleMetadataUpdate(self):
     mock_response = mock.Mock()
@@ -204,7 +558,9 @@ class MetadataWatcherTest(unittest.TestCase):
         metadata_key='', recursive=True, wait=False)
     self.mock_watcher.logger.exception.assert_not_called()
 
-  def testHandleMetadataUpdateException(self):
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testHandleMetadataUpdateException(self, mock_time):
+    mock_time.time.return_value = 0
     mock_response = mock.Mock()
     first = metadata_watcher.socket.timeout()
     second = metadata_watcher.urlerror.URLError('Test')
@@ -224,6 +580,24 @@ class MetadataWatcherTest(unittest.TestCase):
     self.assertEqual(mock_response.mock_calls, expected_calls)
     expected_calls = [mock.call.exception(mock.ANY)] * 2
     self.assertEqual(self.mock_logger.mock_calls, expected_calls)
+    self.assertEqual(self.mock_wait.call_count, 3)
+    self.assertEqual(self.mock_watcher.retry_policy.stats['retries'], 3)
+
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testHandleMetadataUpdateExpired(self, mock_time):
+    mock_time.time.side_effect = [0, 5, 15]
+    mock_response = mock.Mock()
+    mock_response.side_effect = metadata_watcher.socket.timeout()
+    self.mock_watcher._GetMetadataUpdate = mock_response
+    self.mock_watcher.retry_policy = metadata_watcher.RetryPolicy(
+        max_elapsed=10)
+
+    self.assertIsNone(self.mock_watcher._HandleMetadataUpdate(wait=False))
+    self.assertEqual(mock_response.call_count, 2)
+    self.assertEqual(self.mock_wait.call_count, 1)
+    self.assertEqual(self.mock_logger.exception.call_count, 1)
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+    self.assertEqual(self.mock_watcher.retry_policy.stats['expired'], 1)
 
   def testWatchMetadata(self):
     mock_response = mock.Mock()
@@ -240,7 +614,8 @@ class MetadataWatcherTest(unittest.TestCase):
     mock_response.assert_called_once_with(
         metadata_key='', recursive=recursive, wait=True)
 
-  def testWatchMetadataException(self):
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testWatchMetadataException(self, mock_time):
     mock_response = mock.Mock()
     mock_response.side_effect = metadata_watcher.socket.timeout()
     self.mock_watcher._GetMetadataUpdate = mock_response
@@ -254,6 +629,127 @@ class MetadataWatcherTest(unittest.TestCase):
     mock_response.assert_called_once_with(
         metadata_key=metadata_key, recursive=recursive, wait=True)
 
+  def testSelectMetadata(self):
+    metadata = {
+        'instance': {'attributes': {'ssh-keys': 'key', 'hello': 'world'}},
+        'project': 'id',
+    }
+    selector = ['instance/attributes/ssh-keys', 'project/attributes/ssh-keys']
+    expected_selection = {
+        'instance/attributes/ssh-keys': 'key',
+        'project/attributes/ssh-keys': None,
+    }
+    self.assertEqual(
+        self.mock_watcher._SelectMetadata(metadata, selector),
+        expected_selection)
+    self.assertEqual(
+        self.mock_watcher._SelectMetadata(metadata, lambda m: m['project']),
+        'id')
+
+  def testGetFingerprint(self):
+    fingerprint = self.mock_watcher._GetFingerprint({'a': 1, 'b': [2, 3]})
+    self.assertEqual(
+        fingerprint, self.mock_watcher._GetFingerprint({'b': [2, 3], 'a': 1}))
+    self.assertNotEqual(
+        fingerprint, self.mock_watcher._GetFingerprint({'a': 1, 'b': [3, 2]}))
+
+  def testWatchMetadataSelector(self):
+    first = {'instance': {'id': 1, 'hostname': 'a'}}
+    second = {'instance': {'id': 1, 'hostname': 'b'}}
+    third = {'instance': {'id': 2, 'hostname': 'b'}}
+    mock_response = mock.Mock()
+    mock_response.side_effect = [first, second, third, RuntimeError()]
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+    mock_handler = mock.Mock()
+
+    with self.assertRaises(RuntimeError):
+      self.mock_watcher.WatchMetadata(mock_handler, selector=['instance/id'])
+    self.assertEqual(
+        mock_handler.mock_calls, [mock.call(first), mock.call(third)])
+
+  def testWatchMetadataSelectorException(self):
+    mock_response = mock.Mock()
+    mock_response.side_effect = [{}, {}, RuntimeError()]
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+    mock_handler = mock.Mock()
+    mock_handler.side_effect = [Exception(), None]
+
+    # The handler is called again if it raised an exception.
+    with self.assertRaises(RuntimeError):
+      self.mock_watcher.WatchMetadata(mock_handler, selector=lambda m: m)
+    self.assertEqual(mock_handler.mock_calls, [mock.call({})] * 2)
+    self.assertEqual(self.mock_logger.exception.call_count, 1)
+
+  def testWatchMetadataDelta(self):
+    first = {'a': 1}
+    second = {'a': 2}
+    third = {'a': 3}
+    mock_response = mock.Mock()
+    mock_response.side_effect = [first, second, third, RuntimeError()]
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+    deltas = []
+
+    def _Handler(delta):
+      deltas.append(delta)
+      if delta.new == second:
+        raise Exception()
+
+    with self.assertRaises(RuntimeError):
+      self.mock_watcher.WatchMetadata(_Handler, delta=True)
+    self.assertEqual(
+        [(delta.old, delta.new) for delta in deltas],
+        [(None, first), (first, second), (first, third)])
+    self.assertEqual(deltas[2].modified, {'a': (1, 3)})
+
+  def testWatchMetadataStop(self):
+    mock_response = mock.Mock()
+    mock_response.return_value = {}
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+    mock_handler = mock.Mock()
+    mock_handler.side_effect = lambda _: self.mock_watcher.Stop()
+
+    self.mock_watcher.WatchMetadata(mock_handler)
+    mock_handler.assert_called_once_with({})
+
+    # A stopped watcher does not call the handler.
+    mock_handler.reset_mock()
+    self.mock_watcher.WatchMetadata(mock_handler)
+    mock_handler.assert_not_called()
+
+  def testWatchMetadataNoResponse(self):
+    mock_response = mock.Mock()
+    mock_response.side_effect = [None, {'a': 1}, None, RuntimeError()]
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+    mock_handler = mock.Mock()
+
+    # The handler is not called when the retry budget is exhausted.
+    with self.assertRaises(RuntimeError):
+      self.mock_watcher.WatchMetadata(mock_handler, selector=['a'])
+    mock_handler.assert_called_once_with({'a': 1})
+    self.assertEqual(mock_response.call_count, 4)
+
+  def testWaitForNextPollStop(self):
+    watcher = metadata_watcher.MetadataWatcher(
+        logger=self.mock_logger, timeout=self.timeout)
+    watcher.poll_interval = 60
+    timer = threading.Timer(0.1, watcher.Stop)
+    timer.start()
+
+    # The wait ends when the watcher is stopped.
+    start_time = time.time()
+    watcher._WaitForNextPoll(0)
+    timer.join()
+    self.assertLess(time.time() - start_time, 30)
+
+  def testHandleMetadataUpdateStop(self):
+    mock_response = mock.Mock()
+    mock_response.side_effect = metadata_watcher.socket.timeout()
+    self.mock_watcher._GetMetadataUpdate = mock_response
+    self.mock_watcher.Stop()
+
+    self.assertIsNone(self.mock_watcher._HandleMetadataUpdate())
+    self.mock_wait.assert_not_called()
+
   def testGetMetadata(self):
     mock_response = mock.Mock()
     mock_response.return_value = {}
@@ -264,6 +760,77 @@ class MetadataWatcherTest(unittest.TestCase):
         metadata_key='', recursive=True, wait=False)
     self.mock_watcher.logger.exception.assert_not_called()
 
+  def testGetMetadataCache(self):
+    mock_cache = mock.Mock()
+    mock_cache.Get.return_value = {'contents': {'a': 1}, 'fresh': True}
+    self.mock_watcher.cache = mock_cache
+    mock_response = mock.Mock()
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+
+    self.assertEqual(self.mock_watcher.GetMetadata(), {'a': 1})
+    mock_cache.Get.assert_called_once_with('', True)
+    mock_response.assert_not_called()
+    mock_cache.Set.assert_not_called()
+
+  def testGetMetadataCacheStale(self):
+    snapshot = {'contents': {'a': 1}, 'etag': 'old', 'fresh': False}
+    mock_cache = mock.Mock()
+    mock_cache.Get.return_value = snapshot
+    self.mock_watcher.cache = mock_cache
+    mock_response = mock.Mock()
+    mock_response.return_value = {'a': 2}
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+    self.mock_watcher.etag = 'new'
+
+    self.assertEqual(
+        self.mock_watcher.GetMetadata(metadata_key='a', recursive=False),
+        {'a': 2})
+    mock_response.assert_called_once_with(
+        metadata_key='a', recursive=False, wait=False)
+    mock_cache.Set.assert_called_once_with(
+        'a', False, 'new', {'a': 2}, snapshot=snapshot)
+
+  def testGetMetadataCacheError(self):
+    mock_cache = mock.Mock()
+    mock_cache.Get.return_value = {'contents': {'a': 1}, 'fresh': False}
+    self.mock_watcher.cache = mock_cache
+    mock_response = mock.Mock()
+    mock_response.return_value = None
+    self.mock_watcher._HandleMetadataUpdate = mock_response
+
+    self.assertEqual(self.mock_watcher.GetMetadata(), {'a': 1})
+    mock_cache.Set.assert_not_called()
+    self.assertEqual(self.mock_logger.warning.call_count, 1)
+
+  @mock.patch('google_compute_engine.metadata_watcher.time')
+  def testGetMetadataCacheRetryExpired(self, mock_time):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    clock = iter(range(1000, 2000))
+    mock_time.time.side_effect = lambda: next(clock)
+    cache = metadata_watcher.MetadataCache(
+        logger=self.mock_logger, cache_dir=temp_dir, ttl=60)
+    cache.Set('', True, 'etag', {'a': 1})
+    os.utime(cache._GetCacheFile('', True), (0, 0))
+    mock_pool = mock.Mock()
+    mock_pool.Request.side_effect = socket.error('Test Error')
+    retry_policy = metadata_watcher.RetryPolicy(max_delay=5, max_elapsed=30)
+    self.mock_watcher.pool = mock_pool
+    self.mock_watcher.retry_policy = retry_policy
+    self.mock_watcher.cache = cache
+
+    # The stale snapshot is used once the retry budget is exhausted.
+    self.assertEqual(self.mock_watcher.GetMetadata(), {'a': 1})
+    retries = retry_policy.stats['retries']
+    self.assertGreater(retries, 1)
+    self.assertEqual(retry_policy.stats['expired'], 1)
+    self.assertEqual(mock_pool.Request.call_count, retries + 1)
+    self.assertEqual(self.mock_wait.call_count, retries)
+    self.mock_logger.warning.assert_has_calls([
+        mock.call(mock.ANY, '/'),
+        mock.call('Using a cached metadata snapshot.'),
+    ])
+
   def testGetMetadataArgs(self):
     mock_response = mock.Mock()
     mock_response.return_value = {}
@@ -279,5 +846,93 @@ class MetadataWatcherTest(unittest.TestCase):
     self.mock_watcher.logger.exception.assert_not_called()
 
 
+class WatchGroupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.mock_logger = mock.Mock()
+    self.mock_pool = mock.Mock()
+    self.mock_pool.max_idle = 1
+    self.group = metadata_watcher.WatchGroup(
+        logger=self.mock_logger, timeout=10, pool=self.mock_pool)
+
+  @mock.patch('google_compute_engine.metadata_watcher.threading.Thread')
+  @mock.patch('google_compute_engine.metadata_watcher.MetadataWatcher')
+  def testAddWatch(self, mock_watcher, mock_thread):
+    mock_handler = mock.Mock()
+    mock_policy = mock.Mock()
+
+    watcher = self.group.AddWatch(
+        mock_handler, metadata_key='key', recursive=False, selector=['a'],
+        delta=True, retry_policy=mock_policy)
+    self.assertEqual(watcher, mock_watcher.return_value)
+    mock_watcher.assert_called_once_with(
+        logger=self.mock_logger, timeout=10, pool=self.mock_pool,
+        retry_policy=mock_policy)
+    mock_thread.assert_called_once_with(
+        target=self.group._Watch,
+        args=(watcher, mock_handler, 'key', False, ['a'], True))
+    mock_thread.return_value.start.assert_called_once_with()
+    self.assertTrue(mock_thread.return_value.daemon)
+
+    # Each watch has its own retry policy.
+    self.group.AddWatch(mock_handler)
+    retry_policy = mock_watcher.call_args[1]['retry_policy']
+    self.assertTrue(isinstance(retry_policy, metadata_watcher.RetryPolicy))
+    self.assertEqual(self.mock_pool.max_idle, 2)
+
+  def testWatch(self):
+    mock_watcher = mock.Mock()
+    mock_handler = mock.Mock()
+    mock_watcher.WatchMetadata.side_effect = RuntimeError()
+
+    self.group._Watch(mock_watcher, mock_handler, 'key', True, None, False)
+    mock_watcher.WatchMetadata.assert_called_once_with(
+        mock_handler, metadata_key='key', recursive=True, selector=None,
+        delta=False)
+    self.assertEqual(self.mock_logger.exception.call_count, 1)
+
+  def testConcurrentWatches(self):
+    keys = ['a', 'b', 'c']
+    handled = []
+    events = dict((key, metadata_watcher.threading.Event()) for key in keys)
+
+    def _HandleMetadataUpdate(watcher, metadata_key='', **_):
+      if metadata_key in handled:
+        # Block like a hanging GET request until the watch is cancelled.
+        watcher.stopped.wait(5)
+      return metadata_key
+
+    def _Handler(response):
+      handled.append(response)
+      events[response].set()
+
+    with mock.patch.object(
+        metadata_watcher.MetadataWatcher, '_HandleMetadataUpdate',
+        autospec=True) as mock_update:
+      mock_update.side_effect = _HandleMetadataUpdate
+      for key in keys:
+        self.group.AddWatch(_Handler, metadata_key=key)
+      for key in keys:
+        self.assertTrue(events[key].wait(5))
+      self.group.Cancel()
+      self.assertTrue(self.group.Join(timeout=5))
+    self.assertEqual(sorted(handled), keys)
+
+  def testCancelWatch(self):
+    mock_watcher = mock.Mock()
+
+    self.group.CancelWatch(mock_watcher)
+    mock_watcher.Stop.assert_called_once_with()
+
+  def testJoinTimeout(self):
+    mock_thread = mock.Mock()
+    mock_thread.is_alive.return_value = True
+    self.group.watches = [(mock.Mock(), mock_thread)]
+
+    self.assertFalse(self.group.Join(timeout=0))
+    mock_thread.is_alive.return_value = False
+    self.assertTrue(self.group.Join())
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -37,6 +37,7 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'google_accounts_daemon=google_compute_engine.accounts.accounts_daemon:main',
+            'google_authorized_keys=google_compute_engine.accounts.authorized_keys_index:main',
             'google_clock_skew_daemon=google_compute_engine.clock_skew.clock_skew_daemon:main',
             'google_ip_forwarding_daemon=google_compute_engine.ip_forwarding.ip_forwarding_daemon:main',
             'google_instance_setup=google_compute_engine.instance_setup.instance_setup:main',